@@ -1,56 +1,214 @@
 # main.py
 
+import argparse
 import asyncio
-import sys
-import threading
-import time
+import configparser
 import logging
-import argparse
-from modules.gps_server import start_gps_server
-from modules.bluetooth_scanner import get_bluetooth_interfaces, start_continuous_scan_and_connect
-from modules.database import initialize_database
-from modules import utils
+import signal
+import sys
 from termcolor import colored
 
-# Configure logging
-logging.basicConfig(
-    filename='app.log',
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s:%(message)s'
-)
+from modules import utils
+from modules.config import read_config, apply_defaults, apply_tuning
+from modules.console import setup_logging, stop_logging, close_console
+
+# The scanner, database and GPS modules are imported in main() once the
+# arguments are parsed, so --help and bad options return immediately and
+# nothing Bluetooth-related is loaded before it is needed.
+
+def _parse_adapters(value, names):
+    """'all', 'hci0,hci1' or '0,1' -> list of adapter names. Exits on bad input."""
+    value = value.strip()
+    if value.lower() == "all":
+        return list(names)
+    adapters = []
+    for item in value.split(","):
+        item = item.strip()
+        if item.isdigit() and 0 <= int(item) < len(names):
+            item = names[int(item)]
+        if item not in names:
+            print(f"Invalid adapter: {item}")
+            sys.exit(1)
+        if item not in adapters:
+            adapters.append(item)
+    if not adapters:
+        print("No adapters selected.")
+        sys.exit(1)
+    return adapters
+
+def _split_adapters(adapters, scan_adapters, connect_adapters):
+    """
+    Decide which adapters scan and which connect. With several adapters and
+    no explicit split, the first one scans and the others connect.
+    """
+    if scan_adapters is None:
+        if connect_adapters is not None:
+            scan_adapters = [a for a in adapters if a not in connect_adapters] or list(adapters)
+        elif len(adapters) > 1:
+            scan_adapters = adapters[:1]
+        else:
+            scan_adapters = list(adapters)
+    if connect_adapters is None:
+        connect_adapters = [a for a in adapters if a not in scan_adapters] or list(scan_adapters)
+    return scan_adapters, connect_adapters
+
+async def _run(state, scan_adapters, connect_adapters):
+    """GPS source, HTTP server (/gps, /metrics, /api) and scanner share one event loop."""
+    from modules.gps_server import start_gps_source
+    from modules.gps_track import get_gps_track
+    from modules.http_server import start_http_server
+    from modules import api
+    from modules.bluetooth_scanner import start_continuous_scan_and_connect
+
+    gps_source = None
+    http_server = None
+    # Whichever starts the HTTP server, the GPS source or we, serves /api
+    api.register()
+    if state.settings.use_gps:
+        gps_source = await start_gps_source()
+    # The "http" GPS source already runs the server
+    if utils.METRICS_HTTP and (gps_source is None or isinstance(gps_source, asyncio.Task)):
+        http_server = await start_http_server(utils.GPS_HTTP_HOST, utils.GPS_HTTP_PORT)
+    if state.settings.use_gps and utils.GPS_WAIT_FOR_FIX:
+        print("Waiting for GPS data...")
+        await get_gps_track().wait_for_fix()
+        print("[INFO] GPS data received.")
+    try:
+        await start_continuous_scan_and_connect(scan_adapters, connect_adapters, state)
+    finally:
+        if isinstance(gps_source, asyncio.Task):
+            gps_source.cancel()
+        elif gps_source is not None:
+            gps_source.close()
+        if http_server is not None:
+            http_server.close()
 
-def main():
+def _build_parser():
     parser = argparse.ArgumentParser(
         description="PiBLE Application: Always scan + connect, store GATT data in DB, and optionally use GPS.",
-        epilog="No mode selection; the program automatically runs in continuous scanning+connecting mode."
+        epilog="No mode selection; the program automatically runs in continuous scanning+connecting mode. "
+               "Any long option can also be set in the [pible] section of a --config file."
     )
+    parser.add_argument("--config", metavar="FILE",
+                        help="INI settings file ([pible]: options, [tuning]: utils constants).")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Never prompt: unset options take their defaults (no GPS, all adapters, "
+                             "summary output). Implied when stdin is not a terminal.")
     parser.add_argument("--use-gps", choices=["y", "n"], help="Use GPS? 'y' to enable, 'n' to skip.")
+    parser.add_argument("--gps-wait", choices=["y", "n"],
+                        help="Wait for the first GPS fix before scanning (default: 'y', 'n' with --daemon).")
     parser.add_argument("--adapter-index", type=int, help="Index of the Bluetooth adapter to use.")
-    args = parser.parse_args()
+    parser.add_argument("--adapters",
+                        help="Adapters to use: 'all' or a comma-separated list (e.g. hci0,hci1).")
+    parser.add_argument("--scan-adapters",
+                        help="Adapters dedicated to scanning (default: the first of --adapters).")
+    parser.add_argument("--connect-adapters",
+                        help="Adapters dedicated to connections (default: the remaining adapters).")
+    parser.add_argument("--max-connect", type=int,
+                        help="Simultaneous connections per connect adapter (default: 5).")
+    parser.add_argument("--scan-mode", choices=["cycle", "stream", "sharded"],
+                        help="'cycle': scan, connect, sleep; 'stream': scan continuously; "
+                             "'sharded': like stream, with a process per scan adapter and connector "
+                             f"(default: {utils.SCAN_MODE}).")
+    parser.add_argument("--connectors", type=int,
+                        help="Connector processes in sharded mode (default: one per connect adapter).")
+    parser.add_argument("--scan-duration", type=float,
+                        help=f"Seconds per scan in cycle mode (default: {utils.SCAN_DURATION}).")
+    parser.add_argument("--scan-interval", type=float,
+                        help=f"Seconds between scans in cycle mode (default: {utils.SCAN_INTERVAL}).")
+    parser.add_argument("--db", metavar="PATH", help=f"SQLite database file (default: {utils.DB_PATH}).")
+    parser.add_argument("--log-file", default="app.log", help="Log file (default: app.log).")
+    parser.add_argument("--state-file", metavar="PATH",
+                        help=f"Journal of runtime state kept across restarts (default: {utils.STATE_JOURNAL}).")
+    parser.add_argument("--gps-source", choices=["http", "gpsd", "nmea"],
+                        help="'http': POST /gps on port 5000; 'gpsd': local gpsd; 'nmea': serial GPS "
+                             f"(default: {utils.GPS_SOURCE}).")
+    parser.add_argument("--gps-device", help=f"Serial device for --gps-source nmea (default: {utils.GPS_SERIAL_DEVICE}).")
+    parser.add_argument("--gps-baud", type=int, help=f"Baud rate of the serial GPS (default: {utils.GPS_SERIAL_BAUD}).")
+    parser.add_argument("--capture", metavar="DIR",
+                        help="Also record every received advert to binary capture files in DIR.")
+    parser.add_argument("--output", choices=["verbose", "summary", "dashboard"],
+                        help="'verbose': a line per device (default); 'summary': statistics only "
+                             "(default with --daemon); 'dashboard': live table redrawn in place.")
+    parser.add_argument("--no-metrics-http", action="store_true",
+                        help=f"Don't serve GET /metrics and /api on port {utils.GPS_HTTP_PORT} unless the GPS server runs.")
+    parser.add_argument("--metrics-dump", metavar="FILE",
+                        help="Also write all metrics as JSON to FILE every METRICS_DUMP_INTERVAL seconds.")
+    return parser
+
+def _parse_args(argv=None):
+    """Command line over [pible] settings over built-in defaults."""
+    parser = _build_parser()
+    pre, _ = parser.parse_known_args(argv)
+    if pre.config:
+        try:
+            config = read_config(pre.config)
+            apply_defaults(parser, config)
+            apply_tuning(config)
+        except (OSError, ValueError, configparser.Error) as e:
+            parser.error(f"{pre.config}: {e}")
+    return parser.parse_args(argv)
+
+def _ask(prompt, daemon, default):
+    """input(), or 'default' when running headless."""
+    if daemon:
+        return default
+    return input(prompt)
+
+def _shutdown(loop):
+    """Let cancelled tasks run their cleanup, then close the loop."""
+    pending = [task for task in asyncio.all_tasks(loop) if not task.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.close()
+
+def main(argv=None):
+    args = _parse_args(argv)
+    daemon = args.daemon or not sys.stdin.isatty()
+
+    setup_logging(args.log_file)
+    utils.CONSOLE_MODE = args.output or ("summary" if daemon else "verbose")
+    utils.METRICS_HTTP = not args.no_metrics_http
+    if args.metrics_dump:
+        utils.METRICS_DUMP_PATH = args.metrics_dump
+    if args.scan_duration:
+        utils.SCAN_DURATION = args.scan_duration
+    if args.scan_interval is not None:
+        utils.SCAN_INTERVAL = args.scan_interval
+    if args.db:
+        utils.DB_PATH = args.db
+    if args.state_file:
+        utils.STATE_JOURNAL = args.state_file
+    if args.connectors:
+        utils.SHARD_CONNECTORS = max(args.connectors, 1)
+    if args.capture:
+        utils.CAPTURE_DIR = args.capture
+    if args.gps_source:
+        utils.GPS_SOURCE = args.gps_source
+    if args.scan_mode:
+        utils.SCAN_MODE = args.scan_mode
+    if args.gps_device:
+        utils.GPS_SERIAL_DEVICE = args.gps_device
+    if args.gps_baud:
+        utils.GPS_SERIAL_BAUD = args.gps_baud
+
+    from modules.bluetooth_scanner import get_bluetooth_interfaces
+    from modules.database import initialize_database, close_database
+    from modules.runtime import get_runtime
+    from modules.capture import close_capture
 
     # Initialize the database
     initialize_database()
 
     # Prompt for GPS usage if not given
     if args.use_gps is None:
-        use_gps_input = input("Use GPS? (y/n): ")
+        use_gps_input = _ask("Use GPS? (y/n): ", daemon, "n")
     else:
         use_gps_input = args.use_gps
-    utils.use_gps = (use_gps_input.lower() == 'y')
-
-    # Start GPS server if GPS is used
-    if utils.use_gps:
-        gps_thread = threading.Thread(target=start_gps_server)
-        gps_thread.daemon = True
-        gps_thread.start()
-
-        print("Waiting for GPS data...")
-        while not utils.gps_data_received:
-            time.sleep(0.1)
-        print("[INFO] GPS data received.")
-    else:
-        utils.gps_status = "offline"
-        utils.gps_data_received = True
+    use_gps = (use_gps_input.lower() == 'y')
+    utils.GPS_WAIT_FOR_FIX = (args.gps_wait or ("n" if daemon else "y")) == "y"
 
     # Find all Bluetooth interfaces
     interfaces = get_bluetooth_interfaces()
@@ -58,37 +216,68 @@ def main():
         print("No Bluetooth interfaces found.")
         sys.exit(1)
 
-    # Prompt or use CLI argument for adapter index
-    if args.adapter_index is not None:
-        adapter_index = args.adapter_index
+    names = [interface for interface, _ in interfaces]
+
+    # Prompt or use CLI arguments for the adapters
+    if args.adapters or args.scan_adapters or args.connect_adapters:
+        adapters = _parse_adapters(args.adapters or "all", names)
+    elif args.adapter_index is not None:
+        adapters = _parse_adapters(str(args.adapter_index), names)
+    elif daemon:
+        adapters = list(names)
     else:
         print("Available Bluetooth interfaces:")
         for idx, (interface, bus_info) in enumerate(interfaces):
             print(f"{idx}: {interface} ({bus_info})")
-        adapter_index = int(input("Select the interface to use (enter the number): "))
+        adapters = _parse_adapters(
+            input("Select the interface(s) to use (number, comma-separated numbers or 'all'): "),
+            names
+        )
 
-    if adapter_index < 0 or adapter_index >= len(interfaces):
-        print("Invalid adapter index.")
-        sys.exit(1)
-
-    chosen_adapter = interfaces[adapter_index][0]
+    scan_adapters, connect_adapters = _split_adapters(
+        adapters,
+        _parse_adapters(args.scan_adapters, names) if args.scan_adapters else None,
+        _parse_adapters(args.connect_adapters, names) if args.connect_adapters else None,
+    )
+    print(f"[INFO] Scanning on: {', '.join(scan_adapters)} | Connecting on: {', '.join(connect_adapters)}")
 
-    # Prompt for concurrency limit
-    limit_input = input("Set the limit on the number of simultaneous connections: ")
-    if limit_input.isdigit():
-        utils.max_connect = int(limit_input)
+    # Prompt for concurrency limit if not given
+    if args.max_connect is not None:
+        max_connect = max(args.max_connect, 1)
     else:
-        utils.max_connect = 5  # default
+        limit_input = _ask("Set the limit on the number of simultaneous connections: ", daemon, "")
+        if limit_input.isdigit():
+            max_connect = int(limit_input)
+        else:
+            max_connect = utils.MAX_CONNECT  # default
+
+    state = get_runtime()
+    state.update(use_gps=use_gps, max_connect=max_connect, scan_mode=utils.SCAN_MODE)
 
-    # Start continuous scanning and connecting
+    # Start the GPS source (if used), then continuous scanning and connecting
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    task = loop.create_task(_run(state, scan_adapters, connect_adapters))
+    # SIGTERM (systemd stop) and Ctrl+C cancel the scan; cleanup runs below
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, task.cancel)
+    stopped = False
     try:
-        loop.run_until_complete(start_continuous_scan_and_connect(chosen_adapter))
-    except KeyboardInterrupt:
-        print("[INFO] Keyboard interrupt received. Exiting.")
+        loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        stopped = True
+        logging.info("Stop requested, flushing pending writes")
     finally:
-        loop.close()
+        _shutdown(loop)
+        close_console()
+        if stopped:
+            print("[INFO] Stop requested. Flushing pending writes and exiting.")
+        # Write back dirty devices and state, then flush whatever the writer still has queued
+        state.close()
+        close_capture()
+        close_database()
+        logging.info("Shutdown complete")
+        stop_logging()
 
 if __name__ == "__main__":
     logo = r'''
@@ -0,0 +1,93 @@
+# modules/adv_codec.py
+
+"""
+Compact binary encoding of AdvertisementData fields for the 'devices' table.
+
+manufacturer_data: repeated <company id: u16><length: u16><data>
+service_uuids:     repeated <uuid>
+service_data:      repeated <uuid><length: u16><data>
+
+A <uuid> is a length byte (2 or 16) followed by the UUID: 16-bit SIG
+UUIDs on the Bluetooth base UUID take 2 bytes, everything else 16.
+All integers are little-endian.
+"""
+
+import struct
+import uuid
+
+_BASE_UUID_SUFFIX = "-0000-1000-8000-00805f9b34fb"
+_U16 = struct.Struct("<H")
+_COMPANY = struct.Struct("<HH")
+
+def _encode_uuid(value):
+    value = value.lower()
+    if value.startswith("0000") and value.endswith(_BASE_UUID_SUFFIX):
+        return b"\x02" + _U16.pack(int(value[4:8], 16))
+    return b"\x10" + uuid.UUID(value).bytes
+
+def _decode_uuid(buf, offset):
+    size = buf[offset]
+    offset += 1
+    if size == 2:
+        short = _U16.unpack_from(buf, offset)[0]
+        return f"0000{short:04x}{_BASE_UUID_SUFFIX}", offset + 2
+    return str(uuid.UUID(bytes=bytes(buf[offset:offset + 16]))), offset + 16
+
+def encode_manufacturer_data(manufacturer_data):
+    if not manufacturer_data:
+        return None
+    parts = []
+    for company_id, data in manufacturer_data.items():
+        parts.append(_COMPANY.pack(company_id, len(data)))
+        parts.append(bytes(data))
+    return b"".join(parts)
+
+def decode_manufacturer_data(blob):
+    result = {}
+    if not blob:
+        return result
+    offset = 0
+    while offset < len(blob):
+        company_id, size = _COMPANY.unpack_from(blob, offset)
+        offset += _COMPANY.size
+        result[company_id] = bytes(blob[offset:offset + size])
+        offset += size
+    return result
+
+def encode_service_uuids(service_uuids):
+    if not service_uuids:
+        return None
+    return b"".join(_encode_uuid(value) for value in service_uuids)
+
+def decode_service_uuids(blob):
+    result = []
+    if not blob:
+        return result
+    offset = 0
+    while offset < len(blob):
+        value, offset = _decode_uuid(blob, offset)
+        result.append(value)
+    return result
+
+def encode_service_data(service_data):
+    if not service_data:
+        return None
+    parts = []
+    for key, data in service_data.items():
+        parts.append(_encode_uuid(key))
+        parts.append(_U16.pack(len(data)))
+        parts.append(bytes(data))
+    return b"".join(parts)
+
+def decode_service_data(blob):
+    result = {}
+    if not blob:
+        return result
+    offset = 0
+    while offset < len(blob):
+        key, offset = _decode_uuid(blob, offset)
+        size = _U16.unpack_from(blob, offset)[0]
+        offset += 2
+        result[key] = bytes(blob[offset:offset + size])
+        offset += size
+    return result
@@ -0,0 +1,322 @@
+# modules/api.py
+
+"""
+Read-only query API on the scanner's HTTP server (the port of /gps and
+/metrics):
+
+    GET /api/devices?sort=last_seen|rssi&offset=0&limit=50
+    GET /api/device?mac=AA:BB:CC:DD:EE:FF
+    GET /api/adapters
+    GET /api/status
+    GET /api/events?since=N        new devices as server-sent events
+
+Lists and status come from in-process state (device registries, scan
+statistics, schedulers), never from SQLite, so a polling dashboard does
+not compete with the ingestion writer. A sorted device list is built at
+most once per API_LIST_TTL seconds and every page is cut from it.
+
+Only the device detail reads the database, for the stored row and the
+GATT table: on the thread-local read connection in an executor (a WAL
+reader never waits for the writer), cached for API_DETAIL_TTL seconds
+or until the device is interrogated again.
+
+JSON responses carry an ETag; a request whose If-None-Match names it gets
+an empty 304. The routes are added by register().
+"""
+
+import asyncio
+import hashlib
+import itertools
+import json
+import struct
+import time
+
+from . import utils
+from .adv_codec import decode_manufacturer_data, decode_service_uuids, decode_service_data
+from .database import load_device_detail
+from .device_registry import int_to_mac
+from .gatt_layout import mask_to_properties
+from .http_server import route, conditional
+from .runtime import instances, scanning, get_device_events
+
+_SORTS = ("last_seen", "rssi")
+
+# Sort -> _DeviceList
+_lists = {}
+# Distinguishes list versions across restarts of the process
+_boot = f"{int(time.time()):x}"
+_builds = itertools.count(1)
+# (MAC, interrogated_at) -> (expiry, future of load_device_detail())
+_details = {}
+_streams = 0
+
+def _error(status, message):
+    return status, {"status": "error", "message": message}
+
+def _etag(body):
+    return f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+def _json(request, data):
+    body = json.dumps(data).encode()
+    return conditional(request, _etag(body), body)
+
+def _registries():
+    """(state, registry) per distinct registry; the default pipeline shares the process one."""
+    seen = set()
+    for state in instances():
+        if id(state.registry) not in seen:
+            seen.add(id(state.registry))
+            yield state, state.registry
+
+def _payload(manufacturer_data, service_uuids, service_data, tx_power):
+    return {
+        "manufacturer_data": {str(company): bytes(data).hex() for company, data in (manufacturer_data or {}).items()},
+        "service_uuids": list(service_uuids or ()),
+        "service_data": {uuid: bytes(data).hex() for uuid, data in (service_data or {}).items()},
+        "tx_power": tx_power,
+    }
+
+def _device_json(state, record):
+    mac = int_to_mac(record.mac)
+    logical_device = state.identities.get(mac)
+    return {
+        "mac": mac,
+        "name": record.name,
+        "rssi": record.rssi,
+        "adapter": record.adapter,
+        "first_seen": record.first_seen,
+        "last_seen": record.last_seen,
+        "count": record.count,
+        "lat": record.gps[0] if record.gps else None,
+        "lon": record.gps[1] if record.gps else None,
+        "logical_id": logical_device.id if logical_device is not None else None,
+        "pipeline": state.name,
+    }
+
+class _DeviceList:
+    """One sorted snapshot of the registries and the pages served from it."""
+
+    def __init__(self, sort, version):
+        self.version = version
+        self.built_at = time.monotonic()
+        self.tag = f"{_boot}-{next(_builds)}"
+        sources = list(_registries())
+        if sort == "last_seen" and len(sources) == 1:
+            # Registries are kept in last-seen order already
+            state, registry = sources[0]
+            self.entries = [(state, record) for record in reversed(registry.records())]
+        else:
+            self.entries = [(state, record) for state, registry in sources for record in registry.records()]
+            key = (lambda entry: entry[1].last_seen) if sort == "last_seen" else (lambda entry: entry[1].rssi)
+            self.entries.sort(key=key, reverse=True)
+        # (offset, limit) -> (ETag, encoded body)
+        self.pages = {}
+
+    def page(self, offset, limit):
+        cached = self.pages.get((offset, limit))
+        if cached is None:
+            total = len(self.entries)
+            body = json.dumps({
+                "total": total,
+                "offset": offset,
+                "limit": limit,
+                "next_offset": offset + limit if offset + limit < total else None,
+                "devices": [_device_json(state, record) for state, record in self.entries[offset:offset + limit]],
+            }).encode()
+            cached = self.pages[(offset, limit)] = (f'"{self.tag}-{offset}-{limit}"', body)
+        return cached
+
+def _version():
+    return tuple((registry.observations, len(registry)) for _, registry in _registries())
+
+def _device_list(sort):
+    """The cached list for 'sort', rebuilt once it is older than API_LIST_TTL and out of date."""
+    cached = _lists.get(sort)
+    now = time.monotonic()
+    if cached is not None and now - cached.built_at < utils.API_LIST_TTL:
+        return cached
+    version = _version()
+    if cached is not None and cached.version == version:
+        cached.built_at = now
+        return cached
+    cached = _lists[sort] = _DeviceList(sort, version)
+    return cached
+
+def _int_param(request, name, default, maximum=None):
+    value = int(request.query.get(name, default))
+    if value < 0:
+        raise ValueError(name)
+    return min(value, maximum) if maximum is not None else value
+
+def devices_route(request):
+    """Devices in memory, most recently seen (or strongest) first, one page at a time."""
+    sort = request.query.get("sort", "last_seen")
+    if sort not in _SORTS:
+        return _error(400, f"sort must be one of: {', '.join(_SORTS)}")
+    try:
+        offset = _int_param(request, "offset", 0)
+        limit = _int_param(request, "limit", utils.API_PAGE_SIZE, utils.API_PAGE_MAX)
+    except ValueError:
+        return _error(400, "offset and limit must be non-negative integers")
+    etag, body = _device_list(sort).page(offset, limit)
+    return conditional(request, etag, body)
+
+async def _stored(mac, interrogated_at):
+    """(device row, GATT table) from the database, through the detail cache."""
+    now = time.monotonic()
+    key = (mac, interrogated_at)
+    cached = _details.get(key)
+    if cached is None or cached[0] < now:
+        if len(_details) >= utils.API_DETAIL_CACHE:
+            for stale in [k for k, (expiry, _) in _details.items() if expiry < now] or list(_details):
+                del _details[stale]
+        future = asyncio.get_running_loop().run_in_executor(None, load_device_detail, mac)
+        cached = _details[key] = (now + utils.API_DETAIL_TTL, future)
+    # Several requests may wait for one read; a client going away must not cancel it
+    return await asyncio.shield(cached[1])
+
+def _stored_json(row):
+    """Copy of a stored device row with the advert payload decoded."""
+    row = dict(row)
+    payload = [row.pop("manufacturer_data"), row.pop("service_uuids"), row.pop("service_data")]
+    try:
+        for i, decode in enumerate((decode_manufacturer_data, decode_service_uuids, decode_service_data)):
+            payload[i] = decode(payload[i]) if isinstance(payload[i], bytes) else None
+    except (IndexError, ValueError, struct.error):
+        payload = [None, None, None]
+    row.update(_payload(*payload, row.pop("tx_power")))
+    return row
+
+def _gatt_json(gatt):
+    # Property masks as names; copies, the cached table is shared
+    return dict(gatt, services=[
+        dict(service, characteristics=[
+            dict(characteristic, properties=mask_to_properties(characteristic["properties"] or 0))
+            for characteristic in service["characteristics"]
+        ])
+        for service in gatt["services"]
+    ])
+
+async def device_route(request):
+    """One device: live state, logical device, stored row and GATT table."""
+    mac = request.query.get("mac", "").upper().replace("-", ":")
+    if not utils.is_mac_address(mac):
+        return _error(400, "mac must be a MAC address")
+    live = logical = None
+    for state, registry in _registries():
+        record = registry.get(mac)
+        if record is not None and (live is None or record.last_seen > live["last_seen"]):
+            live = _device_json(state, record)
+            live.update(_payload(record.manufacturer_data, record.service_uuids,
+                                 record.service_data, record.tx_power))
+            logical = state.identities.get(mac)
+
+    row, gatt = await _stored(mac, logical.interrogated_at if logical is not None else None)
+    if live is None and row is None:
+        return _error(404, "Unknown device")
+    data = {
+        "mac": mac,
+        "live": live,
+        "stored": _stored_json(row) if row is not None else None,
+        "logical_device": {
+            "id": logical.id,
+            "current_mac": logical.mac,
+            "mac_count": logical.mac_count,
+            "first_seen": logical.first_seen,
+            "last_seen": logical.last_seen,
+            "interrogated_at": logical.interrogated_at,
+        } if logical is not None else None,
+        "gatt": _gatt_json(gatt) if gatt is not None else None,
+    }
+    return _json(request, data)
+
+def adapters_route(request):
+    """Per adapter: scanning now, plus rates of the last statistics window."""
+    adapters = {}
+    for state in instances():
+        for adapter, stats in state.scan_stats.items():
+            adverts_per_sec, duty_cycle, dropped = stats.last
+            adapters.setdefault(adapter, {"pipeline": state.name}).update({
+                "scanning": stats.scanning,
+                "adverts_per_sec": round(adverts_per_sec, 1),
+                "scan_duty_cycle": round(duty_cycle, 2),
+                "dropped": dropped,
+            })
+        if state.scheduler is not None:
+            for adapter, (rate, success_rate) in state.scheduler.last_stats[3].items():
+                adapters.setdefault(adapter, {"pipeline": state.name}).update({
+                    "connects_per_sec": round(rate, 2),
+                    "connect_success_rate": round(success_rate, 2),
+                })
+    return _json(request, {"adapters": adapters})
+
+def status_route(request):
+    return _json(request, {
+        "scanning": scanning(),
+        "pipelines": [state.snapshot() for state in instances()],
+        "events": get_device_events().sequence,
+    })
+
+def _event_lines(event):
+    # The id carries the process' boot tag so a reconnect after a restart is recognised
+    return f"id: {_boot}-{event['seq']}\nevent: device\ndata: {json.dumps(event)}\n\n"
+
+def _parse_since(value, sequence):
+    """
+    Event number to resume after, from ?since=N or a Last-Event-ID of
+    'boot-N'. An id from an earlier process, or a number this process has
+    not reached, restarts from the beginning of the buffer.
+    """
+    boot, _, number = value.rpartition("-")
+    number = int(number)
+    if boot and boot != _boot:
+        return 0
+    return number if number <= sequence else 0
+
+async def _event_stream(since):
+    global _streams
+    _streams += 1
+    events = get_device_events()
+    try:
+        # EventSource clients reconnect after 'retry' ms and resume from Last-Event-ID
+        yield "retry: 3000\n\n"
+        while True:
+            batch = events.since(since)
+            if batch:
+                since = batch[-1]["seq"]
+                yield "".join(_event_lines(event) for event in batch)
+            else:
+                # Also how a closed connection is noticed
+                yield ": keep-alive\n\n"
+            await events.wait(since, utils.API_EVENT_HEARTBEAT)
+    finally:
+        _streams -= 1
+
+def events_route(request):
+    """
+    New devices as server-sent events, starting after event 'since' (or
+    the Last-Event-ID header); by default only events from now on. Event
+    ids are '<boot>-<n>'; the 'seq' field of the data is n.
+    """
+    if _streams >= utils.API_MAX_STREAMS:
+        return _error(503, "Too many event streams")
+    since = request.query.get("since", request.headers.get("last-event-id"))
+    sequence = get_device_events().sequence
+    try:
+        since = _parse_since(since, sequence) if since is not None else sequence
+    except ValueError:
+        return _error(400, "since must be an event number")
+    return _event_stream(since)
+
+_ROUTES = {
+    "/api/devices": devices_route,
+    "/api/device": device_route,
+    "/api/adapters": adapters_route,
+    "/api/status": status_route,
+    "/api/events": events_route,
+}
+
+def register():
+    """Add the /api routes to the HTTP server (before it starts serving)."""
+    for path, handler in _ROUTES.items():
+        route("GET", path)(handler)
@@ -0,0 +1,333 @@
+# modules/benchmark.py
+
+"""
+Benchmark of the scan -> persist -> connect pipeline against the simulator.
+
+    python -m modules.benchmark --duration 600 --devices 2000 --scan-mode stream
+    python -m modules.benchmark --replay capture.jsonl --speed 10 --json result.json
+    python -m modules.benchmark --record capture.jsonl --adapter hci0 --duration 300
+    python -m modules.benchmark --micro 200000 --devices 2000
+
+Runs start_continuous_scan_and_connect() on a throwaway database and
+reports adverts/sec ingested, DB rows/sec, connects/sec, first-advert ->
+GATT-capture latency percentiles and RSS memory. No Bluetooth hardware is
+needed except for --record.
+
+--micro N skips the event loop and the scanners: it feeds N simulated
+adverts straight through the ingestion path (ingest_batch()) and reports
+the CPU time per advert, plus the cost of writing the result back.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from . import utils
+from . import simulator
+from .console import setup_logging, stop_logging, close_console
+
+def _rss_kb():
+    """(current RSS, peak RSS) in kB from /proc/self/status, (0, 0) elsewhere."""
+    rss = peak = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, peak
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+class _Sampler:
+    """Interval snapshots of the pipeline counters during a run."""
+
+    def __init__(self, world, interval, verbose):
+        self.world = world
+        self.interval = interval
+        self.verbose = verbose
+        self.samples = []
+
+    def snapshot(self, elapsed):
+        from .database import get_writer
+        from .device_registry import get_registry
+        writer = get_writer()
+        rss, peak = _rss_kb()
+        return {
+            "elapsed": round(elapsed, 1),
+            "adverts_generated": self.world.adverts,
+            "adverts_ingested": get_registry().observations,
+            "rows_written": writer.rows_written,
+            "commits": writer.commits,
+            "writer_backlog": writer.pending(),
+            "devices_in_registry": len(get_registry()),
+            "connects": self.world.connects,
+            "connect_failures": self.world.connect_failures,
+            "captures": self.world.captures,
+            "rss_kb": rss,
+            "peak_rss_kb": peak,
+        }
+
+    async def run(self, started):
+        while True:
+            await asyncio.sleep(self.interval)
+            sample = self.snapshot(time.monotonic() - started)
+            self.samples.append(sample)
+            if self.verbose:
+                sys.stderr.write(
+                    f"[{sample['elapsed']:>7.1f}s] ingested {sample['adverts_ingested']} | "
+                    f"rows {sample['rows_written']} | captures {sample['captures']} | "
+                    f"RSS {sample['rss_kb'] // 1024} MB\n"
+                )
+
+def _summary(world, samples, duration, start_rss):
+    last = samples[-1]
+    latencies = world.latencies
+    return {
+        "duration": round(duration, 1),
+        "adverts_generated_per_sec": round(last["adverts_generated"] / duration, 1),
+        "adverts_ingested_per_sec": round(last["adverts_ingested"] / duration, 1),
+        "db_rows_per_sec": round(last["rows_written"] / duration, 1),
+        "db_commits_per_sec": round(last["commits"] / duration, 2),
+        "connects_per_sec": round(last["connects"] / duration, 2),
+        "captures_per_sec": round(last["captures"] / duration, 2),
+        "connect_success_rate": round(last["captures"] / last["connects"], 3) if last["connects"] else None,
+        "devices_heard": len(world.first_heard),
+        "devices_captured": len(latencies),
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p99": percentile(latencies, 0.99),
+        "rss_start_kb": start_rss,
+        "rss_end_kb": last["rss_kb"],
+        "rss_peak_kb": last["peak_rss_kb"],
+        "samples": samples,
+    }
+
+async def _run_pipeline(adapters, duration, sampler):
+    from .bluetooth_scanner import start_continuous_scan_and_connect
+    started = time.monotonic()
+    pipeline = asyncio.create_task(start_continuous_scan_and_connect(adapters))
+    sampling = asyncio.create_task(sampler.run(started))
+    try:
+        await asyncio.wait({pipeline}, timeout=duration)
+    finally:
+        for task in (pipeline, sampling):
+            task.cancel()
+        await asyncio.gather(pipeline, sampling, return_exceptions=True)
+    return time.monotonic() - started
+
+def run_benchmark(world, duration=60, adapters=("sim0",), scan_mode="stream",
+                  max_connect=5, sample_interval=5, workdir=None, verbose=False, capture_dir=None,
+                  output="verbose"):
+    """
+    Run the pipeline against 'world' for 'duration' seconds and return a
+    summary dict. 'output' is the console mode; its text is discarded
+    unless 'verbose'.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="pible-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    utils.DB_PATH = os.path.join(workdir, "bench.db")
+    utils.STATE_JOURNAL = os.path.join(workdir, "state.journal")
+    utils.CAPTURE_DIR = capture_dir
+    utils.CONSOLE_MODE = output
+    setup_logging(os.path.join(workdir, "bench.log"))
+
+    # Imported after DB_PATH is set so nothing opens the real database
+    from .database import initialize_database, close_database, get_writer
+    from .runtime import get_runtime
+    from .capture import close_capture
+
+    simulator.install(world)
+    start_rss = _rss_kb()[0]
+    sampler = _Sampler(world, sample_interval, verbose)
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    try:
+        with output:
+            initialize_database()
+            get_runtime().update(scan_mode=scan_mode, max_connect=max_connect, use_gps=False)
+            elapsed = asyncio.run(_run_pipeline(list(adapters), duration, sampler))
+            get_runtime().close()
+            close_capture()
+            close_console()
+            # Counters are read before close_database() drops the writer
+            get_writer().flush(timeout=60)
+            sampler.samples.append(sampler.snapshot(elapsed))
+            close_database(timeout=60)
+    finally:
+        simulator.uninstall()
+        stop_logging()
+    summary = _summary(world, sampler.samples, elapsed, start_rss)
+    summary["database"] = utils.DB_PATH
+    return summary
+
+def micro_benchmark(world, adverts=200000, batch_size=100, workdir=None):
+    """
+    CPU cost per advert of ingest_batch() (registry, identities, sightings,
+    console, connect offers) and of the following write-back flush.
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="pible-micro-")
+    os.makedirs(workdir, exist_ok=True)
+    utils.DB_PATH = os.path.join(workdir, "bench.db")
+    utils.STATE_JOURNAL = os.path.join(workdir, "state.journal")
+    utils.CONSOLE_MODE = "summary"
+    setup_logging(os.path.join(workdir, "bench.log"))
+
+    from .database import initialize_database, close_database, get_writer
+    from .runtime import get_runtime
+    from .connection_scheduler import ConnectionScheduler
+    from .bluetooth_scanner import ingest_batch
+
+    # Generated up front so the simulator is not part of the measurement
+    take = world.sampler()
+    events = []
+    while len(events) < adverts:
+        events.extend((device, advertisement_data, "sim0") for device, advertisement_data in take(1.0))
+    del events[adverts:]
+    batches = [events[i:i + batch_size] for i in range(0, len(events), batch_size)]
+
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            initialize_database()
+            state = get_runtime()
+            state.update(use_gps=False)
+            scheduler = ConnectionScheduler(["sim0"], state=state)
+
+            started = time.process_time()
+            for batch in batches:
+                ingest_batch(state, scheduler, batch)
+            ingest = time.process_time() - started
+
+            started = time.process_time()
+            state.flush()
+            get_writer().flush(timeout=60)
+            flush = time.process_time() - started
+            rows = get_writer().rows_written
+            state.close()
+            close_console()
+            close_database(timeout=60)
+    finally:
+        stop_logging()
+    return {
+        "adverts": len(events),
+        "batch_size": batch_size,
+        "devices": len(state.registry),
+        "ingest_us_per_advert": round(ingest / len(events) * 1e6, 2),
+        "ingest_adverts_per_cpu_sec": round(len(events) / ingest) if ingest else None,
+        "flush_us_per_advert": round(flush / len(events) * 1e6, 2),
+        "rows_written": rows,
+        "database": utils.DB_PATH,
+    }
+
+def _print_micro(summary):
+    print(f"Adverts:             {summary['adverts']} in batches of {summary['batch_size']}, "
+          f"{summary['devices']} devices")
+    print(f"Ingest CPU:          {summary['ingest_us_per_advert']} us/advert "
+          f"({summary['ingest_adverts_per_cpu_sec']} adverts per CPU second)")
+    print(f"Write-back CPU:      {summary['flush_us_per_advert']} us/advert ({summary['rows_written']} rows)")
+    print(f"Database:            {summary['database']}")
+
+def _print_summary(summary):
+    def ms(value):
+        return f"{value * 1000:.0f} ms" if value is not None else "n/a"
+
+    print(f"Duration:            {summary['duration']} s")
+    print(f"Adverts/sec:         {summary['adverts_ingested_per_sec']} ingested "
+          f"({summary['adverts_generated_per_sec']} generated)")
+    print(f"DB writes/sec:       {summary['db_rows_per_sec']} rows, {summary['db_commits_per_sec']} commits")
+    print(f"Connects/sec:        {summary['connects_per_sec']} "
+          f"({summary['captures_per_sec']} captures/sec, success rate {summary['connect_success_rate']})")
+    print(f"Devices:             {summary['devices_heard']} heard, {summary['devices_captured']} captured")
+    print(f"Capture latency:     p50 {ms(summary['latency_p50'])} | p99 {ms(summary['latency_p99'])}")
+    print(f"RSS:                 start {summary['rss_start_kb'] // 1024} MB | "
+          f"end {summary['rss_end_kb'] // 1024} MB | peak {summary['rss_peak_kb'] // 1024} MB")
+    print(f"Database:            {summary['database']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scan/persist/connect pipeline without Bluetooth hardware.")
+    parser.add_argument("--duration", type=float, default=60, help="Run time in seconds.")
+    parser.add_argument("--scan-mode", choices=["cycle", "stream"], default="stream")
+    parser.add_argument("--adapters", type=int, default=1, help="Number of simulated adapters.")
+    parser.add_argument("--max-connect", type=int, default=5, help="Connection workers per adapter.")
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--churn", type=float, default=30, help="Devices replaced per minute.")
+    parser.add_argument("--random-mac", type=float, default=0.3, help="Fraction of devices with rotating MACs.")
+    parser.add_argument("--mac-rotation", type=float, default=900, help="Seconds between MAC rotations.")
+    parser.add_argument("--advert-interval", type=float, default=1.0, help="Seconds between adverts of one device.")
+    parser.add_argument("--models", type=int, default=20, help="Distinct GATT layouts.")
+    parser.add_argument("--services", type=int, default=4)
+    parser.add_argument("--characteristics", type=int, default=6, help="Characteristics per service.")
+    parser.add_argument("--connect-latency", type=float, default=1.0)
+    parser.add_argument("--connect-failure", type=float, default=0.2)
+    parser.add_argument("--read-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--replay",
+                        help="Replay a JSON-lines advert capture, a .pblc capture file or a capture directory.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed factor.")
+    parser.add_argument("--loop", action="store_true", help="Restart the replay when it ends.")
+    parser.add_argument("--record", help="Record real adverts from --adapter into this file and exit.")
+    parser.add_argument("--adapter", default="hci0", help="Adapter used by --record.")
+    parser.add_argument("--micro", type=int, metavar="N",
+                        help="Measure the per-advert CPU cost of the ingestion path on N adverts and exit.")
+    parser.add_argument("--batch", type=int, default=100, help="Adverts per ingestion batch for --micro.")
+    parser.add_argument("--capture", metavar="DIR", help="Also write binary advert captures to DIR.")
+    parser.add_argument("--output", choices=["verbose", "summary", "dashboard"], default="verbose",
+                        help="Console mode of the scanner (its output is discarded unless --verbose).")
+    parser.add_argument("--sample-interval", type=float, default=5)
+    parser.add_argument("--workdir", help="Directory for the benchmark database and log.")
+    parser.add_argument("--json", help="Also write the summary (with samples) to this file.")
+    parser.add_argument("--verbose", action="store_true", help="Show scanner output and progress.")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        count = asyncio.run(simulator.record_adverts(args.record, args.adapter, args.duration))
+        print(f"Recorded {count} adverts to {args.record}")
+        return
+
+    config = simulator.SimulationConfig(
+        devices=args.devices, churn_per_minute=args.churn, random_mac_fraction=args.random_mac,
+        mac_rotation=args.mac_rotation, advert_interval=args.advert_interval, models=args.models,
+        services=args.services, characteristics=args.characteristics,
+        connect_latency=args.connect_latency, connect_failure_rate=args.connect_failure,
+        read_latency=args.read_latency, seed=args.seed,
+    )
+    if args.replay and (os.path.isdir(args.replay) or args.replay.endswith(".pblc")):
+        world = simulator.CaptureReplayWorld(args.replay, speed=args.speed, loop=args.loop, config=config)
+    elif args.replay:
+        world = simulator.ReplayWorld(args.replay, speed=args.speed, loop=args.loop, config=config)
+    else:
+        world = simulator.SimulatedWorld(config)
+
+    if args.micro:
+        summary = micro_benchmark(world, adverts=args.micro, batch_size=args.batch, workdir=args.workdir)
+        _print_micro(summary)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+        return
+
+    summary = run_benchmark(
+        world, duration=args.duration,
+        adapters=[f"sim{i}" for i in range(max(args.adapters, 1))],
+        scan_mode=args.scan_mode, max_connect=args.max_connect,
+        sample_interval=args.sample_interval, workdir=args.workdir, verbose=args.verbose,
+        capture_dir=args.capture, output=args.output,
+    )
+    _print_summary(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
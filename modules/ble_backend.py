@@ -0,0 +1,26 @@
+# modules/ble_backend.py
+
+# Scanner/client classes used by bluetooth_scanner and device_connector.
+# Defaults to bleak; the simulator (modules/simulator.py) swaps in its own
+# classes so the whole pipeline can run without Bluetooth hardware.
+
+_scanner_class = None
+_client_class = None
+
+def get_scanner_class():
+    if _scanner_class is None:
+        from bleak import BleakScanner
+        return BleakScanner
+    return _scanner_class
+
+def get_client_class():
+    if _client_class is None:
+        from bleak import BleakClient
+        return BleakClient
+    return _client_class
+
+def set_backend(scanner_class=None, client_class=None):
+    """Install replacement classes; None restores the bleak default."""
+    global _scanner_class, _client_class
+    _scanner_class = scanner_class
+    _client_class = client_class
@@ -4,20 +4,20 @@ import asyncio
 import subprocess
 import logging
 import time
-from datetime import datetime
 from termcolor import colored
-from bleak import BleakScanner, BleakError
-from bleak.backends.device import BLEDevice
-from bleak.backends.scanner import AdvertisementData
-
-from .database import (
-    save_device_to_db,
-    device_exists,
-    get_database_statistics,
-)
-from .utils import is_mac_address
+from bleak.exc import BleakError
+
+from .database import get_database_statistics
+from .runtime import get_runtime
+from .utils import display_name
 from . import utils
-from .device_connector import connect_to_device
+from .connection_scheduler import ConnectionScheduler
+from .ble_backend import get_scanner_class
+from .capture import get_capture
+from .console import get_console
+from .retention import get_retention
+from .identity import address_type
+from . import metrics
 
 def get_bluetooth_interfaces():
     """Return a list of available Bluetooth interfaces (hciN) with bus info."""
@@ -44,109 +44,339 @@ def get_bluetooth_interfaces():
         logging.error(f"Failed to get Bluetooth interfaces: {e}")
         return []
 
-async def start_continuous_scan_and_connect(adapter):
+class ScanStats:
+    """Advert rate and the fraction of wall time the adapter spent scanning."""
+
+    def __init__(self):
+        self.adverts = 0
+        self.dropped = 0
+        self._window_start = time.monotonic()
+        self._scanning_time = 0.0
+        self._scan_started = None
+        # Result of the last take(), for readers that must not reset the window
+        self.last = (0.0, 0.0, 0)
+
+    @property
+    def scanning(self):
+        return self._scan_started is not None
+
+    def scan_started(self):
+        if self._scan_started is None:
+            self._scan_started = time.monotonic()
+
+    def scan_stopped(self):
+        if self._scan_started is not None:
+            self._scanning_time += time.monotonic() - self._scan_started
+            self._scan_started = None
+
+    def take(self):
+        """Return (adverts/sec, scanning fraction, dropped) and start a new window."""
+        now = time.monotonic()
+        scanning = self._scanning_time
+        if self._scan_started is not None:
+            scanning += now - self._scan_started
+            self._scan_started = now
+        elapsed = max(now - self._window_start, 1e-6)
+        result = (self.adverts / elapsed, min(scanning / elapsed, 1.0), self.dropped)
+        self.adverts = 0
+        self.dropped = 0
+        self._scanning_time = 0.0
+        self._window_start = now
+        self.last = result
+        return result
+
+async def _print_statistics(scan_stats, scheduler):
+    # Counters cached by the DB writer, no query on the event loop
+    total_devices, named_devices, devices_with_service = get_database_statistics()
+    lines = [
+        f"{colored('[INFO]', 'blue')} Total: {total_devices} | "
+        f"Named: {named_devices} | With Service Info: {colored(devices_with_service, 'yellow')}"
+    ]
+
+    for adapter, stats in scan_stats.items():
+        adverts_per_sec, duty_cycle, dropped = stats.take()
+        lines.append(
+            f"{colored('[INFO]', 'blue')} {adapter} scan: Adverts/sec: {adverts_per_sec:.1f} | "
+            f"Scanning: {duty_cycle * 100:.0f}% of the time"
+            + (f" | Dropped: {dropped}" if dropped else "")
+        )
+        logging.info(
+            f"{adapter} scan: adverts/sec: {adverts_per_sec:.1f}, "
+            f"scanning duty cycle: {duty_cycle:.2f}, dropped: {dropped}"
+        )
+
+    queue_depth, connects_per_sec, success_rate, per_adapter = scheduler.take_stats()
+    scheduler.prune()
+    lines.append(
+        f"{colored('[INFO]', 'blue')} Connect queue: {queue_depth} | "
+        f"Connects/sec: {connects_per_sec:.2f} | Success rate: {success_rate * 100:.0f}%"
+    )
+    logging.info(
+        f"Connect queue: {queue_depth}, connects/sec: {connects_per_sec:.2f}, success rate: {success_rate:.2f}"
+    )
+    if len(per_adapter) > 1:
+        for adapter, (rate, adapter_success) in per_adapter.items():
+            lines.append(
+                f"{colored('[INFO]', 'blue')} {adapter} connect: "
+                f"Connects/sec: {rate:.2f} | Success rate: {adapter_success * 100:.0f}%"
+            )
+            logging.info(f"{adapter} connect: connects/sec: {rate:.2f}, success rate: {adapter_success:.2f}")
+    get_console().status(lines)
+
+def log_sighting(sighting_log, record, timestamp, rssi, adapter):
+    # Coordinates are interpolated when the log is flushed, by which time
+    # the fixes after 'timestamp' have usually arrived as well
+    if timestamp - record.logged_at >= utils.SIGHTING_INTERVAL:
+        record.logged_at = timestamp
+        sighting_log.append(record.mac, timestamp, rssi, None, None, adapter)
+
+def _capture_advert(capture, timestamp, adapter, device, advertisement_data):
+    capture.append(
+        timestamp, adapter, device.address, advertisement_data.rssi,
+        advertisement_data.local_name or device.name, advertisement_data.manufacturer_data,
+        advertisement_data.service_uuids, advertisement_data.service_data, advertisement_data.tx_power
+    )
+
+async def _housekeeping(state, scan_stats, scheduler):
+    """Periodic write-behind flush, rollups and statistics for all adapters."""
+    capture = get_capture()
+    while True:
+        await asyncio.sleep(5)
+        if capture is not None:
+            capture.flush()
+        if state.registry.flush_due():
+            state.flush()
+        if state.sightings.rollup_due():
+            state.sightings.rollup()
+        await _print_statistics(scan_stats, scheduler)
+
+async def start_continuous_scan_and_connect(adapters, connect_adapters=None, state=None):
     """
-    Continuously scan for BLE devices using the single 'adapter',
-    then attempt to connect to each discovered device (limited by a semaphore).
+    Continuously scan for BLE devices on 'adapters' (one name or a list)
+    and connect to discovered devices using 'connect_adapters' (defaults
+    to the scan adapters). 'state' (a RuntimeState, default: the process'
+    default one) holds the settings, registry and sighting log; its
+    scan_mode selects between discover/connect cycles ("cycle"),
+    continuous callback-based scanning ("stream") and scanner/connector
+    child processes ("sharded", see modules/sharded.py). Connections are
+    made by a ConnectionScheduler worker pool that runs independently of
+    the scan cadence and balances load across adapters.
     """
-    # Create a semaphore based on user’s chosen concurrency limit
-    semaphore = asyncio.Semaphore(utils.max_connect)
+    if isinstance(adapters, str):
+        adapters = [adapters]
+    connect_adapters = list(connect_adapters or adapters)
+
+    state = state or get_runtime()
+    scan_stats = {adapter: ScanStats() for adapter in adapters}
+    scan_mode = state.settings.scan_mode
+    if scan_mode == "sharded":
+        from .sharded import ShardedPipeline
+        # Connector processes take the scheduler's place
+        scheduler = ShardedPipeline(adapters, connect_adapters, state, scan_stats)
+    else:
+        scheduler = ConnectionScheduler(connect_adapters, state=state)
+        scheduler.load_interrogated()
+    scheduler.start()
+    state.scheduler = scheduler
+    state.scan_stats = scan_stats
+    state.started_at = time.time()
+    housekeeping = asyncio.create_task(_housekeeping(state, scan_stats, scheduler))
+    dashboard = asyncio.create_task(get_console().run_dashboard())
+    # One retention task per process, whichever pipeline starts first
+    retention = get_retention(state.sightings).start()
+    metrics.track_queue(_queue_name("sightings", state), state.sightings.__len__)
+    metrics_tasks = metrics.start_metrics_tasks()
+    try:
+        if scan_mode == "sharded":
+            await scheduler.run()
+        elif scan_mode == "stream":
+            await _scan_stream(adapters, scheduler, state, scan_stats)
+        else:
+            await asyncio.gather(*(
+                _scan_cycles(adapter, scheduler, state, scan_stats[adapter])
+                for adapter in adapters
+            ))
+    finally:
+        housekeeping.cancel()
+        dashboard.cancel()
+        if retention is not None:
+            retention.cancel()
+        for task in metrics_tasks:
+            task.cancel()
+        scheduler.stop()
+        state.started_at = None
 
-    # For logging and stats
-    detection_counts = {}
-    last_info_time = time.time()
+def _queue_name(queue, state):
+    """Metric label of a per-pipeline queue; the default pipeline keeps the bare name."""
+    return queue if state.name == "default" else f"{queue}:{state.name}"
 
+async def _scan_cycles(adapter, scheduler, state, stats):
+    """
+    Scan for SCAN_DURATION seconds on 'adapter', hand discovered devices to the
+    connection scheduler, then wait and repeat.
+    """
+    console = get_console()
+    scan_duration = metrics.SCAN_DURATION.labels(adapter)
+    scan_devices = metrics.SCAN_ADVERTS.labels(adapter)
+    adverts_metric = metrics.ADVERTS.labels(adapter)
     while True:
-        print(f"{colored('[INFO]', 'blue')} Scanning on {adapter}...")
+        if console.per_device:
+            console.event(f"{colored('[INFO]', 'blue')} Scanning on {adapter}...")
         logging.info(f"Scanning for devices on {adapter}...")
         
         try:
-            scanner = BleakScanner(adapter=adapter)
-            devices = await scanner.discover(timeout=3.0)
+            stats.scan_started()
+            started = time.perf_counter()
+            # A classmethod building its own scanner: the adapter goes in its kwargs.
+            # return_adv=True: address -> (BLEDevice, AdvertisementData)
+            devices = await get_scanner_class().discover(timeout=utils.SCAN_DURATION, return_adv=True,
+                                                         adapter=adapter)
+            scan_duration.observe(time.perf_counter() - started)
+            stats.scan_stopped()
+            stats.adverts += len(devices)
+            scan_devices.observe(len(devices))
+            adverts_metric.inc(len(devices))
         except BleakError as e:
+            stats.scan_stopped()
             logging.error(f"Failed to scan on adapter {adapter}: {e}")
-            print(f"{colored('[ERROR]', 'red')} Failed to scan on {adapter}. Is the adapter powered on?")
+            console.line(f"{colored('[ERROR]', 'red')} Failed to scan on {adapter}. Is the adapter powered on?")
             await asyncio.sleep(3)
             continue
 
         if not devices:
-            print("No devices found.")
+            console.event("No devices found.")
             logging.info("No devices found.")
             await asyncio.sleep(3)
             continue
 
-        # For each discovered device, update or insert into 'devices' table and connect
-        tasks = []
-        for device in devices:
-            mac_address = device.address
-            device_name = device.name if device.name and not is_mac_address(device.name) else "Unknown"
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            rssi = device.rssi if device.rssi is not None else -100
-            rssi_display = colored(f"{rssi}", "magenta", attrs=["bold"])
-
-            # GPS data if available
-            if utils.use_gps and utils.is_gps_data_fresh():
-                gps_data = f"{utils.latest_gps_coords['latitude']}, {utils.latest_gps_coords['longitude']}"
-            else:
-                gps_data = None
-
-            # Save device (name, mac, etc.) to the main 'devices' table
-            if device_exists(mac_address):
-                print(f"{colored('[UPDATED]', 'yellow')} {device_name} (Interface: {adapter}) RSSI: {rssi_display}")
-                save_device_to_db(
-                    device_name,
-                    mac_address,
-                    rssi,
-                    timestamp,
-                    adapter,
-                    manufacturer_data=None,
-                    service_uuids=None,
-                    service_data=None,
-                    tx_power=None,
-                    platform_data=None,
-                    gps_data=gps_data,
-                    service_list=None,
-                    update_existing=True
-                )
-            else:
-                print(f"{colored('[NEW]', 'green')} {device_name} (Interface: {adapter}) RSSI: {rssi_display}")
-                save_device_to_db(
-                    device_name,
-                    mac_address,
-                    rssi,
-                    timestamp,
-                    adapter,
-                    manufacturer_data=None,
-                    service_uuids=None,
-                    service_data=None,
-                    tx_power=None,
-                    platform_data=None,
-                    gps_data=gps_data,
-                    service_list=None
-                )
-
-            # For stats
-            detection_counts[mac_address] = detection_counts.get(mac_address, 0) + 1
-            detection_count = detection_counts[mac_address]
-            print(f"{colored('[INFO]', 'blue')} Device {device_name} seen {detection_count} times.")
-
-            # Always connect in this “scan+connect” mode
-            tasks.append(connect_to_device(device, adapter, semaphore))
-
-        # Show DB stats every ~5 seconds
-        if time.time() - last_info_time >= 5:
-            last_info_time = time.time()
-            total_devices, named_devices, devices_with_service = get_database_statistics()
-            print(
-                f"{colored('[INFO]', 'blue')} Total: {total_devices} | "
-                f"Named: {named_devices} | With Service Info: {colored(devices_with_service, 'yellow')}"
-            )
+        capture = get_capture()
+        if capture is not None:
+            now = time.time()
+            for device, advertisement_data in devices.values():
+                _capture_advert(capture, now, adapter, device, advertisement_data)
 
-        # Connect to all discovered devices with concurrency control
-        if tasks:
-            await asyncio.gather(*tasks)
+        # Update the registry and queue connections for all discovered devices
+        await state.registry.load_missing(devices)
+        ingest_batch(
+            state, scheduler,
+            [(device, advertisement_data, adapter) for device, advertisement_data in devices.values()],
+            updates=True,
+        )
 
-        print("\n[INFO] Waiting before next scan...\n")
+        console.event("\n[INFO] Waiting before next scan...\n")
         logging.info("Restarting scan...")
-        await asyncio.sleep(3)
+        await asyncio.sleep(utils.SCAN_INTERVAL)
+
+async def _scan_stream(adapters, scheduler, state, scan_stats):
+    """
+    Keep every adapter in 'adapters' scanning all the time. The detection
+    callbacks only push (BLEDevice, AdvertisementData, adapter) into one
+    shared queue; a persistence stage merges the sightings, updates the
+    registry and offers devices to the connection scheduler.
+    """
+    adverts = asyncio.Queue(maxsize=utils.ADVERT_QUEUE_SIZE)
+    metrics.track_queue(_queue_name("adverts", state), adverts.qsize)
+    scanners = [_stream_adapter(adapter, adverts, scan_stats[adapter]) for adapter in adapters]
+    persist = asyncio.create_task(_persist_stage(adverts, scheduler, state))
+    try:
+        await asyncio.gather(*scanners)
+    finally:
+        persist.cancel()
+
+async def _stream_adapter(adapter, adverts, stats):
+    capture = get_capture()
+    adverts_metric = metrics.ADVERTS.labels(adapter)
+    dropped_metric = metrics.ADVERTS_DROPPED.labels(adapter)
+
+    def on_advert(device, advertisement_data):
+        stats.adverts += 1
+        adverts_metric.inc()
+        if capture is not None:
+            _capture_advert(capture, time.time(), adapter, device, advertisement_data)
+        try:
+            adverts.put_nowait((device, advertisement_data, adapter))
+        except asyncio.QueueFull:
+            stats.dropped += 1
+            dropped_metric.inc()
+
+    scanner = get_scanner_class()(detection_callback=on_advert, adapter=adapter)
+    console = get_console()
+    try:
+        while True:
+            console.line(f"{colored('[INFO]', 'blue')} Streaming scan on {adapter}...")
+            logging.info(f"Starting streaming scan on {adapter}...")
+            try:
+                await scanner.start()
+                stats.scan_started()
+                break
+            except BleakError as e:
+                logging.error(f"Failed to scan on adapter {adapter}: {e}")
+                console.line(f"{colored('[ERROR]', 'red')} Failed to scan on {adapter}. Is the adapter powered on?")
+                await asyncio.sleep(3)
+
+        # Scanning runs in the background until we are cancelled
+        await asyncio.Event().wait()
+    finally:
+        try:
+            await scanner.stop()
+        except BleakError as e:
+            logging.error(f"Failed to stop scanner on {adapter}: {e}")
+        stats.scan_stopped()
+
+async def _persist_stage(adverts, scheduler, state):
+    """
+    Drain the advert queue in batches and update the registry. A MAC heard
+    by several adapters within one batch is merged into a single update
+    (strongest RSSI wins).
+    """
+    while True:
+        batch = [await adverts.get()]
+        while not adverts.empty():
+            batch.append(adverts.get_nowait())
+        metrics.PERSIST_BATCH.observe(len(batch))
+        await state.registry.load_missing({event[0].address for event in batch})
+        ingest_batch(state, scheduler, batch)
+
+def ingest_batch(state, scheduler, events, updates=False):
+    """
+    Registry, identities, sightings, console and connect offers for a
+    batch of (BLEDevice, AdvertisementData, adapter). A MAC heard several
+    times in the batch is merged into one update (strongest RSSI wins).
+    'updates' also reports known devices on the verbose console. Callers
+    await registry.load_missing() first, or stored devices not in memory
+    are reported as new.
+    """
+    console = get_console()
+    registry = state.registry
+    sighting_log = state.sightings
+    identities = state.identities
+
+    merged = {}
+    for event in events:
+        mac_address = event[0].address
+        previous = merged.get(mac_address)
+        if previous is None or (event[1].rssi or -100) >= (previous[1].rssi or -100):
+            merged[mac_address] = event
+
+    timestamp = int(time.time())
+    gps_data = state.current_fix(timestamp)
+
+    for mac_address, (device, advertisement_data, adapter) in merged.items():
+        device_name = display_name(advertisement_data.local_name or device.name)
+        rssi = advertisement_data.rssi if advertisement_data.rssi is not None else -100
+
+        record, is_new = registry.observe(
+            mac_address, device_name, rssi, timestamp, adapter, gps_data, advertisement_data
+        )
+        logical_device, new_identity = identities.observe(
+            mac_address, rssi, timestamp, advertisement_data, address_type(device)
+        )
+        log_sighting(sighting_log, record, timestamp, rssi, adapter)
+        console.seen(mac_address, device_name, adapter, rssi, record.count, timestamp, is_new, updates)
+        if is_new:
+            state.device_added(mac_address, record, adapter, logical_device, new_identity)
+
+        # The scheduler decides whether and when to connect; a rotated
+        # MAC of a known device is not new
+        scheduler.offer(device, rssi, is_new and new_identity)
+    return len(merged)
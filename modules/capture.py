@@ -0,0 +1,371 @@
+# modules/capture.py
+
+"""
+Raw advertisement capture: every received advert is appended to a binary
+file as a fixed-layout record, and the files rotate at CAPTURE_ROTATE_BYTES.
+
+File (*.pblc):  header <magic "PBLECAP1"><version: u16><created: i64 us>
+                then records <payload length: u16><kind: u8><timestamp: i64 us>
+                <adapter id: u8><mac: 6 bytes><rssi: i8><payload>
+Advert payload: <name length: u8><mfr length: u16><uuids length: u16>
+                <service data length: u16><tx power: i8, 127 = none>
+                <name utf-8><mfr><uuids><service data> (adv_codec encodings)
+Adapter record: payload is the adapter name; each file starts with the
+                definitions it needs so files can be read on their own.
+Index (*.pblx): <timestamp: i64 us><offset: u64> every CAPTURE_INDEX_EVERY
+                records, so a reader can seek by time without a full scan.
+
+All integers are little-endian.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+
+from . import utils
+from .adv_codec import (
+    encode_manufacturer_data,
+    decode_manufacturer_data,
+    encode_service_uuids,
+    decode_service_uuids,
+    encode_service_data,
+    decode_service_data,
+)
+
+MAGIC = b"PBLECAP1"
+VERSION = 1
+FILE_SUFFIX = ".pblc"
+INDEX_SUFFIX = ".pblx"
+
+KIND_ADVERT = 0
+KIND_ADAPTER = 1
+
+_HEADER = struct.Struct("<8sHq")
+_RECORD = struct.Struct("<HBqB6sb")
+_PAYLOAD = struct.Struct("<BHHHb")
+_INDEX = struct.Struct("<qQ")
+_NO_TX_POWER = 127
+
+_capture = None
+
+# Decoded advert with the AdvertisementData field names used by the registry
+CapturedAdvert = namedtuple(
+    "CapturedAdvert",
+    "timestamp adapter mac rssi local_name manufacturer_data service_data service_uuids tx_power"
+)
+
+def encode_advert(name, manufacturer_data, service_uuids, service_data, tx_power):
+    name = (name or "").encode("utf-8", "replace")[:255]
+    mfr = encode_manufacturer_data(manufacturer_data) or b""
+    uuids = encode_service_uuids(service_uuids) or b""
+    sdata = encode_service_data(service_data) or b""
+    if tx_power is None or not -128 <= tx_power < _NO_TX_POWER:
+        tx_power = _NO_TX_POWER
+    return b"".join((_PAYLOAD.pack(len(name), len(mfr), len(uuids), len(sdata), tx_power), name, mfr, uuids, sdata))
+
+class CaptureWriter:
+    """
+    Append-only writer for one capture directory. append() only packs the
+    record into a memory buffer; flush() writes it out (called from the
+    housekeeping task), rotating to a new file when the current one is full.
+    """
+
+    def __init__(self, directory=None, max_bytes=None, index_every=None):
+        self.directory = directory or utils.CAPTURE_DIR
+        self.max_bytes = max_bytes or utils.CAPTURE_ROTATE_BYTES
+        self.index_every = index_every or utils.CAPTURE_INDEX_EVERY
+        os.makedirs(self.directory, exist_ok=True)
+        self._adapter_ids = {}
+        self._buffer = bytearray()
+        self._index = bytearray()
+        self._file = None
+        self._index_file = None
+        self._offset = 0
+        self._records = 0
+        self.records_written = 0
+        self._open()
+
+    def _open(self):
+        stamp = time.strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(self.directory, f"capture_{stamp}")
+        n = 0
+        while os.path.exists(base + (f"_{n}" if n else "") + FILE_SUFFIX):
+            n += 1
+        base += f"_{n}" if n else ""
+        self.path = base + FILE_SUFFIX
+        self._file = open(self.path, "ab")
+        self._index_file = open(base + INDEX_SUFFIX, "ab")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, int(time.time() * 1_000_000)))
+        self._file.flush()
+        self._offset = _HEADER.size
+        self._records = 0
+        for adapter, adapter_id in self._adapter_ids.items():
+            self._define_adapter(adapter, adapter_id)
+        logging.info(f"Capturing adverts to {self.path}")
+
+    def _define_adapter(self, adapter, adapter_id):
+        name = adapter.encode("utf-8")[:255]
+        self._put(_RECORD.pack(len(name), KIND_ADAPTER, 0, adapter_id, b"\0" * 6, 0) + name, 0)
+
+    def _put(self, record, timestamp_us):
+        if self._records % self.index_every == 0:
+            self._index += _INDEX.pack(timestamp_us, self._offset + len(self._buffer))
+        self._buffer += record
+        self._records += 1
+
+    def append(self, timestamp, adapter, mac, rssi, name, manufacturer_data,
+               service_uuids, service_data, tx_power):
+        """Buffer one advert; 'timestamp' is epoch seconds (float), 'mac' 'AA:BB:..'."""
+        adapter_id = self._adapter_ids.get(adapter)
+        if adapter_id is None:
+            adapter_id = len(self._adapter_ids) + 1
+            self._adapter_ids[adapter] = adapter_id
+            self._define_adapter(adapter, adapter_id)
+        payload = encode_advert(name, manufacturer_data, service_uuids, service_data, tx_power)
+        timestamp_us = int(timestamp * 1_000_000)
+        self._put(
+            _RECORD.pack(
+                len(payload), KIND_ADVERT, timestamp_us, adapter_id,
+                bytes.fromhex(mac.replace(":", "").replace("-", "")),
+                max(-128, min(127, rssi if rssi is not None else -128))
+            ) + payload,
+            timestamp_us
+        )
+        self.records_written += 1
+
+    def flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._offset += len(self._buffer)
+            self._buffer = bytearray()
+            self._file.flush()
+        if self._index:
+            self._index_file.write(self._index)
+            self._index = bytearray()
+            self._index_file.flush()
+        if self._offset >= self.max_bytes:
+            self._close_files()
+            self._open()
+
+    def _close_files(self):
+        self._file.close()
+        self._index_file.close()
+
+    def close(self):
+        self.flush()
+        self._close_files()
+
+class CaptureReader:
+    """
+    Memory-mapped reader for one capture file. Records are decoded with
+    struct.unpack_from straight from the mapping, no text parsing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.created = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} capture file")
+        self._index_times = []
+        self._index_offsets = []
+        index_path = path[:-len(FILE_SUFFIX)] + INDEX_SUFFIX if path.endswith(FILE_SUFFIX) else None
+        if index_path and os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+            for timestamp_us, offset in _INDEX.iter_unpack(data[:len(data) - len(data) % _INDEX.size]):
+                if timestamp_us:
+                    self._index_times.append(timestamp_us)
+                    self._index_offsets.append(offset)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _adapters(self, end):
+        """Adapter definitions found before 'end' (they are written first)."""
+        adapters = {}
+        for kind, _, adapter_id, _, _, start, size in self._iter_raw(_HEADER.size, end):
+            if kind == KIND_ADAPTER:
+                adapters[adapter_id] = bytes(self._map[start:start + size]).decode("utf-8", "replace")
+        return adapters
+
+    def _iter_raw(self, offset, end=None):
+        buf = self._map
+        end = len(buf) if end is None else end
+        unpack = _RECORD.unpack_from
+        size = _RECORD.size
+        while offset + size <= end:
+            length, kind, timestamp_us, adapter_id, mac, rssi = unpack(buf, offset)
+            start = offset + size
+            if start + length > len(buf):
+                # Truncated tail of a file that was still being written
+                return
+            yield kind, timestamp_us, adapter_id, mac, rssi, start, length
+            offset = start + length
+
+    def _offset_for(self, since):
+        """File offset of an index point at or before 'since' (epoch seconds)."""
+        if since is None or not self._index_times:
+            return _HEADER.size
+        i = bisect.bisect_right(self._index_times, int(since * 1_000_000)) - 1
+        return self._index_offsets[i] if i >= 0 else _HEADER.size
+
+    def records(self, since=None, decode=True):
+        """
+        Yield CapturedAdvert tuples (timestamp in float seconds). With
+        decode=False the payload fields are left as None, which is enough for
+        counting or RSSI-only passes and much faster.
+        """
+        offset = self._offset_for(since)
+        adapters = self._adapters(offset) if offset > _HEADER.size else {}
+        since_us = int(since * 1_000_000) if since is not None else None
+        buf = self._map
+        for kind, timestamp_us, adapter_id, mac, rssi, start, length in self._iter_raw(offset):
+            if kind == KIND_ADAPTER:
+                adapters[adapter_id] = bytes(buf[start:start + length]).decode("utf-8", "replace")
+                continue
+            if since_us is not None and timestamp_us < since_us:
+                continue
+            mac_text = mac.hex(":").upper()
+            if not decode:
+                yield CapturedAdvert(timestamp_us / 1_000_000, adapters.get(adapter_id), mac_text, rssi,
+                                     None, None, None, None, None)
+                continue
+            name_len, mfr_len, uuids_len, sdata_len, tx_power = _PAYLOAD.unpack_from(buf, start)
+            pos = start + _PAYLOAD.size
+            name = bytes(buf[pos:pos + name_len]).decode("utf-8", "replace") or None
+            pos += name_len
+            manufacturer_data = decode_manufacturer_data(buf[pos:pos + mfr_len])
+            pos += mfr_len
+            service_uuids = decode_service_uuids(buf[pos:pos + uuids_len])
+            pos += uuids_len
+            service_data = decode_service_data(buf[pos:pos + sdata_len])
+            yield CapturedAdvert(
+                timestamp_us / 1_000_000, adapters.get(adapter_id), mac_text, rssi, name,
+                manufacturer_data, service_data, service_uuids,
+                None if tx_power == _NO_TX_POWER else tx_power
+            )
+
+def capture_files(paths):
+    """Expand files/directories into capture files in chronological order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(FILE_SUFFIX)
+            )
+        else:
+            files.append(path)
+    return sorted(files)
+
+def iter_captures(paths, since=None, decode=True):
+    for path in capture_files(paths):
+        with CaptureReader(path) as reader:
+            yield from reader.records(since, decode)
+
+def reprocess(paths, since=None, flush_every=50000, sightings=True):
+    """
+    Bulk-load captured adverts into the database through the device
+    registry (and the sightings log), bypassing scanning entirely.
+    Returns the number of adverts processed.
+    """
+    from .database import get_writer
+    from .device_registry import DeviceRegistry
+    from .sightings import get_sighting_log
+    from .utils import display_name
+
+    # Captures are old by definition: keep the TTL from expiring everything
+    registry = DeviceRegistry(ttl=10 * 365 * 24 * 3600)
+    sighting_log = get_sighting_log() if sightings else None
+    writer = get_writer()
+    count = 0
+    for advert in iter_captures(paths, since):
+        name = display_name(advert.local_name)
+        timestamp = int(advert.timestamp)
+        rssi = advert.rssi if advert.rssi is not None else -100
+        record, _ = registry.observe(advert.mac, name, rssi, timestamp, advert.adapter, None, advert)
+        if sighting_log is not None and timestamp - record.logged_at >= utils.SIGHTING_INTERVAL:
+            record.logged_at = timestamp
+            sighting_log.append(record.mac, timestamp, rssi, None, None, advert.adapter)
+        count += 1
+        if count % flush_every == 0:
+            registry.flush()
+            if sighting_log is not None:
+                sighting_log.flush()
+            # Keep the writer queue bounded
+            writer.flush()
+            logging.info(f"Reprocessed {count} adverts")
+    registry.flush()
+    if sighting_log is not None:
+        sighting_log.flush()
+        sighting_log.rollup()
+    writer.flush()
+    return count
+
+def get_capture():
+    """Shared capture writer, or None when utils.CAPTURE_DIR is not set."""
+    global _capture
+    if _capture is None and utils.CAPTURE_DIR:
+        _capture = CaptureWriter()
+    return _capture
+
+def close_capture():
+    global _capture
+    if _capture is not None:
+        _capture.close()
+        _capture = None
+
+def main(argv=None):
+    import argparse
+    from .database import initialize_database, close_database
+
+    parser = argparse.ArgumentParser(description="Inspect or reprocess advert capture files.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    info = sub.add_parser("info", help="Print record counts and time span.")
+    info.add_argument("paths", nargs="+", help="Capture files or directories.")
+    load = sub.add_parser("reprocess", help="Load captures into the database.")
+    load.add_argument("paths", nargs="+", help="Capture files or directories.")
+    load.add_argument("--db", help=f"Database file (default: {utils.DB_PATH}).")
+    load.add_argument("--since", type=float, help="Skip adverts before this epoch time.")
+    load.add_argument("--no-sightings", action="store_true", help="Only update the devices table.")
+    args = parser.parse_args(argv)
+
+    if args.command == "info":
+        for path in capture_files(args.paths):
+            with CaptureReader(path) as reader:
+                count, first, last, macs = 0, None, None, set()
+                for advert in reader.records(decode=False):
+                    count += 1
+                    first = advert.timestamp if first is None else first
+                    last = advert.timestamp
+                    macs.add(advert.mac)
+            span = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first))} .. " \
+                   f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last))}" if count else "empty"
+            print(f"{path}: {count} adverts, {len(macs)} devices, {span}")
+        return
+
+    if args.db:
+        utils.DB_PATH = args.db
+    initialize_database()
+    started = time.monotonic()
+    try:
+        count = reprocess(args.paths, args.since, sightings=not args.no_sightings)
+    finally:
+        close_database(timeout=600)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"Reprocessed {count} adverts in {elapsed:.1f} s ({count / elapsed:.0f} adverts/sec)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# modules/config.py
+
+"""
+Settings file for unattended runs (e.g. under systemd), INI format:
+
+    [pible]
+    adapters = hci0,hci1
+    max-connect = 4
+    scan-mode = stream
+    db = /var/lib/pible/bluetooth_devices.db
+    use-gps = y
+    gps-source = gpsd
+
+    [tuning]
+    REGISTRY_FLUSH_INTERVAL = 30
+    GATT_DEVICE_TIMEOUT = 15
+
+Keys of [pible] are main.py's long options without the leading dashes;
+options given on the command line win. [tuning] overrides constants of
+modules/utils.py by name, converted to the type of the current value.
+"""
+
+import configparser
+
+from . import utils
+
+def read_config(path):
+    parser = configparser.ConfigParser(interpolation=None)
+    # [tuning] keys are case-sensitive utils names
+    parser.optionxform = str
+    with open(path, encoding="utf-8") as f:
+        parser.read_file(f)
+    return parser
+
+def apply_defaults(argparser, config):
+    """
+    Make the [pible] values the defaults of 'argparser'. Raises ValueError
+    for unknown keys and invalid values.
+    """
+    if not config.has_section("pible"):
+        return
+    actions = {action.dest: action for action in argparser._actions}
+    defaults = {}
+    for key, raw in config.items("pible"):
+        dest = key.strip().lower().replace("-", "_")
+        action = actions.get(dest)
+        if action is None or not action.option_strings or dest in ("help", "config"):
+            raise ValueError(f"unknown setting '{key}'")
+        try:
+            if action.nargs == 0:
+                # store_true flags
+                value = config.getboolean("pible", key)
+            else:
+                value = action.type(raw) if action.type else raw
+        except ValueError:
+            raise ValueError(f"{key}: invalid value '{raw}'")
+        if action.choices is not None and value not in action.choices:
+            raise ValueError(f"{key}: '{raw}' is not one of {', '.join(map(str, action.choices))}")
+        defaults[dest] = value
+    argparser.set_defaults(**defaults)
+
+# Type of the constants whose default is None (off); the others take the
+# type of their current value
+_OPTIONAL_TYPES = {
+    "SHARD_CONNECTORS": int,
+    "RETENTION_DEVICES_DAYS": float,
+    "RETENTION_MAX_DB_MB": float,
+    "METRICS_DUMP_PATH": str,
+    "CAPTURE_DIR": str,
+}
+
+def _convert(name, current, raw):
+    if isinstance(current, bool):
+        value = raw.strip().lower()
+        if value not in configparser.ConfigParser.BOOLEAN_STATES:
+            raise ValueError(f"{name}: '{raw}' is not a boolean")
+        return configparser.ConfigParser.BOOLEAN_STATES[value]
+    optional = current is None or name in _OPTIONAL_TYPES
+    if (optional or isinstance(current, str)) and raw.strip().lower() == "none":
+        return None
+    if optional:
+        kind = _OPTIONAL_TYPES.get(name, str)
+        try:
+            return kind(raw)
+        except ValueError:
+            raise ValueError(f"{name}: '{raw}' is not a valid {kind.__name__}")
+    if isinstance(current, str):
+        return raw
+    if isinstance(current, int):
+        # "1800" stays an int, "0.5" becomes a float
+        try:
+            return int(raw)
+        except ValueError:
+            return float(raw)
+    return type(current)(raw)
+
+def apply_tuning(config):
+    """Override utils constants with the [tuning] section."""
+    if not config.has_section("tuning"):
+        return
+    for name, raw in config.items("tuning"):
+        if not name.isupper() or not hasattr(utils, name):
+            raise ValueError(f"unknown tuning constant '{name}'")
+        setattr(utils, name, _convert(name, getattr(utils, name), raw))
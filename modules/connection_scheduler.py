@@ -0,0 +1,214 @@
+# modules/connection_scheduler.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from . import utils
+from . import metrics
+from .database import load_interrogated_devices
+from .device_connector import connect_to_device
+
+class ConnectionScheduler:
+    """
+    Long-lived pool of connection workers fed by a priority queue.
+
+    New devices go first, then stronger RSSI. Devices whose GATT table was
+    captured less than REINTERROGATE_TTL seconds ago are not queued again,
+    nor are new MACs of a logical device that was (see modules/identity.py),
+    and failed devices are retried with per-MAC exponential backoff.
+
+    'adapters' is one adapter name or a list; each adapter gets
+    max_connect workers (from 'state', a RuntimeState) and every job goes
+    to the adapter with the fewest connections in flight. The backoff
+    table is restored from and journaled to 'state'.
+    """
+
+    def __init__(self, adapters, workers=None, reinterrogate_ttl=None, state=None):
+        if isinstance(adapters, str):
+            adapters = [adapters]
+        self.adapters = list(adapters)
+        self.state = state
+        max_connect = state.settings.max_connect if state is not None else utils.MAX_CONNECT
+        self.workers = workers or max_connect * len(self.adapters)
+        self.reinterrogate_ttl = reinterrogate_ttl or utils.REINTERROGATE_TTL
+        # Heap of (priority, -rssi, seq, mac); stale entries are skipped on pop
+        self._heap = []
+        self._seq = itertools.count()
+        # MAC -> (device, seq, queued_at) for devices waiting in the heap
+        self._pending = {}
+        self._in_flight = set()
+        # MAC -> (consecutive failures, monotonic time of next allowed attempt)
+        self._backoff = {}
+        # MAC -> epoch seconds of the last successful GATT capture
+        self._interrogated = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        # Adapter -> connections in flight / window counters
+        self._load = {adapter: 0 for adapter in self.adapters}
+        self._adapter_attempts = {adapter: 0 for adapter in self.adapters}
+        self._adapter_successes = {adapter: 0 for adapter in self.adapters}
+        self._rr = 0
+
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+        self.expired = 0
+        self._window_start = time.monotonic()
+        # Result of the last take_stats(), for readers that must not reset the window
+        self.last_stats = (0, 0.0, 0.0, {})
+        self._window_attempts = 0
+        self._window_successes = 0
+        if state is not None:
+            self._restore_backoff(state.backoff)
+
+    def _restore_backoff(self, backoff):
+        """Epoch-based backoff from the state journal -> monotonic deadlines."""
+        offset = time.monotonic() - time.time()
+        for mac, (failures, until) in backoff.items():
+            self._backoff[mac] = (failures, until + offset)
+
+    def load_interrogated(self):
+        """Seed the 'already interrogated' cache from gatt_services."""
+        since = int(time.time()) - self.reinterrogate_ttl
+        self._interrogated.update(load_interrogated_devices(since))
+        logging.info(f"Connection scheduler: {len(self._interrogated)} devices interrogated within TTL")
+
+    def start(self):
+        suffix = f":{self.state.name}" if self.state is not None and self.state.name != "default" else ""
+        metrics.track_queue(f"connect{suffix}", self.queue_depth)
+        metrics.track_queue(f"connecting{suffix}", lambda: len(self._in_flight))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def offer(self, device, rssi, is_new=False):
+        """
+        Called for every sighting. Queues the device unless it is already
+        queued/connecting, recently interrogated, or backing off.
+        """
+        mac = device.address
+        if mac in self._pending or mac in self._in_flight:
+            return False
+        done = self._interrogated.get(mac)
+        if done is not None and time.time() - done < self.reinterrogate_ttl:
+            return False
+        identities = self.state.identities if self.state is not None else None
+        if identities is not None and identities.interrogated(mac, self.reinterrogate_ttl):
+            return False
+        now = time.monotonic()
+        backoff = self._backoff.get(mac)
+        if backoff is not None and now < backoff[1]:
+            return False
+
+        seq = next(self._seq)
+        self._pending[mac] = (device, seq, now)
+        heapq.heappush(self._heap, (0 if is_new else 1, -rssi, seq, mac))
+        self._wakeup.set()
+        return True
+
+    async def _next(self):
+        while True:
+            while self._heap:
+                _, _, seq, mac = heapq.heappop(self._heap)
+                entry = self._pending.get(mac)
+                if entry is None or entry[1] != seq:
+                    continue
+                del self._pending[mac]
+                device, _, queued_at = entry
+                waited = time.monotonic() - queued_at
+                # The device has probably moved out of range by now
+                if waited > utils.CONNECT_QUEUE_MAX_AGE:
+                    self.expired += 1
+                    continue
+                metrics.CONNECT_QUEUE_WAIT.observe(waited)
+                return device
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def _pick_adapter(self):
+        """Least-loaded adapter; ties are broken round-robin."""
+        self._rr = (self._rr + 1) % len(self.adapters)
+        order = self.adapters[self._rr:] + self.adapters[:self._rr]
+        return min(order, key=self._load.__getitem__)
+
+    async def _worker(self):
+        while True:
+            device = await self._next()
+            mac = device.address
+            adapter = self._pick_adapter()
+            self._in_flight.add(mac)
+            self._load[adapter] += 1
+            self.attempts += 1
+            self._window_attempts += 1
+            self._adapter_attempts[adapter] += 1
+            success = False
+            try:
+                success = await connect_to_device(device, adapter)
+            finally:
+                self._in_flight.discard(mac)
+                self._load[adapter] -= 1
+            if success:
+                self._adapter_successes[adapter] += 1
+            self._record_result(mac, success)
+
+    def _record_result(self, mac, success):
+        if success:
+            self.successes += 1
+            self._window_successes += 1
+            self._interrogated[mac] = time.time()
+            if self.state is not None:
+                self.state.record_capture(mac, self._interrogated[mac])
+            if self._backoff.pop(mac, None) is not None and self.state is not None:
+                self.state.clear_backoff(mac)
+            return
+        self.failures += 1
+        failures = self._backoff.get(mac, (0, 0))[0] + 1
+        delay = min(utils.CONNECT_BACKOFF_BASE * 2 ** (failures - 1), utils.CONNECT_BACKOFF_MAX)
+        self._backoff[mac] = (failures, time.monotonic() + delay)
+        if self.state is not None:
+            self.state.record_backoff(mac, failures, time.time() + delay)
+
+    def prune(self):
+        """Forget expired cache and backoff entries so memory stays bounded."""
+        cutoff = time.time() - self.reinterrogate_ttl
+        for mac in [mac for mac, t in self._interrogated.items() if t < cutoff]:
+            del self._interrogated[mac]
+        stale = time.monotonic() - utils.CONNECT_BACKOFF_MAX
+        for mac in [mac for mac, (_, t) in self._backoff.items() if t < stale]:
+            del self._backoff[mac]
+        # Rebuild the heap once it is mostly stale entries
+        if len(self._heap) > 2 * len(self._pending) + 64:
+            self._heap = [e for e in self._heap if self._pending.get(e[3], (None, None))[1] == e[2]]
+            heapq.heapify(self._heap)
+
+    def take_stats(self):
+        """
+        Return (queue depth, connects/sec, success rate, per-adapter
+        {adapter: (connects/sec, success rate)}) and start a new window.
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._window_start, 1e-6)
+        rate = self._window_attempts / elapsed
+        success_rate = self._window_successes / self._window_attempts if self._window_attempts else 0.0
+        per_adapter = {}
+        for adapter in self.adapters:
+            attempts = self._adapter_attempts[adapter]
+            successes = self._adapter_successes[adapter]
+            per_adapter[adapter] = (attempts / elapsed, successes / attempts if attempts else 0.0)
+            self._adapter_attempts[adapter] = 0
+            self._adapter_successes[adapter] = 0
+        self._window_start = now
+        self._window_attempts = 0
+        self._window_successes = 0
+        self.last_stats = (len(self._pending), rate, success_rate, per_adapter)
+        return self.last_stats
@@ -0,0 +1,265 @@
+# modules/console.py
+
+"""
+Console output of the scanner. The scan loop never calls print() itself;
+it hands lines to the Console, which depending on utils.CONSOLE_MODE:
+
+- "verbose": prints every line, per-device ones included ([NEW], [UPDATED],
+  "seen N times", connects), as the scanner always did;
+- "summary": prints the periodic statistics and errors only;
+- "dashboard": redraws a live table in place every DASHBOARD_REFRESH
+  seconds. Sightings only update a bounded table of recent devices, so
+  the output cost is per refresh, not per device.
+
+Text goes to a writer thread through a bounded queue: a slow terminal (an
+SSH session over a bad link) stalls that thread, not the event loop. When
+the queue is full, lines are dropped and counted.
+
+setup_logging() does the same for app.log: records are put on a queue and
+written to the file by a QueueListener thread. The file is rotated at
+LOG_MAX_BYTES and old files are gzipped on that thread as well.
+"""
+
+import asyncio
+import collections
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from termcolor import colored
+
+from . import utils
+from . import metrics
+
+_console = None
+_listener = None
+
+def _gzip_name(name):
+    return name + ".gz"
+
+def _gzip_rotate(source, destination):
+    with open(source, "rb") as f_in, gzip.open(destination, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def setup_logging(filename, level=logging.INFO):
+    """Log to 'filename' from a background thread; replaces the root handlers."""
+    global _listener
+    stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename, maxBytes=utils.LOG_MAX_BYTES, backupCount=utils.LOG_BACKUPS
+    )
+    if utils.LOG_COMPRESS:
+        file_handler.namer = _gzip_name
+        file_handler.rotator = _gzip_rotate
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s:%(message)s'))
+    records = queue.Queue(-1)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+
+def log_file():
+    """Path of the file setup_logging() writes to, or None."""
+    if _listener is None:
+        return None
+    for handler in _listener.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+    return None
+
+def stop_logging():
+    """Write out queued log records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+class _Writer(threading.Thread):
+    """Writes queued lines and dashboard frames to stdout, one write per batch."""
+
+    def __init__(self, size):
+        super().__init__(name="console-writer", daemon=True)
+        self.items = queue.Queue(maxsize=size)
+
+    def run(self):
+        while True:
+            batch = [self.items.get()]
+            while True:
+                try:
+                    batch.append(self.items.get_nowait())
+                except queue.Empty:
+                    break
+            # Only the newest frame of a batch is worth drawing
+            frame = None
+            lines = []
+            stop = False
+            for kind, text in batch:
+                if kind == "frame":
+                    frame = text
+                elif kind == "line":
+                    lines.append(text)
+                else:
+                    stop = True
+            out = "".join(line + "\n" for line in lines) + (frame or "")
+            if out:
+                try:
+                    sys.stdout.write(out)
+                    sys.stdout.flush()
+                except (OSError, ValueError):
+                    pass
+            if stop:
+                return
+
+class Console:
+    def __init__(self, mode=None):
+        self.mode = mode or utils.CONSOLE_MODE
+        # Callers skip formatting per-device text nobody will see
+        self.per_device = self.mode != "summary"
+        self.dropped = 0
+        self.new_devices = 0
+        self._writer = _Writer(utils.CONSOLE_QUEUE_SIZE)
+        self._writer.start()
+        metrics.track_queue("console", self._writer.items.qsize)
+        # Dashboard state: MAC -> (name, adapter, rssi, count, timestamp), most recent last
+        self._devices = collections.OrderedDict()
+        self._events = collections.deque(maxlen=utils.DASHBOARD_EVENTS)
+        self._status = []
+        self._started = time.time()
+
+    def _put(self, kind, text):
+        if self.dropped and kind == "line":
+            try:
+                self._writer.items.put_nowait(("line", f"[... {self.dropped} console lines dropped]"))
+                self.dropped = 0
+            except queue.Full:
+                pass
+        try:
+            self._writer.items.put_nowait((kind, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def line(self, text):
+        """A message shown in every mode (errors, start-up notices)."""
+        if self.mode == "dashboard":
+            self._events.append(text.strip())
+        else:
+            self._put("line", text)
+
+    def event(self, text):
+        """A per-device or per-cycle message: hidden in summary mode."""
+        if self.mode == "verbose":
+            self._put("line", text)
+        elif self.mode == "dashboard":
+            self._events.append(text.strip())
+
+    def seen(self, mac, name, adapter, rssi, count, timestamp, is_new, updates=False):
+        """
+        A device was heard. Verbose mode prints [NEW] (and with 'updates'
+        [UPDATED] plus the sighting count); the dashboard just moves the
+        device to the top of its table.
+        """
+        if is_new:
+            self.new_devices += 1
+        if self.mode == "dashboard":
+            devices = self._devices
+            devices[mac] = (name, adapter, rssi, count, timestamp)
+            devices.move_to_end(mac)
+            if len(devices) > utils.DASHBOARD_ROWS:
+                devices.popitem(last=False)
+        elif self.mode == "verbose" and (is_new or updates):
+            rssi_display = colored(f"{rssi}", "magenta", attrs=["bold"])
+            if is_new:
+                self._put("line", f"{colored('[NEW]', 'green')} {name} (Interface: {adapter}) RSSI: {rssi_display}")
+            else:
+                self._put("line", f"{colored('[UPDATED]', 'yellow')} {name} (Interface: {adapter}) RSSI: {rssi_display}")
+            if updates:
+                self._put("line", f"{colored('[INFO]', 'blue')} Device {name} seen {count} times.")
+
+    def status(self, lines):
+        """Periodic statistics block: printed, or shown in the dashboard header."""
+        if self.mode == "dashboard":
+            self._status = lines
+        else:
+            for text in lines:
+                self._put("line", text)
+
+    def render(self):
+        width, height = shutil.get_terminal_size((100, 30))
+        uptime = int(time.time() - self._started)
+        head = [
+            colored(f"PiBLE | {time.strftime('%H:%M:%S')} | up {uptime // 3600}:{uptime // 60 % 60:02d}:"
+                    f"{uptime % 60:02d} | new devices: {self.new_devices}", "white", attrs=["bold"]),
+        ]
+        head.extend(self._status)
+        head.append("")
+        head.append(colored(f"{'MAC':<18} {'Name':<24} {'RSSI':>5} {'Seen':>6} {'Adapter':<8} Last", attrs=["bold"]))
+        tail = []
+        if self._events:
+            tail.append("")
+            tail.extend(text[:width] for text in self._events)
+        if self.dropped:
+            tail.append(f"[{self.dropped} console lines dropped]")
+
+        # The device table gets whatever rows the terminal has left
+        rows = []
+        now = time.time()
+        for mac, (name, adapter, rssi, count, timestamp) in reversed(self._devices.items()):
+            if len(head) + len(rows) + len(tail) >= height - 1:
+                break
+            rows.append(
+                f"{mac:<18} {name[:24]:<24} {rssi:>5} {count:>6} {adapter:<8} {int(now - timestamp)}s ago"[:width]
+            )
+        lines = (head + rows + tail)[:max(height - 1, 1)]
+        # Cursor home, overwrite each line, clear what is left of the old frame
+        return "\x1b[H" + "".join(text + "\x1b[K\n" for text in lines) + "\x1b[J"
+
+    async def run_dashboard(self):
+        """Redraw the dashboard every DASHBOARD_REFRESH seconds (no-op in other modes)."""
+        if self.mode != "dashboard":
+            return
+        while True:
+            self._put("frame", self.render())
+            await asyncio.sleep(utils.DASHBOARD_REFRESH)
+
+    def close(self):
+        """Draw the last frame, write out everything queued and stop the writer."""
+        if self.mode == "dashboard":
+            self._put("frame", self.render())
+        try:
+            self._writer.items.put(("stop", None), timeout=5)
+        except queue.Full:
+            return
+        self._writer.join(timeout=5)
+
+def get_console():
+    global _console
+    if _console is None:
+        _console = Console()
+    return _console
+
+def console_line(text):
+    """
+    console.line() from any thread; printed directly when no console is
+    open (before start-up, after close_console()).
+    """
+    if _console is None:
+        print(text)
+    else:
+        _console.line(text)
+
+def close_console():
+    global _console
+    if _console is not None:
+        _console.close()
+        _console = None
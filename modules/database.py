@@ -1,15 +1,259 @@
 # modules/database.py
 
 import sqlite3
-from datetime import datetime
+import threading
+import queue
+import time
+from termcolor import colored
 from . import utils
+from . import metrics
+from .console import console_line
 import logging
 
-def initialize_database():
-    connection = sqlite3.connect("bluetooth_devices.db")
-    cursor = connection.cursor()
+# Writer queue item kinds
+_EXEC = "exec"
+_MANY = "many"
+_CALL = "call"
+_COMMIT = "commit"
+_SYNC = "sync"
+_STOP = "stop"
+
+_writer = None
+_reader_local = threading.local()
+
+def _report_error(message):
+    # Through the console writer: a print() from the writer thread would tear the dashboard
+    logging.error(message)
+    console_line(f"{colored('[ERROR]', 'red')} {message}")
+
+def open_connection(path=None):
+    """Open a connection with the configured journal/synchronous/cache settings."""
+    connection = sqlite3.connect(path or utils.DB_PATH, check_same_thread=False)
+    # Only takes effect on a new database, before WAL writes its header;
+    # existing ones switch with 'python -m modules.retention vacuum'
+    connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    connection.execute(f"PRAGMA journal_mode={utils.DB_JOURNAL_MODE}")
+    connection.execute(f"PRAGMA synchronous={utils.DB_SYNCHRONOUS}")
+    connection.execute(f"PRAGMA cache_size={int(utils.DB_CACHE_SIZE)}")
+    return connection
+
+class DatabaseWriter:
+    """
+    Single long-lived write connection running on a dedicated thread.
+    Statements are queued by the scanner/connector coroutines and applied
+    in batches; everything queued between two commit() calls (one scan
+    cycle) ends up in one transaction.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or utils.DB_PATH
+        self._queue = queue.Queue()
+        self._thread = None
+        # (total, named, with service) as of the last commit; replaced
+        # atomically by the writer thread, read by anyone
+        self.statistics = None
+        # Rows written / transactions committed since start (benchmarking)
+        self.rows_written = 0
+        self.commits = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql, params=()):
+        """Queue a single statement. Never blocks the caller."""
+        self._queue.put((_EXEC, sql, params))
+
+    def submit_many(self, sql, rows):
+        """Queue a statement to be run with executemany over 'rows'."""
+        self._queue.put((_MANY, sql, rows))
+
+    def call(self, func, *args, **kwargs):
+        """Queue func(cursor, *args, **kwargs) to run on the writer thread."""
+        self._queue.put((_CALL, func, (args, kwargs)))
+
+    def commit(self):
+        """Mark the end of a batch (e.g. a scan cycle)."""
+        self._queue.put((_COMMIT, None, None))
+
+    def flush(self, timeout=None):
+        """Commit everything queued so far and wait until it is on disk."""
+        if not self._thread or not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        self._queue.put((_SYNC, done, None))
+        return done.wait(timeout)
+
+    def stop(self, timeout=None):
+        if not self._thread:
+            return
+        self._queue.put((_STOP, None, None))
+        self._thread.join(timeout)
+        self._thread = None
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _refresh_statistics(self, cursor):
+        try:
+            row = cursor.execute('SELECT total, named, with_service FROM stats WHERE id = 1').fetchone()
+            if row is not None:
+                self.statistics = row
+        except sqlite3.DatabaseError as e:
+            logging.error(f"Database error (stats): {e}")
+
+    def _run(self):
+        connection = open_connection(self.path)
+        cursor = connection.cursor()
+        ops = 0
+        txn_started = None
+        self._refresh_statistics(cursor)
+
+        def commit():
+            nonlocal ops, txn_started
+            if ops:
+                started = time.perf_counter()
+                try:
+                    connection.commit()
+                    self.commits += 1
+                    metrics.DB_COMMIT.observe(time.perf_counter() - started)
+                    metrics.DB_BATCH.observe(ops)
+                except sqlite3.DatabaseError as e:
+                    _report_error(f"Database commit error: {e}")
+                self._refresh_statistics(cursor)
+            ops = 0
+            txn_started = None
+
+        while True:
+            try:
+                kind, a, b = self._queue.get(timeout=utils.DB_COMMIT_INTERVAL)
+            except queue.Empty:
+                commit()
+                continue
+
+            if kind == _STOP:
+                commit()
+                break
+            if kind == _COMMIT:
+                commit()
+                continue
+            if kind == _SYNC:
+                commit()
+                a.set()
+                continue
+
+            try:
+                if kind == _EXEC:
+                    cursor.execute(a, b)
+                    self.rows_written += 1
+                    metrics.DB_ROWS.inc()
+                elif kind == _MANY:
+                    cursor.executemany(a, b)
+                    self.rows_written += len(b)
+                    metrics.DB_ROWS.inc(len(b))
+                elif kind == _CALL:
+                    args, kwargs = b
+                    a(cursor, *args, **kwargs)
+            except sqlite3.DatabaseError as e:
+                metrics.DB_ERRORS.inc()
+                _report_error(f"Database error: {e}")
+            except Exception as e:
+                metrics.DB_ERRORS.inc()
+                _report_error(f"Error in database writer: {e}")
+
+            ops += 1
+            if txn_started is None:
+                txn_started = time.monotonic()
+            if ops >= utils.DB_MAX_BATCH or time.monotonic() - txn_started >= utils.DB_COMMIT_INTERVAL:
+                commit()
+
+        connection.close()
+
+def get_writer():
+    """Return the shared writer, starting it on first use."""
+    global _writer
+    if _writer is None:
+        _writer = DatabaseWriter()
+        _writer.start()
+        metrics.track_queue("db_writer", _writer.pending)
+    return _writer
+
+def use_writer(writer):
+    """
+    Replace the shared writer with an object of the same interface, e.g.
+    one forwarding the statements to another process.
+    """
+    global _writer
+    _writer = writer
+
+def commit_pending():
+    """Close the current batch so it is committed as one transaction."""
+    get_writer().commit()
+
+def close_database(timeout=10):
+    """Flush pending writes and stop the writer thread."""
+    global _writer
+    if _writer is not None:
+        _writer.stop(timeout)
+        _writer = None
+
+def read_connection():
+    """Long-lived read connection, one per thread."""
+    connection = getattr(_reader_local, "connection", None)
+    if connection is None:
+        connection = open_connection()
+        _reader_local.connection = connection
+    return connection
+
+# Column order of a device row passed to upsert_devices()
+DEVICE_COLUMNS = (
+    "name", "mac", "rssi", "timestamp", "adapter", "manufacturer_data",
+    "service_uuids", "service_data", "tx_power", "platform_data", "gps", "service",
+    "first_seen", "lat", "lon",
+)
+
+# One statement does insert-or-update plus the detection_count rule:
+# the count is bumped at most once per DETECTION_COUNT_INTERVAL seconds.
+# NULL values never overwrite what is already stored. changed_at is the
+# time of the write (not of the sighting), for incremental exports.
+_UPSERT_DEVICE_SQL = '''
+    INSERT INTO devices (
+        name, mac, rssi, timestamp, adapter, manufacturer_data,
+        service_uuids, service_data, tx_power, platform_data, gps,
+        service, first_seen, lat, lon, detection_count, last_count_update, changed_at
+    ) VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10, ?11, ?12, ?13, ?14, ?15, 1, ?4,
+              CAST(strftime('%s', 'now') AS INTEGER))
+    ON CONFLICT(mac) DO UPDATE SET
+        name = COALESCE(excluded.name, name),
+        rssi = COALESCE(excluded.rssi, rssi),
+        timestamp = COALESCE(excluded.timestamp, timestamp),
+        adapter = COALESCE(excluded.adapter, adapter),
+        manufacturer_data = COALESCE(excluded.manufacturer_data, manufacturer_data),
+        service_uuids = COALESCE(excluded.service_uuids, service_uuids),
+        service_data = COALESCE(excluded.service_data, service_data),
+        tx_power = COALESCE(excluded.tx_power, tx_power),
+        platform_data = COALESCE(excluded.platform_data, platform_data),
+        gps = COALESCE(excluded.gps, gps),
+        lat = COALESCE(excluded.lat, lat),
+        lon = COALESCE(excluded.lon, lon),
+        service = COALESCE(excluded.service, service),
+        first_seen = COALESCE(first_seen, excluded.first_seen),
+        changed_at = excluded.changed_at,
+        detection_count = CASE
+            WHEN last_count_update IS NULL
+              OR excluded.timestamp - last_count_update >= {interval}
+            THEN detection_count + 1 ELSE detection_count END,
+        last_count_update = CASE
+            WHEN last_count_update IS NULL
+              OR excluded.timestamp - last_count_update >= {interval}
+            THEN excluded.timestamp ELSE last_count_update END
+'''
+
+def _upsert_device_sql():
+    return _UPSERT_DEVICE_SQL.format(interval=int(utils.DETECTION_COUNT_INTERVAL))
 
-    # 'devices' table
+def _migrate_v1(cursor):
+    """Original schema (text timestamps)."""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS devices (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -29,7 +273,6 @@ def initialize_database():
             last_count_update TEXT
         )
     ''')
-    connection.commit()
 
     # Add new columns if they don't exist
     columns = ["service", "last_count_update"]
@@ -53,169 +296,547 @@ def initialize_database():
         )
     ''')
 
-    connection.commit()
+def _migrate_v2(cursor):
+    """Store 'timestamp' and 'last_count_update' as integer epoch seconds."""
+    cursor.execute('''
+        CREATE TABLE devices_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            mac TEXT UNIQUE,
+            rssi INTEGER,
+            service TEXT,
+            timestamp INTEGER,
+            adapter TEXT,
+            manufacturer_data TEXT,
+            service_uuids TEXT,
+            service_data TEXT,
+            tx_power TEXT,
+            platform_data TEXT,
+            gps TEXT,
+            detection_count INTEGER DEFAULT 1,
+            last_count_update INTEGER
+        )
+    ''')
+    # Old values are local-time "YYYY-MM-DD HH:MM:SS" strings
+    cursor.execute('''
+        INSERT INTO devices_v2 (
+            id, name, mac, rssi, service, timestamp, adapter, manufacturer_data,
+            service_uuids, service_data, tx_power, platform_data, gps,
+            detection_count, last_count_update
+        )
+        SELECT
+            id, name, mac, rssi, service,
+            CASE WHEN typeof(timestamp) = 'text'
+                 THEN CAST(strftime('%s', timestamp, 'utc') AS INTEGER) ELSE timestamp END,
+            adapter, manufacturer_data, service_uuids, service_data, tx_power,
+            platform_data, gps, detection_count,
+            CASE WHEN typeof(last_count_update) = 'text'
+                 THEN CAST(strftime('%s', last_count_update, 'utc') AS INTEGER) ELSE last_count_update END
+        FROM devices
+    ''')
+    cursor.execute('DROP TABLE devices')
+    cursor.execute('ALTER TABLE devices_v2 RENAME TO devices')
+
+def _migrate_v3(cursor):
+    """Track first sighting and index last sighting for the registry warm-load."""
+    cursor.execute('ALTER TABLE devices ADD COLUMN first_seen INTEGER')
+    cursor.execute('UPDATE devices SET first_seen = timestamp')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_timestamp ON devices (timestamp)')
+
+def _migrate_v4(cursor):
+    """Remember when each device's GATT table was captured."""
+    cursor.execute('ALTER TABLE gatt_services ADD COLUMN updated_at INTEGER')
+    cursor.execute('''
+        UPDATE gatt_services
+        SET updated_at = (SELECT timestamp FROM devices WHERE devices.mac = gatt_services.mac)
+    ''')
+
+def _migrate_v5(cursor):
+    """
+    Normalized GATT storage. Layouts (services + characteristics) are
+    content-hashed and shared between devices; values are per device.
+    Old text blobs in gatt_services.service are kept as they are.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS gatt_layouts (
+            hash BLOB PRIMARY KEY,
+            service_count INTEGER,
+            characteristic_count INTEGER,
+            first_seen INTEGER
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS services (
+            layout_hash BLOB,
+            handle INTEGER,
+            uuid TEXT,
+            description TEXT,
+            PRIMARY KEY (layout_hash, handle)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS characteristics (
+            layout_hash BLOB,
+            handle INTEGER,
+            service_handle INTEGER,
+            uuid TEXT,
+            description TEXT,
+            properties INTEGER,
+            PRIMARY KEY (layout_hash, handle)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS characteristic_values (
+            mac TEXT,
+            handle INTEGER,
+            uuid TEXT,
+            value BLOB,
+            error TEXT,
+            PRIMARY KEY (mac, handle)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characteristics_uuid ON characteristics (uuid)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_characteristic_values_uuid ON characteristic_values (uuid)')
+    cursor.execute('ALTER TABLE gatt_services ADD COLUMN layout_hash BLOB')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_gatt_services_layout ON gatt_services (layout_hash)')
+
+def _migrate_v6(cursor):
+    """Device counters kept up to date by triggers instead of COUNT(*) scans."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL,
+            named INTEGER NOT NULL,
+            with_service INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO stats (id, total, named, with_service) VALUES (
+            1,
+            (SELECT COUNT(*) FROM devices),
+            (SELECT COUNT(*) FROM devices WHERE name != 'Unknown'),
+            (SELECT COUNT(*) FROM gatt_services)
+        )
+    ''')
+    triggers = [
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_devices_insert AFTER INSERT ON devices BEGIN
+            UPDATE stats SET total = total + 1,
+                             named = named + IFNULL(NEW.name != 'Unknown', 0)
+            WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_devices_delete AFTER DELETE ON devices BEGIN
+            UPDATE stats SET total = total - 1,
+                             named = named - IFNULL(OLD.name != 'Unknown', 0)
+            WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_devices_rename AFTER UPDATE OF name ON devices
+        WHEN NEW.name IS NOT OLD.name BEGIN
+            UPDATE stats SET named = named + IFNULL(NEW.name != 'Unknown', 0)
+                                           - IFNULL(OLD.name != 'Unknown', 0)
+            WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_gatt_insert AFTER INSERT ON gatt_services BEGIN
+            UPDATE stats SET with_service = with_service + 1 WHERE id = 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS stats_gatt_delete AFTER DELETE ON gatt_services BEGIN
+            UPDATE stats SET with_service = with_service - 1 WHERE id = 1;
+        END
+        ''',
+    ]
+    for trigger in triggers:
+        cursor.execute(trigger)
+
+def _migrate_v7(cursor):
+    """
+    Sighting history. The per-day sightings_YYYYMMDD tables are created on
+    demand by modules/sightings.py; these are the shared lookup/rollup tables.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS adapters (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS device_locations (
+            mac_id INTEGER PRIMARY KEY,
+            rssi INTEGER,
+            lat INTEGER,
+            lon INTEGER,
+            ts INTEGER
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS hourly_counts (
+            mac_id INTEGER,
+            hour INTEGER,
+            count INTEGER,
+            PRIMARY KEY (mac_id, hour)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            partition TEXT PRIMARY KEY,
+            last_rowid INTEGER
+        )
+    ''')
+
+def _migrate_v8(cursor):
+    """
+    Numeric coordinates: devices.lat/lon in 1e-7 degrees next to the
+    legacy 'lat, lon' text, an R-tree per sightings partition and the
+    heat_cells density grid (maintained by the sightings rollup).
+    """
+    cursor.execute('ALTER TABLE devices ADD COLUMN lat INTEGER')
+    cursor.execute('ALTER TABLE devices ADD COLUMN lon INTEGER')
+    cursor.execute('''
+        UPDATE devices SET
+            lat = CAST(ROUND(CAST(TRIM(substr(gps, 1, instr(gps, ',') - 1)) AS REAL) * 10000000) AS INTEGER),
+            lon = CAST(ROUND(CAST(TRIM(substr(gps, instr(gps, ',') + 1)) AS REAL) * 10000000) AS INTEGER)
+        WHERE gps GLOB '*[0-9],*[0-9]*'
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS heat_cells (
+            cy INTEGER,
+            cx INTEGER,
+            hour INTEGER,
+            count INTEGER,
+            PRIMARY KEY (cy, cx, hour)
+        ) WITHOUT ROWID
+    ''')
+    # Rows past rollup_state are picked up by the next rollup
+    from .sightings import list_partitions, create_geo_index, index_locations
+    for name in list_partitions(cursor):
+        create_geo_index(cursor, name)
+        row = cursor.execute('SELECT last_rowid FROM rollup_state WHERE partition = ?', (name,)).fetchone()
+        if row and row[0]:
+            index_locations(cursor, name, 0, row[0])
+
+def _migrate_v9(cursor):
+    """
+    Write time of device and GATT rows (changed_at), so exports can pick
+    up only the rows changed since their last run (modules/export.py).
+    """
+    cursor.execute('ALTER TABLE devices ADD COLUMN changed_at INTEGER')
+    cursor.execute('UPDATE devices SET changed_at = timestamp')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_devices_changed ON devices (changed_at)')
+    cursor.execute('ALTER TABLE gatt_services ADD COLUMN changed_at INTEGER')
+    cursor.execute('UPDATE gatt_services SET changed_at = updated_at')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_gatt_services_changed ON gatt_services (changed_at)')
+
+def _migrate_v10(cursor):
+    """
+    Logical devices: MACs that belong to one physical device (rotating
+    random addresses) share a logical_devices row through mac_aliases.
+    Maintained by modules/identity.py.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS logical_devices (
+            id INTEGER PRIMARY KEY,
+            fingerprint INTEGER,
+            mac TEXT,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            mac_count INTEGER,
+            interrogated_at INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_logical_devices_last_seen ON logical_devices (last_seen)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mac_aliases (
+            mac TEXT PRIMARY KEY,
+            logical_id INTEGER NOT NULL,
+            first_seen INTEGER,
+            last_seen INTEGER
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mac_aliases_logical ON mac_aliases (logical_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_mac_aliases_last_seen ON mac_aliases (last_seen)')
+
+def _migrate_v11(cursor):
+    """Hour indexes, so retention finds the oldest aggregates without a scan."""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hourly_counts_hour ON hourly_counts (hour)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_heat_cells_hour ON heat_cells (hour)')
+
+# (version, migration) pairs; PRAGMA user_version holds the last applied one
+_MIGRATIONS = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+    (3, _migrate_v3),
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+    (6, _migrate_v6),
+    (7, _migrate_v7),
+    (8, _migrate_v8),
+    (9, _migrate_v9),
+    (10, _migrate_v10),
+    (11, _migrate_v11),
+]
+
+def initialize_database():
+    connection = open_connection()
+    cursor = connection.cursor()
+
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    for target, migration in _MIGRATIONS:
+        if version >= target:
+            continue
+        logging.info(f"Migrating database schema to version {target}")
+        try:
+            cursor.execute('BEGIN')
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {target}')
+            cursor.execute('COMMIT')
+        except sqlite3.DatabaseError as e:
+            cursor.execute('ROLLBACK')
+            logging.error(f"Database migration to version {target} failed: {e}")
+            raise
+        version = target
+
     connection.close()
 
+    get_writer()
+
+def upsert_devices(rows):
+    """
+    Queue a batch of device rows (tuples in DEVICE_COLUMNS order) for a
+    single executemany of the upsert statement. 'timestamp' is epoch seconds.
+    """
+    if rows:
+        get_writer().submit_many(_upsert_device_sql(), rows)
+
 def save_device_to_db(device_name, mac, rssi, timestamp, adapter, manufacturer_data,
                       service_uuids, service_data, tx_power, platform_data, gps_data,
-                      service_list=None, detection_count=1,
-                      update_existing=False):
+                      service_list=None, lat=None, lon=None):
+    """
+    Queue an upsert of a single device row. 'timestamp' is epoch seconds,
+    lat/lon are integer 1e-7 degrees.
+    """
+    get_writer().submit(_upsert_device_sql(), (
+        device_name, mac, rssi, timestamp, adapter, manufacturer_data,
+        service_uuids, service_data, tx_power, platform_data, gps_data,
+        service_list, timestamp, lat, lon,
+    ))
+
+def _store_gatt_table(cursor, mac, layout_hash, service_rows, characteristic_rows,
+                      value_rows, timestamp):
+    cursor.execute(
+        'INSERT OR IGNORE INTO gatt_layouts (hash, service_count, characteristic_count, first_seen) '
+        'VALUES (?, ?, ?, ?)',
+        (layout_hash, len(service_rows), len(characteristic_rows), timestamp)
+    )
+    # Layout rows are only written the first time this layout is seen
+    if cursor.rowcount == 1:
+        cursor.executemany(
+            'INSERT OR IGNORE INTO services (layout_hash, handle, uuid, description) VALUES (?, ?, ?, ?)',
+            [(layout_hash,) + row for row in service_rows]
+        )
+        cursor.executemany(
+            'INSERT OR IGNORE INTO characteristics '
+            '(layout_hash, handle, service_handle, uuid, description, properties) VALUES (?, ?, ?, ?, ?, ?)',
+            [(layout_hash,) + row for row in characteristic_rows]
+        )
+    cursor.execute('DELETE FROM characteristic_values WHERE mac = ?', (mac,))
+    cursor.executemany(
+        'INSERT INTO characteristic_values (mac, handle, uuid, value, error) VALUES (?, ?, ?, ?, ?)',
+        [(mac,) + row for row in value_rows]
+    )
+    cursor.execute("""
+        INSERT INTO gatt_services (mac, service, updated_at, layout_hash, changed_at)
+        VALUES (?, NULL, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+        ON CONFLICT(mac) DO UPDATE SET
+            service = NULL,
+            updated_at = excluded.updated_at,
+            layout_hash = excluded.layout_hash,
+            changed_at = excluded.changed_at
+    """, (mac, timestamp, layout_hash))
+
+def save_gatt_table(mac, layout_hash, service_rows, characteristic_rows, value_rows, timestamp):
+    """
+    Queue a captured GATT table. Rows come from gatt_layout.build_layout();
+    value_rows are (handle, uuid, value bytes or None, error text or None).
+    """
+    get_writer().call(
+        _store_gatt_table, mac, layout_hash, service_rows, characteristic_rows,
+        value_rows, timestamp
+    )
+
+def load_adapter_ids():
+    """Return {adapter name: id} for the sightings log."""
     try:
-        connection = sqlite3.connect("bluetooth_devices.db")
-        cursor = connection.cursor()
+        cursor = read_connection().cursor()
+        cursor.execute('SELECT name, id FROM adapters')
+        return dict(cursor.fetchall())
+    except sqlite3.DatabaseError as e:
+        _report_error(f"Database error: {e}")
+        return {}
 
-        if update_existing:
-            cursor.execute('SELECT detection_count, last_count_update FROM devices WHERE mac = ?', (mac,))
-            result = cursor.fetchone()
-            if result:
-                existing_detection_count, last_count_update_str = result
-                detection_count = existing_detection_count
-
-                if last_count_update_str:
-                    last_count_update_time = datetime.strptime(last_count_update_str, "%Y-%m-%d %H:%M:%S")
-                    current_time = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
-                    time_diff = (current_time - last_count_update_time).total_seconds()
-                else:
-                    time_diff = None
-
-                if time_diff is None or time_diff >= 1800:
-                    detection_count += 1
-                    last_count_update_str = timestamp
-            else:
-                detection_count = 1
-                last_count_update_str = timestamp
-
-            update_fields = []
-            params = []
-
-            if device_name is not None:
-                update_fields.append("name = ?")
-                params.append(device_name)
-            if rssi is not None:
-                update_fields.append("rssi = ?")
-                params.append(rssi)
-            if timestamp is not None:
-                update_fields.append("timestamp = ?")
-                params.append(timestamp)
-            if adapter is not None:
-                update_fields.append("adapter = ?")
-                params.append(adapter)
-            if manufacturer_data is not None:
-                update_fields.append("manufacturer_data = ?")
-                params.append(manufacturer_data)
-            if service_uuids is not None:
-                update_fields.append("service_uuids = ?")
-                params.append(service_uuids)
-            if service_data is not None:
-                update_fields.append("service_data = ?")
-                params.append(service_data)
-            if tx_power is not None:
-                update_fields.append("tx_power = ?")
-                params.append(tx_power)
-            if platform_data is not None:
-                update_fields.append("platform_data = ?")
-                params.append(platform_data)
-            if gps_data is not None:
-                update_fields.append("gps = ?")
-                params.append(gps_data)
-            if service_list is not None:
-                update_fields.append("service = ?")
-                params.append(service_list)
-
-            update_fields.append("detection_count = ?")
-            params.append(detection_count)
-            update_fields.append("last_count_update = ?")
-            params.append(last_count_update_str)
-            params.append(mac)
-
-            update_query = f'''
-                UPDATE devices SET
-                    {', '.join(update_fields)}
-                WHERE mac = ?
-            '''
-            cursor.execute(update_query, params)
-
-        else:
-            # Insert new record
-            cursor.execute('''
-                INSERT OR IGNORE INTO devices (
-                    name, mac, rssi, timestamp, adapter, manufacturer_data,
-                    service_uuids, service_data, tx_power, platform_data, gps,
-                    service, detection_count, last_count_update
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                device_name,
-                mac,
-                rssi,
-                timestamp,
-                adapter,
-                manufacturer_data,
-                service_uuids,
-                service_data,
-                tx_power,
-                platform_data,
-                gps_data,
-                service_list,
-                detection_count,
-                timestamp
-            ))
-
-        connection.commit()
-        connection.close()
+def load_interrogated_devices(since):
+    """Return {mac: updated_at} for GATT tables captured since 'since'."""
+    try:
+        cursor = read_connection().cursor()
+        cursor.execute('SELECT mac, updated_at FROM gatt_services WHERE updated_at >= ?', (since,))
+        return dict(cursor.fetchall())
+    except sqlite3.DatabaseError as e:
+        _report_error(f"Database error: {e}")
+        return {}
+
+def load_recent_devices(since, limit):
+    """Return up to 'limit' device rows seen since 'since', most recent last."""
+    try:
+        cursor = read_connection().cursor()
+        cursor.execute('''
+            SELECT mac, name, adapter, rssi, lat, lon, first_seen, timestamp,
+                   detection_count, last_count_update,
+                   manufacturer_data, service_uuids, service_data, tx_power
+            FROM devices
+            WHERE timestamp >= ?
+            ORDER BY timestamp DESC
+            LIMIT ?
+        ''', (since, limit))
+        rows = cursor.fetchall()
+        rows.reverse()
+        return rows
+    except sqlite3.DatabaseError as e:
+        _report_error(f"Database error: {e}")
+        return []
 
+def load_devices(macs):
+    """Stored rows of those 'macs' that exist, in the columns of load_recent_devices()."""
+    rows = []
+    try:
+        cursor = read_connection().cursor()
+        # Stay well below SQLite's bound-parameter limit
+        for start in range(0, len(macs), 500):
+            chunk = macs[start:start + 500]
+            cursor.execute(f'''
+                SELECT mac, name, adapter, rssi, lat, lon, first_seen, timestamp,
+                       detection_count, last_count_update,
+                       manufacturer_data, service_uuids, service_data, tx_power
+                FROM devices
+                WHERE mac IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+            rows.extend(cursor.fetchall())
+        return rows
     except sqlite3.DatabaseError as e:
-        logging.error(f"Database error: {e}")
-        print(f"Database error: {e}")
-    except Exception as e:
-        logging.error(f"Error saving device to database: {e}")
-        print(f"Error saving device to database: {e}")
-
-def update_gatt_services(mac, services):
-    """Insert or update GATT services info into the 'gatt_services' table."""
+        _report_error(f"Database error: {e}")
+        return rows
+
+def load_identities(since, limit):
+    """
+    Return (logical device rows, alias rows, highest logical id) for the
+    identities seen since 'since': (id, fingerprint, mac, first_seen,
+    last_seen, mac_count, interrogated_at) and (mac, logical_id,
+    first_seen, last_seen), most recent last.
+    """
     try:
-        conn = sqlite3.connect("bluetooth_devices.db")
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO gatt_services (mac, service)
-            VALUES (?, ?)
-            ON CONFLICT(mac) DO UPDATE SET service = excluded.service
-        """, (mac, services))
-        conn.commit()
-        conn.close()
+        cursor = read_connection().cursor()
+        cursor.execute('''
+            SELECT id, fingerprint, mac, first_seen, last_seen, mac_count, interrogated_at
+            FROM logical_devices WHERE last_seen >= ? ORDER BY last_seen DESC LIMIT ?
+        ''', (since, limit))
+        devices = cursor.fetchall()
+        devices.reverse()
+        cursor.execute('''
+            SELECT mac, logical_id, first_seen, last_seen
+            FROM mac_aliases WHERE last_seen >= ? ORDER BY last_seen DESC LIMIT ?
+        ''', (since, limit))
+        aliases = cursor.fetchall()
+        aliases.reverse()
+        last_id = cursor.execute('SELECT MAX(id) FROM logical_devices').fetchone()[0] or 0
+        return devices, aliases, last_id
     except sqlite3.DatabaseError as e:
-        logging.error(f"Database error (gatt_services): {e}")
-        print(f"Database error (gatt_services): {e}")
-    except Exception as e:
-        logging.error(f"Error updating gatt_services: {e}")
-        print(f"Error updating gatt_services: {e}")
+        _report_error(f"Database error: {e}")
+        return [], [], 0
 
 def device_exists(mac):
     try:
-        connection = sqlite3.connect("bluetooth_devices.db")
-        cursor = connection.cursor()
-        cursor.execute('SELECT COUNT(*) FROM devices WHERE mac = ?', (mac,))
-        result = cursor.fetchone()[0]
-        connection.close()
-        return result > 0
+        cursor = read_connection().cursor()
+        cursor.execute('SELECT 1 FROM devices WHERE mac = ? LIMIT 1', (mac,))
+        return cursor.fetchone() is not None
     except sqlite3.DatabaseError as e:
-        logging.error(f"Database error: {e}")
-        print(f"Database error: {e}")
+        _report_error(f"Database error: {e}")
         return False
 
+def load_device_detail(mac):
+    """
+    Return (device row, GATT table) of 'mac' for the HTTP API, each None if
+    not stored. The device row is a dict of the devices columns; the GATT
+    table is {"updated_at", "services": [...]} with each service holding its
+    characteristics and their last read value (hex) or error.
+    """
+    try:
+        cursor = read_connection().cursor()
+        cursor.execute('''
+            SELECT name, rssi, adapter, first_seen, timestamp, detection_count,
+                   lat, lon, manufacturer_data, service_uuids, service_data, tx_power
+            FROM devices WHERE mac = ?
+        ''', (mac,))
+        row = cursor.fetchone()
+        device = dict(zip((
+            "name", "rssi", "adapter", "first_seen", "last_seen", "count",
+            "lat", "lon", "manufacturer_data", "service_uuids", "service_data", "tx_power",
+        ), row)) if row is not None else None
+        if device is not None and device["lat"] is not None:
+            device["lat"] /= 1e7
+            device["lon"] /= 1e7
+
+        row = cursor.execute(
+            'SELECT updated_at, layout_hash, service FROM gatt_services WHERE mac = ?', (mac,)
+        ).fetchone()
+        if row is None:
+            return device, None
+        updated_at, layout_hash, legacy = row
+        if layout_hash is None:
+            # Captured before migration v5: only the text dump exists
+            return device, {"updated_at": updated_at, "services": [], "text": legacy}
+        services = {}
+        for handle, uuid, description in cursor.execute(
+            'SELECT handle, uuid, description FROM services WHERE layout_hash = ? ORDER BY handle',
+            (layout_hash,)
+        ):
+            services[handle] = {"handle": handle, "uuid": uuid, "description": description,
+                                "characteristics": []}
+        cursor.execute('''
+            SELECT c.handle, c.service_handle, c.uuid, c.description, c.properties, v.value, v.error
+            FROM characteristics c
+            LEFT JOIN characteristic_values v ON v.mac = ? AND v.handle = c.handle
+            WHERE c.layout_hash = ?
+            ORDER BY c.handle
+        ''', (mac, layout_hash))
+        for handle, service_handle, uuid, description, properties, value, error in cursor:
+            service = services.get(service_handle)
+            if service is None:
+                continue
+            service["characteristics"].append({
+                "handle": handle, "uuid": uuid, "description": description, "properties": properties,
+                "value": value.hex() if isinstance(value, bytes) else value, "error": error,
+            })
+        return device, {"updated_at": updated_at, "services": list(services.values())}
+    except sqlite3.DatabaseError as e:
+        _report_error(f"Database error: {e}")
+        return None, None
+
 def get_database_statistics():
+    """
+    Return (total, named, with service). O(1): the counters are maintained
+    by triggers and cached in memory by the writer after every commit.
+    """
+    if _writer is not None and _writer.statistics is not None:
+        return _writer.statistics
     try:
-        connection = sqlite3.connect("bluetooth_devices.db")
-        cursor = connection.cursor()
-        cursor.execute('SELECT COUNT(*) FROM devices')
-        total_devices = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM devices WHERE name != "Unknown"')
-        named_devices = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM devices WHERE service IS NOT NULL AND service != ""')
-        devices_with_service = cursor.fetchone()[0]
-        connection.close()
-        return total_devices, named_devices, devices_with_service
+        cursor = read_connection().cursor()
+        row = cursor.execute('SELECT total, named, with_service FROM stats WHERE id = 1').fetchone()
+        return row if row is not None else (0, 0, 0)
     except sqlite3.DatabaseError as e:
-        logging.error(f"Database error: {e}")
-        print(f"Database error: {e}")
+        _report_error(f"Database error: {e}")
         return 0, 0, 0
-
@@ -2,80 +2,149 @@
 
 import asyncio
 import logging
-from datetime import datetime
-from bleak import BleakClient
+import time
 from termcolor import colored
 
-# Import your DB helper so you can call save_device_to_db(...)
-from .database import save_device_to_db, update_gatt_services
+from .database import save_gatt_table
+from .gatt_layout import build_layout
+from .ble_backend import get_client_class
+from .console import get_console
 from .utils import is_mac_address
 from . import utils
-
-async def connect_to_device(device, adapter, semaphore):
+from . import metrics
+
+# Adapter -> seconds to wait after a connection before the worker moves on.
+# Grows after failures (BlueZ needs time to settle), shrinks after successes.
+_cooldown = {}
+
+_connect_wait = metrics.SEMAPHORE_WAIT.labels("connect")
+_read_wait = metrics.SEMAPHORE_WAIT.labels("gatt_read")
+
+async def connect_to_device(device, adapter, semaphore=None):
+    """
+    Connect to 'device', capture its GATT table and store it.
+    Returns True if the GATT data was captured (possibly partially).
+    """
+    if semaphore is None:
+        return await _connect_and_capture(device, adapter)
+    waiting = time.perf_counter()
     async with semaphore:
-        try:
-            async with BleakClient(device.address, adapter=adapter) as client:
-                if client.is_connected:
-                    device_name = device.name or "Unknown"
-                    if is_mac_address(device_name):
-                        device_name = "Unknown"
-
-                    print(f"{colored('[CONNECTED]', 'green')} {device_name} ({device.address})")
-                    logging.info(f"Connected to {device_name} ({device.address})")
-
-                    services_data = []
-
-                    # Gather GATT service info
-                    for service in client.services:
-                        service_info = f"Service: {service.uuid} - {service.description or 'No description'}"
-                        services_data.append(service_info)
-
-                        for char in service.characteristics:
-                            char_info = f"  ├─ Characteristic: {char.uuid} - {char.description or 'No description'}"
-                            services_data.append(char_info)
-
-                            props = ", ".join(char.properties)
-                            services_data.append(f"  │  Properties: {props}")
-
-                            if "read" in char.properties:
-                                try:
-                                    value = await client.read_gatt_char(char)
-                                    services_data.append(f"  │  Value: {value}")
-                                except Exception as e:
-                                    services_data.append(f"  │  Read error: {e}")
-
-                            services_data.append("  └─────────────────────────────────")
-
-                    # Convert the list of lines to one string
-                    service_list_str = "\n".join(services_data)
-
-                    # 1) Store data in a separate gatt_services table
-                    update_gatt_services(device.address, service_list_str)
-
-                    # 2) Also store it in the devices table’s "service" column
-                    timestamp_now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    save_device_to_db(
-                        device_name, 
-                        device.address,
-                        rssi=None, 
-                        timestamp=timestamp_now,
-                        adapter=adapter,
-                        manufacturer_data=None,
-                        service_uuids=None,
-                        service_data=None,
-                        tx_power=None,
-                        platform_data=None,
-                        gps_data=None,
-                        service_list=service_list_str,  # <-- This populates `devices.service`
-                        update_existing=True             # <-- This tells the function to UPDATE if device exists
+        _connect_wait.observe(time.perf_counter() - waiting)
+        return await _connect_and_capture(device, adapter)
+
+async def _read_characteristics(client, characteristics, budget):
+    """
+    Read 'characteristics' concurrently (at most GATT_READ_CONCURRENCY in
+    flight), each within GATT_READ_TIMEOUT and all within 'budget' seconds.
+    Returns ({char.handle: value or exception}, timed_out).
+    """
+    limit = asyncio.Semaphore(utils.GATT_READ_CONCURRENCY)
+
+    async def read(char):
+        waiting = time.perf_counter()
+        async with limit:
+            started = time.perf_counter()
+            _read_wait.observe(started - waiting)
+            try:
+                return await asyncio.wait_for(client.read_gatt_char(char), utils.GATT_READ_TIMEOUT)
+            finally:
+                metrics.GATT_READ.observe(time.perf_counter() - started)
+
+    tasks = {asyncio.ensure_future(read(char)): char for char in characteristics}
+    if not tasks:
+        return {}, False
+    done, pending = await asyncio.wait(tasks, timeout=max(budget, 0))
+    for task in pending:
+        task.cancel()
+    if pending:
+        # Let the cancelled reads unwind before the caller disconnects
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    results = {}
+    for task in done:
+        char = tasks[task]
+        error = task.exception()
+        if isinstance(error, asyncio.TimeoutError):
+            error = TimeoutError("read timed out")
+        results[char.handle] = error if error is not None else task.result()
+    for task in pending:
+        results[tasks[task].handle] = TimeoutError("device time budget exhausted")
+    return results, bool(pending)
+
+async def _connect_and_capture(device, adapter):
+    started = time.monotonic()
+    success = False
+    result = "not_connected"
+    try:
+        connect_timeout = min(utils.GATT_CONNECT_TIMEOUT, utils.GATT_DEVICE_TIMEOUT)
+        client_class = get_client_class()
+        async with client_class(device.address, adapter=adapter, timeout=connect_timeout) as client:
+            if client.is_connected:
+                device_name = device.name or "Unknown"
+                if is_mac_address(device_name):
+                    device_name = "Unknown"
+
+                console = get_console()
+                if console.per_device:
+                    console.event(f"{colored('[CONNECTED]', 'green')} {device_name} ({device.address})")
+                logging.info(f"Connected to {device_name} ({device.address})")
+
+                # Read every readable characteristic in parallel
+                readable = [
+                    char
+                    for service in client.services
+                    for char in service.characteristics
+                    if "read" in char.properties
+                ]
+                budget = utils.GATT_DEVICE_TIMEOUT - (time.monotonic() - started)
+                values, timed_out = await _read_characteristics(client, readable, budget)
+                if timed_out:
+                    logging.warning(f"GATT read budget exhausted for {device.address}, storing partial results")
+
+                # Layout (shared between identical devices) + per-device values
+                layout_hash, service_rows, characteristic_rows = build_layout(client.services)
+                value_rows = []
+                for handle, _, uuid, _, _ in characteristic_rows:
+                    if handle in values:
+                        value = values[handle]
+                        if isinstance(value, Exception):
+                            metrics.GATT_READ_ERRORS.labels(type(value).__name__).inc()
+                            value_rows.append((handle, uuid, None, str(value) or type(value).__name__))
+                        else:
+                            value_rows.append((handle, uuid, bytes(value), None))
+
+                save_gatt_table(
+                    device.address, layout_hash, service_rows, characteristic_rows,
+                    value_rows, int(time.time())
+                )
+
+                if console.per_device:
+                    console.event(
+                        f"[DEVICE UPDATED] GATT data saved for {device.address}: "
+                        f"{len(service_rows)} services, {len(characteristic_rows)} characteristics"
                     )
-
-                    print(f"[DEVICE UPDATED] GATT data saved in both tables for {device.address}")
-                    logging.info(f"GATT data saved for {device.address}")
-
-        except Exception as e:
-            print(f"[ERROR] Failed to connect to {device.address} on adapter {adapter}: {e}")
-            logging.error(f"Failed to connect to {device.address} on adapter {adapter}: {e}")
-        finally:
-            await asyncio.sleep(1)
+                logging.info(f"GATT data saved for {device.address}")
+                success = True
+                result = "success"
+
+    except Exception as e:
+        result = type(e).__name__
+        get_console().event(f"[ERROR] Failed to connect to {device.address} on adapter {adapter}: {e}")
+        logging.error(f"Failed to connect to {device.address} on adapter {adapter}: {e}")
+    finally:
+        metrics.CONNECTS.labels(adapter, result).inc()
+        metrics.CONNECT_DURATION.labels(adapter).observe(time.monotonic() - started)
+        await _cool_down(adapter, success)
+    return success
+
+async def _cool_down(adapter, success):
+    """Adaptive pause between connections on the same adapter."""
+    delay = _cooldown.get(adapter, 0.0)
+    if success:
+        delay = delay / 2 if delay > 0.05 else 0.0
+    else:
+        delay = min(max(delay * 2, utils.CONNECT_COOLDOWN_MIN), utils.CONNECT_COOLDOWN_MAX)
+    _cooldown[adapter] = delay
+    if delay:
+        await asyncio.sleep(delay)
 
@@ -0,0 +1,290 @@
+# modules/device_registry.py
+
+import asyncio
+import time
+import struct
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+
+from . import utils
+from .database import upsert_devices, commit_pending, load_recent_devices, load_devices
+from .sightings import scale_coordinate
+from .adv_codec import (
+    encode_manufacturer_data,
+    decode_manufacturer_data,
+    encode_service_uuids,
+    decode_service_uuids,
+    encode_service_data,
+    decode_service_data,
+)
+
+# Bits in DeviceRecord.adv_changed: advertisement fields not yet written
+ADV_MANUFACTURER = 1
+ADV_SERVICE_UUIDS = 2
+ADV_SERVICE_DATA = 4
+ADV_TX_POWER = 8
+
+_registry = None
+
+@lru_cache(maxsize=16384)
+def mac_to_int(mac):
+    """'AA:BB:CC:DD:EE:FF' -> 48-bit integer. Cached: called for every advert."""
+    return int(mac.replace(":", "").replace("-", ""), 16)
+
+def int_to_mac(value):
+    """48-bit integer -> 'AA:BB:CC:DD:EE:FF'."""
+    raw = f"{value:012X}"
+    return ":".join(raw[i:i + 2] for i in range(0, 12, 2))
+
+class DeviceRecord:
+    """
+    Compact per-device state kept in memory between flushes. 'gps' is the
+    last (latitude, longitude) fix in degrees, or None.
+    """
+
+    __slots__ = (
+        "mac", "name", "adapter", "rssi", "gps",
+        "first_seen", "last_seen", "count", "last_count_update", "dirty",
+        # Last advertisement payload as received from bleak (no copies)
+        "manufacturer_data", "service_uuids", "service_data", "tx_power",
+        "adv_changed",
+        # Timestamp of the last row written to the sightings log
+        "logged_at",
+    )
+
+    def __init__(self, mac, name, adapter, rssi, gps, first_seen, last_seen,
+                 count=1, last_count_update=None, dirty=True):
+        self.mac = mac
+        self.name = name
+        self.adapter = adapter
+        self.rssi = rssi
+        self.gps = gps
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.count = count
+        self.last_count_update = last_count_update if last_count_update is not None else last_seen
+        self.dirty = dirty
+        self.manufacturer_data = None
+        self.service_uuids = None
+        self.service_data = None
+        self.tx_power = None
+        self.adv_changed = 0
+        self.logged_at = 0
+
+    def update_advertisement(self, advertisement_data):
+        """
+        Keep references to the advert fields and flag the ones that differ
+        from what was seen before. Encoding is deferred to as_row().
+        """
+        manufacturer_data = advertisement_data.manufacturer_data
+        if manufacturer_data and manufacturer_data != self.manufacturer_data:
+            self.manufacturer_data = manufacturer_data
+            self.adv_changed |= ADV_MANUFACTURER
+        service_uuids = advertisement_data.service_uuids
+        if service_uuids and service_uuids != self.service_uuids:
+            self.service_uuids = service_uuids
+            self.adv_changed |= ADV_SERVICE_UUIDS
+        service_data = advertisement_data.service_data
+        if service_data and service_data != self.service_data:
+            self.service_data = service_data
+            self.adv_changed |= ADV_SERVICE_DATA
+        tx_power = advertisement_data.tx_power
+        if tx_power is not None and tx_power != self.tx_power:
+            self.tx_power = tx_power
+            self.adv_changed |= ADV_TX_POWER
+
+    def as_row(self):
+        """Row in database.DEVICE_COLUMNS order; unchanged advert fields are None."""
+        changed = self.adv_changed
+        self.adv_changed = 0
+        return (
+            self.name, int_to_mac(self.mac), self.rssi, self.last_seen, self.adapter,
+            encode_manufacturer_data(self.manufacturer_data) if changed & ADV_MANUFACTURER else None,
+            encode_service_uuids(self.service_uuids) if changed & ADV_SERVICE_UUIDS else None,
+            encode_service_data(self.service_data) if changed & ADV_SERVICE_DATA else None,
+            self.tx_power if changed & ADV_TX_POWER else None,
+            None, f"{self.gps[0]:.7f}, {self.gps[1]:.7f}" if self.gps else None, None, self.first_seen,
+            scale_coordinate(self.gps[0]) if self.gps else None,
+            scale_coordinate(self.gps[1]) if self.gps else None,
+        )
+
+def _record_from_row(row):
+    """DeviceRecord from a load_recent_devices()/load_devices() row, or None for a bad MAC."""
+    (mac, name, adapter, rssi, lat, lon, first_seen, last_seen, count, last_count_update,
+     manufacturer_data, service_uuids, service_data, tx_power) = row
+    try:
+        key = mac_to_int(mac)
+    except (ValueError, AttributeError):
+        return None
+    gps = (lat / 10_000_000, lon / 10_000_000) if lat is not None and lon is not None else None
+    record = DeviceRecord(
+        key, name, adapter, rssi, gps, first_seen, last_seen,
+        count or 1, last_count_update, dirty=False
+    )
+    # Decode stored payloads so an unchanged advert is not rewritten
+    try:
+        if isinstance(manufacturer_data, bytes):
+            record.manufacturer_data = decode_manufacturer_data(manufacturer_data)
+        if isinstance(service_uuids, bytes):
+            record.service_uuids = decode_service_uuids(service_uuids)
+        if isinstance(service_data, bytes):
+            record.service_data = decode_service_data(service_data)
+    except (IndexError, ValueError, struct.error):
+        pass
+    if tx_power is not None:
+        try:
+            record.tx_power = int(tx_power)
+        except ValueError:
+            pass
+    return record
+
+def load_stored(macs):
+    """DeviceRecords of those 'macs' in the database. Blocks: run it off the event loop."""
+    records = (_record_from_row(row) for row in load_devices(macs))
+    return [record for record in records if record is not None]
+
+class DeviceRegistry:
+    """
+    In-memory set of known devices keyed by 48-bit MAC. Answers "is this
+    device new?" without SQLite and writes dirty records back in batches.
+    Bounded by an LRU size limit and a last-seen TTL.
+    """
+
+    def __init__(self, max_devices=None, ttl=None, flush_interval=None):
+        self.max_devices = max_devices or utils.REGISTRY_MAX_DEVICES
+        self.ttl = ttl or utils.REGISTRY_TTL
+        self.flush_interval = flush_interval or utils.REGISTRY_FLUSH_INTERVAL
+        self._records = OrderedDict()
+        # Dirty records evicted before they were flushed
+        self._evicted = []
+        self._last_flush = time.monotonic()
+        # Sightings passed to observe() since start
+        self.observations = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, mac):
+        return self._records.get(mac_to_int(mac))
+
+    def records(self):
+        """All records, least recently seen first (a copy of the list)."""
+        return list(self._records.values())
+
+    def warm_load(self):
+        """Load devices seen within the TTL from the database."""
+        since = int(time.time()) - self.ttl
+        for row in load_recent_devices(since, self.max_devices):
+            record = _record_from_row(row)
+            if record is not None:
+                self._records[record.mac] = record
+        logging.info(f"Device registry warm-loaded {len(self._records)} devices")
+        return len(self._records)
+
+    def missing(self, macs):
+        """The 'macs' not in memory. Only reads the registry: safe from another thread."""
+        records = self._records
+        return [mac for mac in macs if mac_to_int(mac) not in records]
+
+    def add_stored(self, records):
+        """Add load_stored() records of devices still not in memory. Returns the number added."""
+        loaded = 0
+        for record in records:
+            if record.mac not in self._records:
+                self._records[record.mac] = record
+                loaded += 1
+                if len(self._records) > self.max_devices:
+                    self._evict_one()
+        return loaded
+
+    async def load_missing(self, macs):
+        """
+        Load the stored rows of the 'macs' not in memory, so a device last
+        seen before the TTL (or evicted) is not reported as new. One query,
+        in the executor so scanning goes on, and only when something is
+        missing. Returns the records loaded.
+        """
+        missing = self.missing(macs)
+        if not missing:
+            return 0
+        records = await asyncio.get_running_loop().run_in_executor(None, load_stored, missing)
+        return self.add_stored(records)
+
+    def observe(self, mac, name, rssi, timestamp, adapter, gps=None, advertisement_data=None):
+        """Record a sighting. Returns (record, is_new)."""
+        self.observations += 1
+        key = mac_to_int(mac)
+        record = self._records.get(key)
+        if record is None:
+            record = DeviceRecord(key, name, adapter, rssi, gps, timestamp, timestamp)
+            if advertisement_data is not None:
+                record.update_advertisement(advertisement_data)
+            self._records[key] = record
+            if len(self._records) > self.max_devices:
+                self._evict_one()
+            return record, True
+
+        # Already moved to the end by an earlier advert in this second
+        if record.last_seen != timestamp:
+            self._records.move_to_end(key)
+        if name is not None:
+            record.name = name
+        record.rssi = rssi
+        record.adapter = adapter
+        if gps is not None:
+            record.gps = gps
+        record.last_seen = timestamp
+        # Same rule as the SQL upsert
+        if timestamp - record.last_count_update >= utils.DETECTION_COUNT_INTERVAL:
+            record.count += 1
+            record.last_count_update = timestamp
+        if advertisement_data is not None:
+            record.update_advertisement(advertisement_data)
+        record.dirty = True
+        return record, False
+
+    def _evict_one(self):
+        _, record = self._records.popitem(last=False)
+        if record.dirty:
+            self._evicted.append(record)
+
+    def expire(self, now=None):
+        """Drop records not seen within the TTL (oldest are at the front)."""
+        cutoff = (now or int(time.time())) - self.ttl
+        expired = 0
+        while self._records:
+            record = next(iter(self._records.values()))
+            if record.last_seen >= cutoff:
+                break
+            self._evict_one()
+            expired += 1
+        return expired
+
+    def flush_due(self):
+        return time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self):
+        """Write dirty records back as one upsert batch. Returns the row count."""
+        rows = [record.as_row() for record in self._evicted]
+        self._evicted = []
+        for record in self._records.values():
+            if record.dirty:
+                rows.append(record.as_row())
+                record.dirty = False
+                # The next sighting after a flush is always logged
+                record.logged_at = 0
+        self._last_flush = time.monotonic()
+        if rows:
+            upsert_devices(rows)
+            commit_pending()
+        self.expire()
+        return len(rows)
+
+def get_registry():
+    """Return the shared registry, warm-loading it on first use."""
+    global _registry
+    if _registry is None:
+        _registry = DeviceRegistry()
+        _registry.warm_load()
+    return _registry
@@ -0,0 +1,402 @@
+# modules/export.py
+
+"""
+Export of the database without copying it off the Pi or stopping the
+scanner:
+
+    python -m modules.export devices sightings --format parquet --output exports/
+    python -m modules.export sightings --format csv --since 2024-05-01 --output exports/
+    python -m modules.export devices --format geojson --incremental --output exports/
+    python -m modules.export snapshot pible-copy.db
+
+All datasets of one run are read inside a single WAL read transaction, so
+they are consistent with each other and the live writer is never blocked.
+Rows are streamed in chunks of EXPORT_CHUNK_ROWS: memory does not grow
+with the size of the database.
+
+--incremental writes only what changed since the previous incremental
+run, as recorded in the watermark file (EXPORT_STATE):
+
+- devices, gatt: rows whose changed_at (write time) is at or after the
+  last exported one. Rows written in that same second are exported
+  again; consumers keep the latest row per MAC.
+- sightings: rows past the last exported rowid of each day partition.
+
+Parquet and Arrow IPC need pyarrow; CSV and GeoJSON need nothing.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sqlite3
+import struct
+import time
+
+from . import utils
+from .adv_codec import decode_manufacturer_data, decode_service_uuids, decode_service_data
+from .device_registry import int_to_mac
+from .geo_query import parse_time
+from .sightings import list_partitions
+
+FORMATS = ("csv", "geojson", "parquet", "arrow")
+
+# Dataset -> [(column, type)]; types: "str", "int", "float", "time" (epoch seconds)
+COLUMNS = {
+    "devices": [
+        ("mac", "str"), ("logical_id", "int"), ("name", "str"), ("rssi", "int"), ("adapter", "str"),
+        ("first_seen", "time"), ("last_seen", "time"), ("detection_count", "int"),
+        ("lat", "float"), ("lon", "float"), ("tx_power", "int"),
+        ("manufacturer_data", "str"), ("service_uuids", "str"), ("service_data", "str"),
+        ("changed_at", "time"),
+    ],
+    "sightings": [
+        ("mac", "str"), ("ts", "time"), ("rssi", "int"), ("lat", "float"), ("lon", "float"), ("adapter", "str"),
+    ],
+    "gatt": [
+        ("mac", "str"), ("captured_at", "time"), ("service_uuid", "str"), ("handle", "int"),
+        ("uuid", "str"), ("value", "str"), ("error", "str"),
+    ],
+}
+
+def open_snapshot(path=None):
+    """
+    Read-only connection with an open read transaction: every query on it
+    sees the database as of this call, whatever the writer does meanwhile.
+    """
+    connection = sqlite3.connect(f"file:{path or utils.DB_PATH}?mode=ro", uri=True, isolation_level=None)
+    connection.execute("BEGIN")
+    # The snapshot starts with the first read, not with BEGIN
+    connection.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    return connection
+
+def backup(target, path=None):
+    """
+    Consistent copy of the whole database into 'target' with the SQLite
+    online backup API. Returns the target size in bytes.
+    """
+    source = sqlite3.connect(f"file:{path or utils.DB_PATH}?mode=ro", uri=True)
+    destination = sqlite3.connect(target)
+    try:
+        # All pages in one step: a stepwise backup restarts whenever the
+        # scanner commits, and in WAL mode one long read blocks nobody
+        source.backup(destination, pages=-1)
+    finally:
+        destination.close()
+        source.close()
+    return os.path.getsize(target)
+
+# --- Row sources: (rows iterator of chunks, new watermark) ---
+
+def _degrees(value):
+    return value / 10_000_000 if value is not None else None
+
+def _blob_text(value, decode):
+    """Advert payload as text: decoded from the binary encoding, legacy text as it is."""
+    if value is None or not isinstance(value, bytes):
+        return value
+    try:
+        decoded = decode(value)
+    except (IndexError, ValueError, struct.error):
+        return value.hex()
+    if isinstance(decoded, dict):
+        return json.dumps({str(key): data.hex() for key, data in decoded.items()})
+    return ";".join(decoded)
+
+def _int_or_none(value):
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+def _chunks(cursor, convert):
+    while True:
+        rows = cursor.fetchmany(utils.EXPORT_CHUNK_ROWS)
+        if not rows:
+            return
+        yield [convert(row) for row in rows]
+
+def _devices(connection, watermark, since, until):
+    where, params = [], []
+    if watermark is not None:
+        where.append("changed_at >= ?")
+        params.append(watermark)
+    if since is not None:
+        where.append("timestamp >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("timestamp <= ?")
+        params.append(until)
+    new_watermark = connection.execute("SELECT MAX(changed_at) FROM devices").fetchone()[0]
+    cursor = connection.execute(f'''
+        SELECT d.mac, a.logical_id, d.name, d.rssi, d.adapter, d.first_seen, d.timestamp, d.detection_count,
+               d.lat, d.lon, d.tx_power, d.manufacturer_data, d.service_uuids, d.service_data, d.changed_at
+        FROM devices d LEFT JOIN mac_aliases a ON a.mac = d.mac
+        {"WHERE " + " AND ".join(where) if where else ""}
+    ''', params)
+
+    def convert(row):
+        return (
+            row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], _degrees(row[8]), _degrees(row[9]),
+            _int_or_none(row[10]), _blob_text(row[11], decode_manufacturer_data),
+            _blob_text(row[12], decode_service_uuids), _blob_text(row[13], decode_service_data), row[14],
+        )
+
+    return _chunks(cursor, convert), new_watermark if new_watermark is not None else watermark
+
+def _sightings(connection, watermark, since, until):
+    """watermark: {partition: last exported rowid}."""
+    watermark = dict(watermark or {})
+    first = time.strftime("sightings_%Y%m%d", time.gmtime(since)) if since is not None else None
+    last = time.strftime("sightings_%Y%m%d", time.gmtime(until)) if until is not None else None
+    partitions = [
+        name for name in list_partitions(connection.cursor())
+        if (first is None or name >= first) and (last is None or name <= last)
+    ]
+    adapters = dict(connection.execute("SELECT id, name FROM adapters").fetchall())
+    # Upper bounds fixed now, so the watermark matches exactly what is exported
+    bounds = {
+        name: connection.execute(f"SELECT MAX(rowid) FROM {name}").fetchone()[0] or 0
+        for name in partitions
+    }
+    new_watermark = dict(watermark)
+    new_watermark.update(bounds)
+
+    def convert(row):
+        return (int_to_mac(row[0]), row[1], row[2], _degrees(row[3]), _degrees(row[4]), adapters.get(row[5]))
+
+    def rows():
+        for name in partitions:
+            cursor = connection.execute(f'''
+                SELECT mac_id, ts, rssi, lat, lon, adapter_id FROM {name}
+                WHERE rowid > ? AND rowid <= ? AND ts >= ? AND ts <= ?
+                ORDER BY rowid
+            ''', (watermark.get(name, 0), bounds[name],
+                  since if since is not None else 0, until if until is not None else 2 ** 62))
+            yield from _chunks(cursor, convert)
+
+    return rows(), new_watermark
+
+def _gatt(connection, watermark, since, until):
+    where, params = [], []
+    if watermark is not None:
+        where.append("g.changed_at >= ?")
+        params.append(watermark)
+    if since is not None:
+        where.append("g.updated_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("g.updated_at <= ?")
+        params.append(until)
+    new_watermark = connection.execute("SELECT MAX(changed_at) FROM gatt_services").fetchone()[0]
+    cursor = connection.execute(f'''
+        SELECT v.mac, g.updated_at, s.uuid, v.handle, v.uuid, v.value, v.error
+        FROM gatt_services g
+        JOIN characteristic_values v ON v.mac = g.mac
+        LEFT JOIN characteristics c ON c.layout_hash = g.layout_hash AND c.handle = v.handle
+        LEFT JOIN services s ON s.layout_hash = g.layout_hash AND s.handle = c.service_handle
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY v.mac, v.handle
+    ''', params)
+
+    def convert(row):
+        value = row[5]
+        return row[:5] + (value.hex() if isinstance(value, bytes) else value, row[6])
+
+    return _chunks(cursor, convert), new_watermark if new_watermark is not None else watermark
+
+_SOURCES = {"devices": _devices, "sightings": _sightings, "gatt": _gatt}
+
+# --- Writers: write(chunk) for every chunk, then close() ---
+
+class _CsvWriter:
+    def __init__(self, path, columns):
+        self._file = open(path, "w", newline="", encoding="utf-8")
+        self._csv = csv.writer(self._file)
+        self._csv.writerow([name for name, _ in columns])
+
+    def write(self, rows):
+        self._csv.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+class _GeoJsonWriter:
+    """FeatureCollection of points, one feature per line; rows without a fix are skipped."""
+
+    def __init__(self, path, columns):
+        names = [name for name, _ in columns]
+        if "lat" not in names:
+            raise ValueError("this dataset has no coordinates, GeoJSON is not available")
+        self._names = names
+        self._lat = names.index("lat")
+        self._lon = names.index("lon")
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write('{"type": "FeatureCollection", "features": [\n')
+        self._first = True
+        self.skipped = 0
+
+    def write(self, rows):
+        lines = []
+        for row in rows:
+            lat, lon = row[self._lat], row[self._lon]
+            if lat is None or lon is None:
+                self.skipped += 1
+                continue
+            properties = {
+                name: value for index, (name, value) in enumerate(zip(self._names, row))
+                if index not in (self._lat, self._lon)
+            }
+            lines.append(json.dumps({
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": properties,
+            }))
+        if lines:
+            self._file.write(("" if self._first else ",\n") + ",\n".join(lines))
+            self._first = False
+
+    def close(self):
+        self._file.write("\n]}\n")
+        self._file.close()
+
+def _arrow_schema(pa, columns):
+    types = {"str": pa.string(), "int": pa.int64(), "float": pa.float64(), "time": pa.timestamp("s", tz="UTC")}
+    return pa.schema([(name, types[kind]) for name, kind in columns])
+
+class _ArrowWriter:
+    """Parquet (one row group per chunk) or Arrow IPC file (one record batch per chunk)."""
+
+    def __init__(self, path, columns, parquet):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ValueError("Parquet and Arrow output need pyarrow (pip install pyarrow)")
+        self._pa = pa
+        self._schema = _arrow_schema(pa, columns)
+        if parquet:
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(path, self._schema, compression="zstd")
+        else:
+            import pyarrow.ipc
+            self._sink = pa.OSFile(path, "wb")
+            self._writer = pyarrow.ipc.new_file(self._sink, self._schema)
+        self._parquet = parquet
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        batch = self._pa.RecordBatch.from_arrays(
+            [self._pa.array(values, type=field.type) for values, field in zip(columns, self._schema)],
+            schema=self._schema,
+        )
+        if self._parquet:
+            self._writer.write_table(self._pa.Table.from_batches([batch]))
+        else:
+            self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+        if not self._parquet:
+            self._sink.close()
+
+def _open_writer(path, fmt, columns):
+    if fmt == "csv":
+        return _CsvWriter(path, columns)
+    if fmt == "geojson":
+        return _GeoJsonWriter(path, columns)
+    return _ArrowWriter(path, columns, parquet=(fmt == "parquet"))
+
+# --- Watermarks ---
+
+def load_watermarks(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_watermarks(path, watermarks):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(watermarks, f, indent=1)
+    os.replace(temporary, path)
+
+def export(datasets, output_dir, fmt="csv", incremental=False, since=None, until=None,
+           state_path=None, db_path=None):
+    """
+    Write each dataset to output_dir/<dataset>[-<time>].<ext> from one
+    snapshot. With 'incremental', only rows past the saved watermarks
+    are written and the watermarks are advanced once every file is
+    complete. Returns {dataset: (path, rows)}.
+    """
+    state_path = state_path or utils.EXPORT_STATE
+    watermarks = load_watermarks(state_path) if incremental else {}
+    os.makedirs(output_dir, exist_ok=True)
+    suffix = time.strftime("-%Y%m%dT%H%M%S") if incremental else ""
+    connection = open_snapshot(db_path)
+    results = {}
+    new_watermarks = dict(watermarks)
+    try:
+        for dataset in datasets:
+            columns = COLUMNS[dataset]
+            chunks, watermark = _SOURCES[dataset](connection, watermarks.get(dataset), since, until)
+            path = os.path.join(output_dir, f"{dataset}{suffix}.{fmt}")
+            writer = _open_writer(path, fmt, columns)
+            count = 0
+            try:
+                for rows in chunks:
+                    writer.write(rows)
+                    count += len(rows)
+            finally:
+                writer.close()
+            results[dataset] = (path, count)
+            new_watermarks[dataset] = watermark
+            logging.info(f"Exported {count} {dataset} rows to {path}")
+    finally:
+        connection.execute("COMMIT")
+        connection.close()
+    if incremental:
+        save_watermarks(state_path, new_watermarks)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the database from a consistent snapshot.")
+    parser.add_argument("datasets", nargs="+", metavar="DATASET",
+                        help=f"One or more of {', '.join(COLUMNS)}; or 'snapshot FILE' for a full copy.")
+    parser.add_argument("--db", help=f"Database file (default: {utils.DB_PATH}).")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--output", default=".", help="Output directory (default: current directory).")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only rows changed since the last incremental export.")
+    parser.add_argument("--state", help=f"Watermark file for --incremental (default: {utils.EXPORT_STATE}).")
+    parser.add_argument("--since", type=parse_time, help="Epoch seconds or 'YYYY-MM-DD[ HH:MM]'.")
+    parser.add_argument("--until", type=parse_time, help="Epoch seconds or 'YYYY-MM-DD[ HH:MM]'.")
+    args = parser.parse_args(argv)
+    if args.db:
+        utils.DB_PATH = args.db
+
+    started = time.perf_counter()
+    if args.datasets[0] == "snapshot":
+        if len(args.datasets) != 2:
+            parser.error("usage: snapshot FILE")
+        size = backup(args.datasets[1])
+        print(f"Copied {size // 1024} kB to {args.datasets[1]} in {time.perf_counter() - started:.1f} s")
+        return
+    unknown = [dataset for dataset in args.datasets if dataset not in COLUMNS]
+    if unknown:
+        parser.error(f"unknown dataset: {', '.join(unknown)}")
+    if args.incremental and (args.since is not None or args.until is not None):
+        # The watermark would move past the rows the time filter left out
+        parser.error("--incremental can't be combined with --since/--until")
+    try:
+        results = export(args.datasets, args.output, args.format, args.incremental,
+                         args.since, args.until, args.state)
+    except (ValueError, sqlite3.Error) as e:
+        parser.exit(1, f"export failed: {e}\n")
+    for dataset, (path, count) in results.items():
+        print(f"{dataset}: {count} rows -> {path}")
+    print(f"Done in {time.perf_counter() - started:.1f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# modules/gatt_layout.py
+
+import hashlib
+import struct
+
+# Characteristic property names reported by bleak -> bitmask.
+# The low byte matches the GATT characteristic properties field.
+PROPERTY_BITS = {
+    "broadcast": 0x01,
+    "read": 0x02,
+    "write-without-response": 0x04,
+    "write": 0x08,
+    "notify": 0x10,
+    "indicate": 0x20,
+    "authenticated-signed-writes": 0x40,
+    "extended-properties": 0x80,
+    "reliable-write": 0x100,
+    "writable-auxiliaries": 0x200,
+    "encrypt-read": 0x400,
+    "encrypt-write": 0x800,
+    "encrypt-authenticated-read": 0x1000,
+    "encrypt-authenticated-write": 0x2000,
+    "authorize": 0x4000,
+}
+
+def properties_to_mask(properties):
+    mask = 0
+    for name in properties:
+        mask |= PROPERTY_BITS.get(name, 0)
+    return mask
+
+def mask_to_properties(mask):
+    return [name for name, bit in PROPERTY_BITS.items() if mask & bit]
+
+def build_layout(services):
+    """
+    Turn bleak's client.services into rows for the 'services' and
+    'characteristics' tables plus a content hash of the layout.
+    Devices of the same model share the hash, so the layout is stored once.
+
+    Returns (layout_hash, service_rows, characteristic_rows) where
+    service_rows are (handle, uuid, description) and characteristic_rows
+    are (handle, service_handle, uuid, description, properties_mask).
+    """
+    service_rows = []
+    characteristic_rows = []
+    digest = hashlib.sha1()
+    for service in sorted(services, key=lambda s: s.handle):
+        service_rows.append((service.handle, service.uuid, service.description))
+        digest.update(struct.pack("<BH", 0, service.handle))
+        digest.update(service.uuid.encode())
+        for char in sorted(service.characteristics, key=lambda c: c.handle):
+            mask = properties_to_mask(char.properties)
+            characteristic_rows.append((char.handle, service.handle, char.uuid, char.description, mask))
+            digest.update(struct.pack("<BHI", 1, char.handle, mask))
+            digest.update(char.uuid.encode())
+    return digest.digest(), service_rows, characteristic_rows
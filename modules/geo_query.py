@@ -0,0 +1,312 @@
+# modules/geo_query.py
+
+"""
+Geo queries over the sightings partitions, answered from the per-day
+R-trees (modules/sightings.py) instead of scanning rows:
+
+    python -m modules.geo_query radius 55.7512 37.6184 250 --since "2024-05-01"
+    python -m modules.geo_query bbox 55.74 37.60 55.76 37.64 --since "2024-05-01 10:00" --until "2024-05-01 12:00"
+    python -m modules.geo_query heatmap 55.70 37.50 55.80 37.70 --cell 100 --geojson heat.geojson
+
+Sightings newer than the last rollup are not in the R-tree yet; they are
+read from the partition tail by rowid, which is always small.
+"""
+
+import argparse
+import json
+import math
+import time
+
+from . import utils
+from .database import read_connection
+from .device_registry import int_to_mac
+from .sightings import (
+    list_partitions,
+    partition_name,
+    partition_day_start,
+    has_geo_index,
+    scale_coordinate,
+    cell_sql,
+    HEAT_CELL,
+)
+
+# Metres per degree of latitude
+_METRES_PER_DEGREE = 111_320
+_DAY = 24 * 3600
+
+def _partitions(cursor, since, until):
+    first = partition_name(since) if since is not None else None
+    last = partition_name(until) if until is not None else None
+    return [
+        name for name in list_partitions(cursor)
+        if (first is None or name >= first) and (last is None or name <= last)
+    ]
+
+def _window(name, since, until):
+    """Seconds-into-day range of the partition covered by [since, until]."""
+    day = partition_day_start(name)
+    start = max(since - day, 0) if since is not None else 0
+    end = min(until - day, _DAY) if until is not None else _DAY
+    return day, start, end
+
+def _box_query(cursor, name, select, box, since, until, extra_where="", extra_params=(), group_by=""):
+    """
+    Run 'select' over the sightings of partition 'name' inside 'box'
+    (scaled min_lat, max_lat, min_lon, max_lon) and [since, until]. 'select'
+    refers to the sighting columns as s.*. Yields result rows of both the
+    indexed part and the not-yet-indexed tail.
+    """
+    min_lat, max_lat, min_lon, max_lon = box
+    day, start, end = _window(name, since, until)
+    params = (min_lat, max_lat, min_lon, max_lon, day + start, day + end) + tuple(extra_params)
+    tail_where = '''
+        s.lat BETWEEN ? AND ? AND s.lon BETWEEN ? AND ? AND s.ts BETWEEN ? AND ?
+    ''' + extra_where
+
+    if not has_geo_index(cursor, name):
+        # No R-tree in this SQLite build: the (lat, lon) index narrows the scan
+        yield from cursor.execute(
+            f'SELECT {select} FROM {name} s INDEXED BY idx_{name}_latlon WHERE {tail_where} {group_by}', params
+        )
+        return
+
+    row = cursor.execute('SELECT last_rowid FROM rollup_state WHERE partition = ?', (name,)).fetchone()
+    indexed = row[0] if row else 0
+    yield from cursor.execute(f'''
+        SELECT {select} FROM {name}_geo g JOIN {name} s ON s.rowid = g.id
+        WHERE g.min_lat >= ? AND g.max_lat <= ? AND g.min_lon >= ? AND g.max_lon <= ?
+          AND g.min_t >= ? AND g.max_t <= ? {extra_where}
+        {group_by}
+    ''', (min_lat, max_lat, min_lon, max_lon, start, end) + tuple(extra_params))
+    # NOT INDEXED keeps the planner on the rowid range instead of idx_*_mac
+    yield from cursor.execute(
+        f'SELECT {select} FROM {name} s NOT INDEXED WHERE s.rowid > ? AND {tail_where} {group_by}',
+        (indexed,) + params
+    )
+
+def _scaled_box(min_lat, min_lon, max_lat, max_lon):
+    return (scale_coordinate(min_lat), scale_coordinate(max_lat),
+            scale_coordinate(min_lon), scale_coordinate(max_lon))
+
+def _merge_devices(rows):
+    """Per-partition (mac_id, count, first, last, best rssi) rows -> one dict per device."""
+    devices = {}
+    for mac_id, count, first, last, rssi in rows:
+        current = devices.get(mac_id)
+        if current is None:
+            devices[mac_id] = [count, first, last, rssi]
+        else:
+            current[0] += count
+            current[1] = min(current[1], first)
+            current[2] = max(current[2], last)
+            if rssi is not None and (current[3] is None or rssi > current[3]):
+                current[3] = rssi
+    return devices
+
+def _named(cursor, devices, limit):
+    """Sort by last sighting, attach names from the devices table."""
+    ordered = sorted(devices.items(), key=lambda item: item[1][2], reverse=True)
+    if limit:
+        ordered = ordered[:limit]
+    macs = [int_to_mac(mac_id) for mac_id, _ in ordered]
+    names = {}
+    for i in range(0, len(macs), 500):
+        chunk = macs[i:i + 500]
+        names.update(cursor.execute(
+            f'SELECT mac, name FROM devices WHERE mac IN ({",".join("?" * len(chunk))})', chunk
+        ).fetchall())
+    return [
+        {"mac": mac, "name": names.get(mac), "sightings": count,
+         "first_seen": first, "last_seen": last, "best_rssi": rssi}
+        for mac, (_, (count, first, last, rssi)) in zip(macs, ordered)
+    ]
+
+def devices_in_bbox(min_lat, min_lon, max_lat, max_lon, since=None, until=None, limit=None):
+    """Devices sighted inside the box during [since, until] (epoch seconds)."""
+    cursor = read_connection().cursor()
+    box = _scaled_box(min_lat, min_lon, max_lat, max_lon)
+    rows = []
+    for name in _partitions(cursor, since, until):
+        rows.extend(_box_query(
+            cursor, name, 's.mac_id, COUNT(*), MIN(s.ts), MAX(s.ts), MAX(s.rssi)', box, since, until,
+            group_by='GROUP BY s.mac_id'
+        ))
+    return _named(cursor, _merge_devices(rows), limit)
+
+def devices_within_radius(latitude, longitude, radius, since=None, until=None, limit=None):
+    """
+    Devices sighted within 'radius' metres of the point. The R-tree narrows
+    the search to the enclosing box; the exact cut uses an equirectangular
+    distance computed in SQL (accurate to well under 1% below ~50 km).
+    """
+    cursor = read_connection().cursor()
+    dlat = radius / _METRES_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    dlon = dlat / cos_lat
+    box = _scaled_box(latitude - dlat, longitude - dlon, latitude + dlat, longitude + dlon)
+    centre_lat, centre_lon = scale_coordinate(latitude), scale_coordinate(longitude)
+    limit_sq = scale_coordinate(dlat) ** 2
+    distance = '''
+        AND (s.lat - ?) * (s.lat - ?) + (s.lon - ?) * (s.lon - ?) * ? <= ?
+    '''
+    params = (centre_lat, centre_lat, centre_lon, centre_lon, cos_lat * cos_lat, limit_sq)
+    rows = []
+    for name in _partitions(cursor, since, until):
+        rows.extend(_box_query(
+            cursor, name, 's.mac_id, COUNT(*), MIN(s.ts), MAX(s.ts), MAX(s.rssi)', box, since, until,
+            extra_where=distance, extra_params=params, group_by='GROUP BY s.mac_id'
+        ))
+    return _named(cursor, _merge_devices(rows), limit)
+
+def _exact_heatmap(cursor, box, cos_lat, cell, since, until):
+    cell_lat = max(scale_coordinate(cell / _METRES_PER_DEGREE), 1)
+    cell_lon = max(scale_coordinate(cell / _METRES_PER_DEGREE / cos_lat), 1)
+    select = f'(s.lat - {box[0]}) / {cell_lat}, (s.lon - {box[2]}) / {cell_lon}, COUNT(*)'
+    counts = {}
+    for name in _partitions(cursor, since, until):
+        for y, x, count in _box_query(cursor, name, select, box, since, until, group_by='GROUP BY 1, 2'):
+            counts[(y, x)] = counts.get((y, x), 0) + count
+    return [
+        ((box[0] + y * cell_lat) / 10_000_000, (box[2] + x * cell_lon) / 10_000_000, count)
+        for (y, x), count in counts.items()
+    ]
+
+def _grid_heatmap(cursor, box, cos_lat, cell, since, until):
+    """Sum pre-aggregated heat_cells; only the un-rolled-up tail is read row by row."""
+    k_lat = max(round(cell / _METRES_PER_DEGREE * 10_000_000 / HEAT_CELL), 1)
+    k_lon = max(round(cell / _METRES_PER_DEGREE / cos_lat * 10_000_000 / HEAT_CELL), 1)
+    cy0, cy1 = box[0] // HEAT_CELL, box[1] // HEAT_CELL
+    cx0, cx1 = box[2] // HEAT_CELL, box[3] // HEAT_CELL
+    first_hour = since // 3600 * 3600 if since is not None else None
+    counts = {}
+    rows = cursor.execute('''
+        SELECT (cy - ?1) / ?2, (cx - ?3) / ?4, SUM(count) FROM heat_cells
+        WHERE cy BETWEEN ?1 AND ?5 AND cx BETWEEN ?3 AND ?6
+          AND (?7 IS NULL OR hour >= ?7) AND (?8 IS NULL OR hour <= ?8)
+        GROUP BY 1, 2
+    ''', (cy0, k_lat, cx0, k_lon, cy1, cx1, first_hour, until))
+    for y, x, count in rows:
+        counts[(y, x)] = count
+
+    select = (f'({cell_sql("s.lat")} - {cy0}) / {k_lat}, ({cell_sql("s.lon")} - {cx0}) / {k_lon}, COUNT(*)')
+    tail_box = (cy0 * HEAT_CELL, (cy1 + 1) * HEAT_CELL - 1, cx0 * HEAT_CELL, (cx1 + 1) * HEAT_CELL - 1)
+    for name in _partitions(cursor, since, until):
+        if not has_geo_index(cursor, name):
+            continue
+        row = cursor.execute('SELECT last_rowid FROM rollup_state WHERE partition = ?', (name,)).fetchone()
+        day, start, end = _window(name, since, until)
+        for y, x, count in cursor.execute(f'''
+            SELECT {select} FROM {name} s NOT INDEXED
+            WHERE s.rowid > ? AND s.lat BETWEEN ? AND ? AND s.lon BETWEEN ? AND ? AND s.ts BETWEEN ? AND ?
+            GROUP BY 1, 2
+        ''', (row[0] if row else 0,) + tail_box + (day + start, day + end)):
+            counts[(y, x)] = counts.get((y, x), 0) + count
+    return [
+        ((cy0 + y * k_lat) * HEAT_CELL / 10_000_000, (cx0 + x * k_lon) * HEAT_CELL / 10_000_000, count)
+        for (y, x), count in counts.items()
+    ]
+
+def heatmap(min_lat, min_lon, max_lat, max_lon, cell=100, since=None, until=None, exact=False):
+    """
+    Sighting density on a grid of about 'cell' x 'cell' metre cells over the
+    box. Returns [(cell south lat, cell west lon, count)], densest first.
+
+    By default the grid is built from heat_cells (0.001 degree cells per
+    hour), so the box edges snap to 0.001 degrees, 'since' to the hour and
+    cells to multiples of ~111 m. 'exact' (or a smaller cell) reads the
+    individual sightings through the R-trees instead.
+    """
+    cursor = read_connection().cursor()
+    box = _scaled_box(min_lat, min_lon, max_lat, max_lon)
+    cos_lat = max(math.cos(math.radians((min_lat + max_lat) / 2)), 1e-6)
+    if exact or cell < HEAT_CELL / 10_000_000 * _METRES_PER_DEGREE:
+        cells = _exact_heatmap(cursor, box, cos_lat, cell, since, until)
+    else:
+        cells = _grid_heatmap(cursor, box, cos_lat, cell, since, until)
+    return sorted(cells, key=lambda cell_row: cell_row[2], reverse=True)
+
+def _heatmap_geojson(cells, cell):
+    features = []
+    for lat, lon, count in cells:
+        dlat = cell / _METRES_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        ring = [[lon, lat], [lon + dlon, lat], [lon + dlon, lat + dlat], [lon, lat + dlat], [lon, lat]]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {"count": count},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+def parse_time(value):
+    """Epoch seconds, 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM[:SS]' (local time)."""
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return int(time.mktime(time.strptime(value, fmt)))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"invalid time: {value}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Geo queries over stored sightings.")
+    parser.add_argument("--db", help=f"Database file (default: {utils.DB_PATH}).")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    radius = sub.add_parser("radius", help="Devices seen within RADIUS metres of a point.")
+    radius.add_argument("lat", type=float)
+    radius.add_argument("lon", type=float)
+    radius.add_argument("radius", type=float, help="Metres.")
+    bbox = sub.add_parser("bbox", help="Devices seen inside a bounding box.")
+    heat = sub.add_parser("heatmap", help="Sighting density grid over a bounding box.")
+    for box_parser in (bbox, heat):
+        for arg in ("min_lat", "min_lon", "max_lat", "max_lon"):
+            box_parser.add_argument(arg, type=float)
+    heat.add_argument("--cell", type=float, default=100, help="Cell size in metres.")
+    heat.add_argument("--geojson", help="Write the grid as GeoJSON polygons to this file.")
+    heat.add_argument("--exact", action="store_true",
+                      help="Count individual sightings instead of the pre-aggregated hourly grid.")
+    for query_parser in (radius, bbox, heat):
+        query_parser.add_argument("--since", type=parse_time, help="Epoch seconds or 'YYYY-MM-DD[ HH:MM]'.")
+        query_parser.add_argument("--until", type=parse_time, help="Epoch seconds or 'YYYY-MM-DD[ HH:MM]'.")
+        query_parser.add_argument("--limit", type=int, default=100, help="Rows to print.")
+        query_parser.add_argument("--json", action="store_true", help="Print JSON.")
+    args = parser.parse_args(argv)
+    if args.db:
+        utils.DB_PATH = args.db
+
+    started = time.perf_counter()
+    if args.command == "radius":
+        result = devices_within_radius(args.lat, args.lon, args.radius, args.since, args.until, args.limit)
+    elif args.command == "bbox":
+        result = devices_in_bbox(args.min_lat, args.min_lon, args.max_lat, args.max_lon,
+                                 args.since, args.until, args.limit)
+    else:
+        result = heatmap(args.min_lat, args.min_lon, args.max_lat, args.max_lon, args.cell,
+                         args.since, args.until, args.exact)
+        if args.geojson:
+            with open(args.geojson, "w", encoding="utf-8") as f:
+                json.dump(_heatmap_geojson(result, args.cell), f)
+        result = result[:args.limit] if args.limit else result
+    elapsed = (time.perf_counter() - started) * 1000
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    if args.command == "heatmap":
+        for lat, lon, count in result:
+            print(f"{lat:.6f}, {lon:.6f}  {count}")
+    else:
+        for row in result:
+            print(f"{row['mac']}  {row['name'] or 'Unknown':<24} sightings: {row['sightings']:<6} "
+                  f"best RSSI: {row['best_rssi']}  last seen: "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(row['last_seen']))}")
+    print(f"{len(result)} rows in {elapsed:.1f} ms")
+
+if __name__ == "__main__":
+    main()
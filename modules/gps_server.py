@@ -1,58 +1,202 @@
 # modules/gps_server.py
 
-from flask import Flask, request, jsonify
-import threading
+import asyncio
+import calendar
+import json
+import logging
+import os
+import termios
 import time
+from datetime import datetime
 from termcolor import colored
-from . import utils  # Import utils for access to global variables and functions
-import logging
 
-app = Flask(__name__)
+from . import utils
+from .gps_track import get_gps_track
+from .console import get_console
+from .runtime import scanning
+from .http_server import route, json_body, start_http_server
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
-# Suppress Flask request logging
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
+def _record_fix(latitude, longitude, timestamp=None, source="http"):
+    try:
+        get_gps_track().add(latitude, longitude, timestamp)
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Ignoring GPS fix from {source}: {e}")
+        return False
+    logger.info(f"Received GPS data ({source}): Latitude={latitude}, Longitude={longitude}")
+    # Display GPS data only if scanning has started
+    if scanning():
+        get_console().event(f"{colored('[GPS DATA]', 'cyan')} Current Coordinates: {latitude}, {longitude}")
+    return True
+
+@route("POST", "/gps")
+def receive_gps(request):
+    """Body: {"latitude": .., "longitude": .., "timestamp": epoch seconds (optional)}."""
+    data = json_body(request)
+    if isinstance(data, dict) and _record_fix(data.get("latitude"), data.get("longitude"), data.get("timestamp")):
+        return 200, {"status": "success"}
+    logger.warning("Received invalid GPS data.")
+    return 400, {"status": "error", "message": "Invalid data"}
 
-def update_gps_status():
-    """Updates gps_status based on freshness of GPS data."""
+@route("GET", "/gps")
+def gps_status_route(request):
+    # Freshness is computed on demand instead of by a polling thread
+    return 200, {"status": "online" if get_gps_track().is_fresh() else "offline"}
+
+async def _read_gpsd(host, port):
+    """Follow gpsd's JSON stream; TPV reports with a 2D/3D fix become fixes."""
     while True:
-        if utils.is_gps_data_fresh():
-            utils.gps_status = "online"
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError as e:
+            logger.error(f"Cannot connect to gpsd at {host}:{port}: {e}")
+            await asyncio.sleep(5)
+            continue
+        logger.info(f"Connected to gpsd at {host}:{port}")
+        try:
+            writer.write(b'?WATCH={"enable":true,"json":true};\n')
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    report = json.loads(line)
+                except ValueError:
+                    continue
+                if report.get("class") != "TPV" or report.get("mode", 0) < 2 or "lat" not in report:
+                    continue
+                timestamp = None
+                if report.get("time"):
+                    try:
+                        timestamp = datetime.fromisoformat(report["time"].replace("Z", "+00:00")).timestamp()
+                    except ValueError:
+                        pass
+                _record_fix(report["lat"], report["lon"], timestamp, "gpsd")
+        except OSError as e:
+            logger.error(f"gpsd connection lost: {e}")
+        finally:
+            writer.close()
+        await asyncio.sleep(1)
+
+def _nmea_degrees(value, hemisphere):
+    """'4807.038', 'N' -> 48.1173."""
+    if not value:
+        return None
+    dot = value.index(".") if "." in value else len(value)
+    degrees = float(value[:dot - 2]) + float(value[dot - 2:]) / 60
+    return -degrees if hemisphere in ("S", "W") else degrees
+
+def parse_nmea(sentence):
+    """
+    (latitude, longitude, epoch timestamp) from an RMC or GGA sentence with
+    a valid fix, else None. GGA carries no date, so today's UTC date is used.
+    """
+    sentence = sentence.strip()
+    if not sentence.startswith("$"):
+        return None
+    body, _, checksum = sentence[1:].partition("*")
+    if checksum:
+        calculated = 0
+        for char in body:
+            calculated ^= ord(char)
+        try:
+            if calculated != int(checksum[:2], 16):
+                return None
+        except ValueError:
+            return None
+    fields = body.split(",")
+    kind = fields[0][2:]
+    try:
+        if kind == "RMC" and len(fields) >= 10 and fields[2] == "A":
+            latitude = _nmea_degrees(fields[3], fields[4])
+            longitude = _nmea_degrees(fields[5], fields[6])
+            clock, date = fields[1], fields[9]
+            year = int(date[4:6]) if len(date) == 6 else 0
+            timestamp = calendar.timegm((
+                year + (2000 if year < 80 else 1900), int(date[2:4]), int(date[0:2]),
+                int(clock[0:2]), int(clock[2:4]), int(clock[4:6]), 0, 0, 0
+            )) + float("0" + clock[6:]) if len(date) == 6 and len(clock) >= 6 else None
+        elif kind == "GGA" and len(fields) >= 7 and fields[6] not in ("", "0"):
+            latitude = _nmea_degrees(fields[2], fields[3])
+            longitude = _nmea_degrees(fields[4], fields[5])
+            clock = fields[1]
+            today = time.gmtime()
+            timestamp = calendar.timegm((
+                today.tm_year, today.tm_mon, today.tm_mday,
+                int(clock[0:2]), int(clock[2:4]), int(clock[4:6]), 0, 0, 0
+            )) + float("0" + clock[6:]) if len(clock) >= 6 else None
         else:
-            utils.gps_status = "offline"
-        time.sleep(1)
-
-@app.route('/gps', methods=['POST'])
-def receive_gps():
-    data = request.get_json()
-    if data:
-        latitude = data.get("latitude")
-        longitude = data.get("longitude")
-        utils.latest_gps_coords["latitude"] = latitude
-        utils.latest_gps_coords["longitude"] = longitude
-        utils.last_gps_update_time = time.time()
-        # Signal that GPS data has been received
-        utils.gps_data_received = True
-        logger.info(f"Received GPS data: Latitude={latitude}, Longitude={longitude}")
-        # Display GPS data only if scanning has started
-        if utils.scanning_started:
-            print(f"{colored('[GPS DATA]', 'cyan')} Current Coordinates: {latitude}, {longitude}")
-        return jsonify({"status": "success"}), 200
-    else:
-        logger.warning("Received invalid GPS data.")
-        return jsonify({"status": "error", "message": "Invalid data"}), 400
-
-@app.route('/gps', methods=['GET'])
-def gps_status_route():
-    return jsonify({"status": utils.gps_status}), 200
-
-def start_gps_server():
+            return None
+    except ValueError:
+        return None
+    if latitude is None or longitude is None:
+        return None
+    return latitude, longitude, timestamp
+
+_BAUD_RATES = {
+    4800: termios.B4800, 9600: termios.B9600, 19200: termios.B19200,
+    38400: termios.B38400, 57600: termios.B57600, 115200: termios.B115200,
+}
+
+def _open_serial(device, baud):
+    fd = os.open(device, os.O_RDONLY | os.O_NOCTTY)
+    try:
+        attrs = termios.tcgetattr(fd)
+        speed = _BAUD_RATES.get(baud, termios.B9600)
+        attrs[4] = attrs[5] = speed
+        # Canonical mode: the driver hands us whole lines
+        attrs[3] |= termios.ICANON
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    except termios.error:
+        # Not a tty (e.g. a FIFO or a replayed log): read it as is
+        pass
+    return os.fdopen(fd, "r", encoding="ascii", errors="replace")
+
+async def _read_nmea(device, baud):
+    """Read NMEA sentences from a serial GPS; blocking reads run in a thread."""
+    loop = asyncio.get_running_loop()
+    # RMC and GGA of one epoch carry the same position; keep one
+    last_timestamp = None
+    while True:
+        try:
+            port = await loop.run_in_executor(None, _open_serial, device, baud)
+        except OSError as e:
+            logger.error(f"Cannot open GPS device {device}: {e}")
+            await asyncio.sleep(5)
+            continue
+        logger.info(f"Reading NMEA from {device} at {baud} baud")
+        try:
+            while True:
+                line = await loop.run_in_executor(None, port.readline)
+                if not line:
+                    break
+                fix = parse_nmea(line)
+                if fix is None or (fix[2] is not None and fix[2] == last_timestamp):
+                    continue
+                last_timestamp = fix[2]
+                _record_fix(fix[0], fix[1], fix[2], "nmea")
+        except OSError as e:
+            logger.error(f"Error reading GPS device {device}: {e}")
+        finally:
+            port.close()
+        await asyncio.sleep(1)
+
+async def start_gps_source(source=None):
+    """
+    Start the configured GPS source in the running loop: "http" (POST /gps
+    on GPS_HTTP_HOST:GPS_HTTP_PORT), "gpsd" or "nmea" (GPS_SERIAL_DEVICE).
+    Returns the server or task so the caller can stop it.
+    """
+    source = source or utils.GPS_SOURCE
+    if source == "gpsd":
+        print(f"Reading GPS from gpsd at {utils.GPSD_HOST}:{utils.GPSD_PORT}...")
+        return asyncio.create_task(_read_gpsd(utils.GPSD_HOST, utils.GPSD_PORT))
+    if source == "nmea":
+        print(f"Reading GPS from {utils.GPS_SERIAL_DEVICE}...")
+        return asyncio.create_task(_read_nmea(utils.GPS_SERIAL_DEVICE, utils.GPS_SERIAL_BAUD))
     print("GPS server is starting...")
     logger.info("GPS server started.")
-    # Start thread to update gps_status
-    threading.Thread(target=update_gps_status, daemon=True).start()
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)
-
+    return await start_http_server(utils.GPS_HTTP_HOST, utils.GPS_HTTP_PORT)
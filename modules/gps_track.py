@@ -0,0 +1,93 @@
+# modules/gps_track.py
+
+import asyncio
+import bisect
+import time
+
+from . import utils
+
+_track = None
+
+class GpsTrack:
+    """
+    Ring buffer of the last GPS_BUFFER_SIZE fixes as (timestamp, latitude,
+    longitude) tuples, oldest first. The buffer is an immutable tuple that
+    add() replaces in one assignment, so snapshot() never needs a lock and
+    never sees a half-updated fix, whichever thread or task calls it.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or utils.GPS_BUFFER_SIZE
+        self._fixes = ()
+        # Created by wait_for_fix() inside the running loop
+        self._first_fix = None
+        self.received = 0
+
+    def add(self, latitude, longitude, timestamp=None):
+        latitude = float(latitude)
+        longitude = float(longitude)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError(f"coordinates out of range: {latitude}, {longitude}")
+        fix = (float(timestamp) if timestamp is not None else time.time(), latitude, longitude)
+        fixes = self._fixes
+        if fixes and fix[0] < fixes[-1][0]:
+            # Late fix (e.g. a phone flushing its queue): keep time order
+            fixes = tuple(sorted(fixes + (fix,)))
+        else:
+            fixes = fixes + (fix,)
+        self._fixes = fixes[-self.size:]
+        self.received += 1
+        if self._first_fix is not None:
+            self._first_fix.set()
+        return fix
+
+    def snapshot(self):
+        return self._fixes
+
+    def latest(self):
+        fixes = self._fixes
+        return fixes[-1] if fixes else None
+
+    def is_fresh(self, now=None):
+        latest = self.latest()
+        return latest is not None and (now or time.time()) - latest[0] <= utils.GPS_DATA_TIMEOUT
+
+    async def wait_for_fix(self):
+        if self._fixes:
+            return
+        if self._first_fix is None:
+            self._first_fix = asyncio.Event()
+        await self._first_fix.wait()
+
+    def fix_at(self, timestamp, fixes=None):
+        """
+        (latitude, longitude) at 'timestamp': linear interpolation between
+        the fixes around it when they are at most GPS_INTERPOLATE_MAX_GAP
+        apart, else the nearest fix within GPS_DATA_TIMEOUT, else None.
+        Pass 'fixes' (a snapshot) to resolve many timestamps consistently.
+        """
+        fixes = self._fixes if fixes is None else fixes
+        if not fixes:
+            return None
+        i = bisect.bisect_left(fixes, (timestamp,))
+        before = fixes[i - 1] if i > 0 else None
+        after = fixes[i] if i < len(fixes) else None
+        if after is not None and after[0] == timestamp:
+            return after[1], after[2]
+        if before is not None and after is not None and after[0] - before[0] <= utils.GPS_INTERPOLATE_MAX_GAP:
+            ratio = (timestamp - before[0]) / (after[0] - before[0])
+            return (before[1] + (after[1] - before[1]) * ratio,
+                    before[2] + (after[2] - before[2]) * ratio)
+        nearest = min(
+            (fix for fix in (before, after) if fix is not None),
+            key=lambda fix: abs(fix[0] - timestamp)
+        )
+        if abs(nearest[0] - timestamp) <= utils.GPS_DATA_TIMEOUT:
+            return nearest[1], nearest[2]
+        return None
+
+def get_gps_track():
+    global _track
+    if _track is None:
+        _track = GpsTrack()
+    return _track
@@ -0,0 +1,149 @@
+# modules/http_server.py
+
+"""
+Minimal HTTP/1.1 server on asyncio streams. It runs inside the scanner's
+event loop, so handlers read in-process state directly and must not block.
+
+Handlers are registered with @route(method, path) and receive a Request;
+they return (status, body) or (status, body, content_type[, headers]).
+A dict/list body is sent as JSON. A handler may instead return an async
+generator, whose chunks are streamed as text/event-stream (server-sent
+events) until the generator ends or the client goes away.
+"""
+
+import asyncio
+import inspect
+import json
+import logging
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+
+Request = namedtuple("Request", "method path query headers body")
+
+_REASONS = {
+    200: "OK", 204: "No Content", 304: "Not Modified", 400: "Bad Request",
+    404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+    500: "Internal Server Error", 503: "Service Unavailable",
+}
+MAX_BODY = 64 * 1024
+
+_routes = {}
+
+def route(method, path):
+    def register(handler):
+        _routes[(method, path)] = handler
+        return handler
+    return register
+
+def json_body(request):
+    """Decoded JSON body of 'request', or None if it is missing/invalid."""
+    try:
+        return json.loads(request.body or b"null")
+    except ValueError:
+        return None
+
+def _response(status, body, content_type="application/json", headers=None):
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode()
+    elif isinstance(body, str):
+        body = body.encode()
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}",
+             f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}",
+             "Connection: close"]
+    for name, value in (headers or {}).items():
+        lines.append(f"{name}: {value}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+def conditional(request, etag, body, content_type="application/json"):
+    """
+    200 with an ETag header, or an empty 304 if the client's If-None-Match
+    already names 'etag'. 'body' may be a callable, only built for a 200.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return 304, b"", content_type, headers
+    return 200, body() if callable(body) else body, content_type, headers
+
+def _stream_head():
+    return ("HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/event-stream\r\n"
+            "Cache-Control: no-cache\r\n"
+            "Connection: close\r\n\r\n").encode()
+
+async def _stream(writer, chunks):
+    try:
+        writer.write(_stream_head())
+        async for chunk in chunks:
+            writer.write(chunk.encode() if isinstance(chunk, str) else chunk)
+            await writer.drain()
+    except asyncio.CancelledError:
+        # Shutdown: nobody awaits the connection task, so don't let asyncio log the cancellation
+        pass
+    finally:
+        await chunks.aclose()
+
+async def _read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY:
+        raise OverflowError(length)
+    body = await reader.readexactly(length) if length else b""
+    url = urlsplit(target)
+    query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    return Request(method.upper(), url.path, query, headers, body)
+
+async def _handle(reader, writer):
+    try:
+        try:
+            request = await _read_request(reader)
+        except OverflowError:
+            writer.write(_response(413, {"status": "error", "message": "Body too large"}))
+            return
+        except (ValueError, asyncio.IncompleteReadError):
+            writer.write(_response(400, {"status": "error", "message": "Malformed request"}))
+            return
+        if request is None:
+            return
+
+        handler = _routes.get((request.method, request.path))
+        if handler is None:
+            allowed = sorted(method for method, path in _routes if path == request.path)
+            if allowed:
+                writer.write(_response(405, {"status": "error", "message": "Method not allowed"},
+                                       headers={"Allow": ", ".join(allowed)}))
+            else:
+                writer.write(_response(404, {"status": "error", "message": "Not found"}))
+            return
+        try:
+            result = handler(request)
+            if asyncio.iscoroutine(result):
+                result = await result
+        except Exception as e:
+            logging.error(f"HTTP handler error for {request.method} {request.path}: {e}")
+            result = (500, {"status": "error", "message": "Internal error"})
+        if inspect.isasyncgen(result):
+            await _stream(writer, result)
+            return
+        writer.write(_response(*result))
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_http_server(host, port):
+    """Start serving on host:port in the running loop; returns the asyncio server."""
+    server = await asyncio.start_server(_handle, host, port)
+    logging.info(f"HTTP server listening on {host}:{port}")
+    return server
@@ -0,0 +1,307 @@
+# modules/identity.py
+
+"""
+Identity resolution for devices with rotating random addresses.
+
+A phone using resolvable private addresses shows up under a new MAC
+every few minutes. Each MAC still gets its own row in 'devices', but all
+MACs of one device are mapped to one logical device (logical_devices +
+mac_aliases), and the connection scheduler skips a MAC whose logical
+device was already interrogated.
+
+Per advert the cost is one dict lookup. Only the first advert of an
+unknown random MAC is fingerprinted: a stable hash of the parts of the
+advert that do not change on rotation (manufacturer company ids, data
+length and type bytes, service UUIDs, service data keys, TX power). The
+fingerprint indexes the last IDENTITY_CANDIDATES logical devices with
+that fingerprint; the new MAC joins the one heard most recently, within
+IDENTITY_MAX_GAP seconds and IDENTITY_RSSI_DELTA dB of the new advert.
+
+A wrong merge (two identical devices next to each other) shows up as the
+older MAC being heard again after the rotation; the newer MAC is then
+split off into a logical device of its own.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict, deque
+
+from . import utils
+from . import metrics
+from .database import get_writer, commit_pending, load_identities
+
+_identities = None
+# Highest logical device id handed out; shared by all resolvers of the process
+_last_id = 0
+
+MERGES = metrics.Counter("pible_identity_merges_total", "New MACs attached to an existing logical device.")
+SPLITS = metrics.Counter("pible_identity_splits_total", "MACs split off a logical device after a wrong merge.")
+
+def _allocate_id():
+    global _last_id
+    _last_id += 1
+    return _last_id
+
+def address_type(device):
+    """BlueZ AddressType of a BLEDevice ("public" or "random"), or None if the backend doesn't report it."""
+    details = device.details
+    if isinstance(details, dict):
+        return (details.get("props") or {}).get("AddressType")
+    return None
+
+def is_rotating_address(mac, address_type=None):
+    """
+    True for random addresses that change over time: resolvable private
+    (top bits 01) and non-resolvable (top bits 00 with the locally
+    administered bit set). The bits only mean that for a random address:
+    a public address is never rotating, whatever its first octet. Without
+    an address type (non-BlueZ backends) the bits alone decide.
+    """
+    if address_type == "public":
+        return False
+    first = int(mac[:2], 16)
+    return first >> 6 == 0b01 or (first >> 6 == 0 and bool(first & 0x02))
+
+def fingerprint(advertisement_data):
+    """Stable 64-bit hash of the rotation-invariant advert fields, or None if there are none."""
+    manufacturer_data = advertisement_data.manufacturer_data
+    service_uuids = advertisement_data.service_uuids
+    service_data = advertisement_data.service_data
+    if not manufacturer_data and not service_uuids and not service_data:
+        return None
+    parts = []
+    for company_id in sorted(manufacturer_data or ()):
+        data = manufacturer_data[company_id]
+        # Length and type bytes survive rotation; the rest is often per-address
+        parts.append(f"m{company_id}:{len(data)}:{bytes(data[:2]).hex()}")
+    parts.extend(f"u{uuid}" for uuid in sorted(service_uuids or ()))
+    parts.extend(f"s{uuid}" for uuid in sorted(service_data or ()))
+    parts.append(f"t{advertisement_data.tx_power}")
+    digest = hashlib.blake2b("|".join(parts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+class LogicalDevice:
+    __slots__ = (
+        "id", "fingerprint", "mac", "first_seen", "last_seen", "rssi",
+        "mac_count", "interrogated_at", "rotated_at", "dirty",
+    )
+
+    def __init__(self, logical_id, fingerprint, mac, first_seen, last_seen, rssi=None,
+                 mac_count=1, interrogated_at=None, dirty=True):
+        self.id = logical_id
+        self.fingerprint = fingerprint
+        # The MAC the device currently advertises with
+        self.mac = mac
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+        self.rssi = rssi
+        self.mac_count = mac_count
+        self.interrogated_at = interrogated_at
+        self.rotated_at = first_seen
+        self.dirty = dirty
+
+    def as_row(self):
+        return (self.id, self.fingerprint, self.mac, self.first_seen, self.last_seen,
+                self.mac_count, self.interrogated_at)
+
+class _Alias:
+    __slots__ = ("logical_id", "first_seen", "last_seen", "dirty")
+
+    def __init__(self, logical_id, first_seen, last_seen=None, dirty=True):
+        self.logical_id = logical_id
+        self.first_seen = first_seen
+        self.last_seen = last_seen if last_seen is not None else first_seen
+        self.dirty = dirty
+
+class IdentityResolver:
+    """
+    MAC -> logical device, kept in memory like the DeviceRegistry (LRU
+    bound, write-behind flush) and written to logical_devices/mac_aliases.
+    """
+
+    def __init__(self, max_devices=None):
+        self.max_devices = max_devices or utils.REGISTRY_MAX_DEVICES
+        self._devices = OrderedDict()
+        self._aliases = OrderedDict()
+        # Fingerprint -> ids of the latest logical devices with it
+        self._index = {}
+        self._evicted = []
+        self._evicted_aliases = []
+
+    def __len__(self):
+        return len(self._devices)
+
+    def warm_load(self):
+        """Load identities seen within the registry TTL."""
+        global _last_id
+        since = int(time.time()) - utils.REGISTRY_TTL
+        devices, aliases, last_id = load_identities(since, self.max_devices)
+        _last_id = max(_last_id, last_id)
+        for logical_id, fingerprint_, mac, first_seen, last_seen, mac_count, interrogated_at in devices:
+            device = LogicalDevice(logical_id, fingerprint_, mac, first_seen, last_seen,
+                                   mac_count=mac_count or 1, interrogated_at=interrogated_at, dirty=False)
+            self._devices[logical_id] = device
+            if fingerprint_ is not None:
+                self._index_device(device)
+        for mac, logical_id, first_seen, last_seen in aliases:
+            if logical_id in self._devices:
+                self._aliases[mac] = _Alias(logical_id, first_seen, last_seen, dirty=False)
+        return len(self._devices)
+
+    def _index_device(self, device):
+        candidates = self._index.get(device.fingerprint)
+        if candidates is None:
+            candidates = self._index[device.fingerprint] = deque(maxlen=utils.IDENTITY_CANDIDATES)
+        candidates.append(device.id)
+
+    def _new_device(self, fingerprint_, mac, timestamp, rssi):
+        device = LogicalDevice(_allocate_id(), fingerprint_, mac, timestamp, timestamp, rssi)
+        self._devices[device.id] = device
+        if fingerprint_ is not None:
+            self._index_device(device)
+        if len(self._devices) > self.max_devices:
+            _, evicted = self._devices.popitem(last=False)
+            if evicted.dirty:
+                self._evicted.append(evicted)
+        return device
+
+    def _match(self, fingerprint_, rssi, timestamp):
+        """Logical device a new MAC with this fingerprint most likely belongs to, or None."""
+        best = None
+        for logical_id in self._index.get(fingerprint_, ()):
+            device = self._devices.get(logical_id)
+            if device is None or timestamp - device.last_seen > utils.IDENTITY_MAX_GAP:
+                continue
+            if device.rssi is not None and abs(rssi - device.rssi) > utils.IDENTITY_RSSI_DELTA:
+                continue
+            if best is None or device.last_seen > best.last_seen:
+                best = device
+        return best
+
+    def observe(self, mac, rssi, timestamp, advertisement_data, address_type=None):
+        """
+        Record an advert of 'mac'. Returns (logical device, is_new) where
+        is_new is False for a known MAC and for a new MAC of a known device.
+        'address_type' is the BlueZ AddressType, see is_rotating_address().
+        """
+        alias = self._aliases.get(mac)
+        device = self._devices.get(alias.logical_id) if alias is not None else None
+        if device is not None:
+            if alias.last_seen != timestamp:
+                self._aliases.move_to_end(mac)
+                alias.last_seen = timestamp
+                alias.dirty = True
+            if device.mac != mac and timestamp - device.rotated_at > utils.IDENTITY_SPLIT_GRACE:
+                # The old MAC is still alive: the newer one is another device
+                self._split(device, mac, timestamp)
+            device.rssi = rssi
+            if device.last_seen != timestamp:
+                self._devices.move_to_end(device.id)
+                device.last_seen = timestamp
+                device.dirty = True
+            return device, False
+
+        fingerprint_ = fingerprint(advertisement_data) if is_rotating_address(mac, address_type) else None
+        device = self._match(fingerprint_, rssi, timestamp) if fingerprint_ is not None else None
+        is_new = device is None
+        if is_new:
+            device = self._new_device(fingerprint_, mac, timestamp, rssi)
+        else:
+            MERGES.inc()
+            device.mac = mac
+            device.mac_count += 1
+            device.rotated_at = timestamp
+            device.rssi = rssi
+            device.last_seen = timestamp
+            device.dirty = True
+            self._devices.move_to_end(device.id)
+        self._aliases[mac] = _Alias(device.id, timestamp)
+        if len(self._aliases) > self.max_devices:
+            evicted_mac, evicted = self._aliases.popitem(last=False)
+            if evicted.dirty:
+                self._evicted_aliases.append((evicted_mac, evicted))
+        return device, is_new
+
+    def _split(self, device, mac, timestamp):
+        """Give device.mac (the MAC merged last) a logical device of its own; 'mac' is current again."""
+        SPLITS.inc()
+        newer = device.mac
+        alias = self._aliases.get(newer)
+        first_seen = alias.first_seen if alias is not None else device.rotated_at
+        split = self._new_device(device.fingerprint, newer, first_seen, None)
+        split.last_seen = alias.last_seen if alias is not None else device.rotated_at
+        if alias is not None:
+            alias.logical_id = split.id
+            alias.dirty = True
+        device.mac_count = max(device.mac_count - 1, 1)
+        device.mac = mac
+        device.rotated_at = timestamp
+        device.dirty = True
+
+    def get(self, mac):
+        alias = self._aliases.get(mac)
+        return self._devices.get(alias.logical_id) if alias is not None else None
+
+    def interrogated(self, mac, ttl):
+        """True if the logical device of 'mac' had its GATT table captured within 'ttl' seconds."""
+        device = self.get(mac)
+        return (device is not None and device.interrogated_at is not None
+                and time.time() - device.interrogated_at < ttl)
+
+    def mark_interrogated(self, mac, timestamp):
+        device = self.get(mac)
+        if device is not None:
+            device.interrogated_at = int(timestamp)
+            device.dirty = True
+
+    def flush(self):
+        """Write dirty logical devices and aliases. Returns the row count."""
+        device_rows = [device.as_row() for device in self._evicted]
+        self._evicted = []
+        for device in self._devices.values():
+            if device.dirty:
+                device_rows.append(device.as_row())
+                device.dirty = False
+        alias_rows = [(mac, alias.logical_id, alias.first_seen, alias.last_seen)
+                      for mac, alias in self._evicted_aliases]
+        self._evicted_aliases = []
+        for mac, alias in self._aliases.items():
+            if alias.dirty:
+                alias_rows.append((mac, alias.logical_id, alias.first_seen, alias.last_seen))
+                alias.dirty = False
+        writer = get_writer()
+        if device_rows:
+            writer.submit_many('''
+                INSERT INTO logical_devices (id, fingerprint, mac, first_seen, last_seen, mac_count, interrogated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    mac = excluded.mac,
+                    last_seen = excluded.last_seen,
+                    mac_count = excluded.mac_count,
+                    interrogated_at = COALESCE(excluded.interrogated_at, interrogated_at)
+            ''', device_rows)
+        if alias_rows:
+            writer.submit_many('''
+                INSERT INTO mac_aliases (mac, logical_id, first_seen, last_seen) VALUES (?, ?, ?, ?)
+                ON CONFLICT(mac) DO UPDATE SET
+                    logical_id = excluded.logical_id,
+                    last_seen = excluded.last_seen
+            ''', alias_rows)
+        if device_rows or alias_rows:
+            commit_pending()
+        self._prune_index()
+        return len(device_rows) + len(alias_rows)
+
+    def _prune_index(self):
+        """Drop fingerprints whose logical devices have all been evicted."""
+        devices = self._devices
+        for key in [key for key, ids in self._index.items() if not any(i in devices for i in ids)]:
+            del self._index[key]
+
+def get_identities():
+    """Return the shared resolver, warm-loading it on first use."""
+    global _identities
+    if _identities is None:
+        _identities = IdentityResolver()
+        _identities.warm_load()
+    return _identities
@@ -0,0 +1,271 @@
+# modules/metrics.py
+
+"""
+In-process counters, gauges and histograms, served in the Prometheus text
+format on GET /metrics (same HTTP server as /gps) and optionally dumped as
+JSON every METRICS_DUMP_INTERVAL seconds.
+
+Updating a metric is an attribute increment (plus a bisect for
+histograms) with no locking, so it stays on in production. Writers on
+other threads (the DB writer) may race a scrape; the worst case is a
+histogram whose buckets and count are one observation apart.
+
+Labelled metrics hand out a child per label tuple; hot paths look the
+child up once and keep it:
+
+    adverts = metrics.ADVERTS.labels(adapter)
+    adverts.inc()
+"""
+
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import time
+
+from . import utils
+from .http_server import route
+
+_metrics = {}
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # counts[i]: observations in (bounds[i - 1], bounds[i]]; the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        _metrics[name] = self
+        if not self.label_names:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def samples(self):
+        """[(label values, child)] at scrape time."""
+        return list(self._children.items())
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._function = None
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        """
+        Compute the value at scrape time instead: 'function' returns a
+        number, or {label value(s): number} for a labelled gauge.
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function is None:
+            return super().samples()
+        try:
+            value = self._function()
+        except Exception as e:
+            logging.error(f"Metric {self.name} failed: {e}")
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        samples = []
+        for key, number in value.items():
+            child = _Value()
+            child.value = number
+            samples.append((key if isinstance(key, tuple) else (key,), child))
+        return samples
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+# Seconds; 1 ms .. 30 s
+_LATENCY = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+START_TIME = Gauge("pible_start_time_seconds", "Unix time the scanner started.")
+ADVERTS = Counter("pible_adverts_total", "Adverts received.", ["adapter"])
+ADVERTS_DROPPED = Counter("pible_adverts_dropped_total", "Adverts dropped because the advert queue was full.",
+                          ["adapter"])
+SCAN_DURATION = Histogram("pible_scan_duration_seconds", "Duration of one discover() call (cycle mode).",
+                          (0.5, 1, 2, 3, 3.5, 4, 5, 7.5, 10, 15), ["adapter"])
+SCAN_ADVERTS = Histogram("pible_scan_devices", "Devices returned by one discover() call (cycle mode).",
+                         (0, 1, 5, 10, 25, 50, 100, 250, 500, 1000), ["adapter"])
+PERSIST_BATCH = Histogram("pible_persist_batch_adverts", "Adverts drained from the queue per batch (stream mode).",
+                          (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+DB_COMMIT = Histogram("pible_db_commit_seconds", "Duration of one SQLite commit.", _LATENCY)
+DB_BATCH = Histogram("pible_db_batch_statements", "Queued statements applied per transaction.",
+                     (1, 5, 10, 50, 100, 500, 1000, 2500, 5000))
+DB_ROWS = Counter("pible_db_rows_total", "Rows written by the database writer.")
+DB_ERRORS = Counter("pible_db_errors_total", "Statements that failed in the database writer.")
+CONNECTS = Counter("pible_connects_total", "Connection attempts by result (success or error class).",
+                   ["adapter", "result"])
+CONNECT_DURATION = Histogram("pible_connect_duration_seconds", "Connect + GATT capture time per device.",
+                             _LATENCY, ["adapter"])
+CONNECT_QUEUE_WAIT = Histogram("pible_connect_queue_wait_seconds", "Time a device waited in the connect queue.",
+                               _LATENCY)
+SEMAPHORE_WAIT = Histogram("pible_semaphore_wait_seconds", "Time spent waiting for a concurrency slot.",
+                           _LATENCY, ["semaphore"])
+GATT_READ = Histogram("pible_gatt_read_seconds", "Latency of one characteristic read.", _LATENCY)
+GATT_READ_ERRORS = Counter("pible_gatt_read_errors_total", "Failed characteristic reads by error class.",
+                           ["error"])
+QUEUE_DEPTH = Gauge("pible_queue_depth", "Items waiting in the internal queues.", ["queue"])
+LOOP_LAG = Histogram("pible_event_loop_lag_seconds", "How late the event loop ran a timer.", _LATENCY)
+
+START_TIME.set(time.time())
+
+# Queue name -> callable returning its current size
+_queue_sizes = {}
+
+def track_queue(name, size):
+    """Report size() as pible_queue_depth{queue=name} on every scrape."""
+    _queue_sizes[name] = size
+
+QUEUE_DEPTH.set_function(lambda: {name: size() for name, size in _queue_sizes.items()})
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics.values():
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for values, child in metric.samples():
+            if metric.kind != "histogram":
+                lines.append(f"{metric.name}{_format_labels(metric.label_names, values)} {_format_number(child.value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (math.inf,), child.counts):
+                cumulative += count
+                le = _format_labels(metric.label_names, values, f'le="{_format_number(float(bound))}"')
+                lines.append(f"{metric.name}_bucket{le} {cumulative}")
+            labels = _format_labels(metric.label_names, values)
+            lines.append(f"{metric.name}_sum{labels} {_format_number(child.sum)}")
+            lines.append(f"{metric.name}_count{labels} {child.count}")
+    return "\n".join(lines) + "\n"
+
+def snapshot():
+    """All metrics as a JSON-serialisable dict."""
+    result = {"timestamp": time.time()}
+    for metric in _metrics.values():
+        samples = []
+        for values, child in metric.samples():
+            sample = {"labels": dict(zip(metric.label_names, values))}
+            if metric.kind == "histogram":
+                sample["buckets"] = dict(zip([str(b) for b in metric.buckets] + ["+Inf"], child.counts))
+                sample["sum"] = child.sum
+                sample["count"] = child.count
+            else:
+                sample["value"] = child.value
+            samples.append(sample)
+        result[metric.name] = {"type": metric.kind, "help": metric.documentation, "samples": samples}
+    return result
+
+@route("GET", "/metrics")
+def metrics_route(request):
+    return 200, render(), "text/plain; version=0.0.4; charset=utf-8"
+
+def _write_json(path, data):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+async def _dump_periodically(path, interval):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Snapshot on the loop, write the file in a thread
+            await loop.run_in_executor(None, _write_json, path, snapshot())
+        except OSError as e:
+            logging.error(f"Cannot write metrics to {path}: {e}")
+
+async def _monitor_event_loop(interval):
+    """Sleep 'interval' and record how much later than asked we woke up."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(loop.time() - started - interval, 0.0))
+
+def start_metrics_tasks():
+    """Start the event-loop lag probe and (if configured) the JSON dump."""
+    tasks = [asyncio.create_task(_monitor_event_loop(utils.METRICS_LAG_INTERVAL))]
+    if utils.METRICS_DUMP_PATH:
+        tasks.append(asyncio.create_task(_dump_periodically(utils.METRICS_DUMP_PATH, utils.METRICS_DUMP_INTERVAL)))
+    return tasks
@@ -0,0 +1,358 @@
+# modules/retention.py
+
+"""
+Retention for long-running deployments: keeps the database bounded by age
+and size without stalling the scanner.
+
+    python -m modules.retention status
+    python -m modules.retention run       # one pass now (scanner stopped)
+    python -m modules.retention vacuum    # full VACUUM, enables incremental vacuum
+
+Policies (modules/utils.py, settable in [tuning]):
+
+- RETENTION_SIGHTINGS_DAYS: sightings day partitions (and their R-trees)
+  older than this are emptied and dropped.
+- RETENTION_AGGREGATE_DAYS: hours of hourly_counts and heat_cells.
+- RETENTION_GATT_DAYS: GATT values of devices not seen for this long.
+- RETENTION_DEVICES_DAYS: devices not seen for this long, with their GATT
+  values, aliases and locations (None keeps them forever).
+- RETENTION_MAX_DB_MB: while the live data is larger, the oldest day
+  partitions are dropped first, then the least recently seen devices,
+  but never today's partition or devices seen within REGISTRY_TTL: if only
+  those are left, a warning is logged instead.
+
+The work runs on the writer thread in steps that delete at most
+RETENTION_DELETE_CHUNK rows and are committed on their own. A step is only
+queued while the writer backlog is small, so scanner writes never wait
+long. Freed pages are handed back to the filesystem afterwards with
+PRAGMA incremental_vacuum, VACUUM_STEP_PAGES at a time. That needs
+auto_vacuum = INCREMENTAL: databases created now have it, older ones
+switch with 'vacuum' (rewrites the file once, needs its size free).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+from . import utils
+from . import metrics
+from .database import get_writer, initialize_database, close_database, open_connection
+from .device_registry import mac_to_int
+from .sightings import list_partitions, partition_name, has_geo_index
+
+_retention = None
+
+DELETED = metrics.Counter("pible_retention_rows_total", "Rows deleted by retention.", ["dataset"])
+VACUUMED = metrics.Counter("pible_retention_vacuum_pages_total", "Pages returned to the filesystem.")
+
+def _seconds(days):
+    # None-valued constants come back from [tuning] as strings
+    return float(days) * 86400 if days not in (None, "") else None
+
+def database_size(cursor):
+    """(live bytes, free bytes) of the main database file."""
+    page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+    pages = cursor.execute('PRAGMA page_count').fetchone()[0]
+    free = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+    return (pages - free) * page_size, free * page_size
+
+# --- Steps, run on the writer thread ---
+
+def _empty_partition(cursor, name, chunk):
+    """Delete up to 'chunk' rows of a partition; drop it once empty. Returns rows deleted."""
+    first = cursor.execute(f'SELECT MIN(rowid) FROM {name}').fetchone()[0]
+    if first is None:
+        cursor.execute(f'DROP TABLE IF EXISTS {name}_geo')
+        cursor.execute(f'DROP TABLE IF EXISTS {name}')
+        cursor.execute('DELETE FROM rollup_state WHERE partition = ?', (name,))
+        logging.info(f"Retention: dropped sightings partition {name}")
+        return 0
+    bound = first + chunk
+    if has_geo_index(cursor, name):
+        # R-tree rows are looked up by id; a range on id would scan the tree
+        cursor.execute(f'DELETE FROM {name}_geo WHERE id IN (SELECT rowid FROM {name} WHERE rowid < ?)', (bound,))
+    cursor.execute(f'DELETE FROM {name} WHERE rowid < ?', (bound,))
+    DELETED.labels("sightings").inc(cursor.rowcount)
+    return cursor.rowcount
+
+def _prune_oldest_hour(cursor, table, cutoff):
+    """Delete the oldest hour of an aggregate table if it is before 'cutoff'."""
+    hour = cursor.execute(f'SELECT MIN(hour) FROM {table}').fetchone()[0]
+    if hour is None or hour >= cutoff:
+        return None
+    cursor.execute(f'DELETE FROM {table} WHERE hour = ?', (hour,))
+    DELETED.labels(table).inc(cursor.rowcount)
+    return cursor.rowcount
+
+def _delete_gatt(cursor, macs):
+    placeholders = ",".join("?" * len(macs))
+    cursor.execute(f'DELETE FROM characteristic_values WHERE mac IN ({placeholders})', macs)
+    rows = cursor.rowcount
+    cursor.execute(f'DELETE FROM gatt_services WHERE mac IN ({placeholders})', macs)
+    DELETED.labels("gatt").inc(rows + cursor.rowcount)
+    return rows + cursor.rowcount
+
+def _delete_devices(cursor, macs):
+    """Devices with everything keyed by their MAC."""
+    placeholders = ",".join("?" * len(macs))
+    rows = _delete_gatt(cursor, macs)
+    cursor.execute(f'DELETE FROM mac_aliases WHERE mac IN ({placeholders})', macs)
+    mac_ids = []
+    for mac in macs:
+        try:
+            mac_ids.append((mac_to_int(mac),))
+        except (ValueError, AttributeError):
+            pass
+    cursor.executemany('DELETE FROM device_locations WHERE mac_id = ?', mac_ids)
+    cursor.executemany('DELETE FROM hourly_counts WHERE mac_id = ?', mac_ids)
+    cursor.execute(f'DELETE FROM devices WHERE mac IN ({placeholders})', macs)
+    DELETED.labels("devices").inc(cursor.rowcount)
+    return rows + cursor.rowcount
+
+def _retention_step(cursor, now):
+    """
+    One bounded piece of retention work. Returns (task, rows deleted,
+    dropped partition or None), or None when there is nothing left to do.
+    """
+    chunk = max(int(utils.RETENTION_DELETE_CHUNK), 1)
+    # GATT tables hold a few dozen value rows per device
+    device_chunk = max(chunk // 32, 1)
+
+    age = _seconds(utils.RETENTION_SIGHTINGS_DAYS)
+    if age is not None:
+        oldest_kept = partition_name(now - age)
+        for name in list_partitions(cursor):
+            if name < oldest_kept:
+                rows = _empty_partition(cursor, name, chunk)
+                return "sightings", rows, name if rows == 0 else None
+
+    age = _seconds(utils.RETENTION_AGGREGATE_DAYS)
+    if age is not None:
+        for table in ("hourly_counts", "heat_cells"):
+            rows = _prune_oldest_hour(cursor, table, now - age)
+            if rows is not None:
+                return table, rows, None
+
+    age = _seconds(utils.RETENTION_GATT_DAYS)
+    if age is not None:
+        cutoff = now - age
+        macs = [row[0] for row in cursor.execute('''
+            SELECT g.mac FROM gatt_services g
+            WHERE g.updated_at < ?
+              AND NOT EXISTS (SELECT 1 FROM devices d WHERE d.mac = g.mac AND d.timestamp >= ?)
+            LIMIT ?
+        ''', (cutoff, cutoff, device_chunk)).fetchall()]
+        if macs:
+            return "gatt", _delete_gatt(cursor, macs), None
+
+    age = _seconds(utils.RETENTION_DEVICES_DAYS)
+    if age is not None:
+        cutoff = now - age
+        macs = [row[0] for row in cursor.execute(
+            'SELECT mac FROM devices WHERE timestamp < ? ORDER BY timestamp LIMIT ?', (cutoff, device_chunk)
+        ).fetchall()]
+        if macs:
+            return "devices", _delete_devices(cursor, macs), None
+        # Aliases of rotating MACs outlive their devices rows by design
+        cursor.execute('''
+            DELETE FROM mac_aliases WHERE mac IN (SELECT mac FROM mac_aliases WHERE last_seen < ? LIMIT ?)
+        ''', (cutoff, chunk))
+        rows = cursor.rowcount
+        cursor.execute('''
+            DELETE FROM logical_devices WHERE id IN (SELECT id FROM logical_devices WHERE last_seen < ? LIMIT ?)
+        ''', (cutoff, chunk))
+        rows += cursor.rowcount
+        if rows:
+            DELETED.labels("identities").inc(rows)
+            return "identities", rows, None
+
+    limit = utils.RETENTION_MAX_DB_MB
+    if limit not in (None, ""):
+        live, _ = database_size(cursor)
+        if live > float(limit) * 1024 * 1024:
+            # Oldest first: whole days of sightings, never the one being written
+            partitions = list_partitions(cursor)
+            if len(partitions) > 1:
+                name = partitions[0]
+                rows = _empty_partition(cursor, name, chunk)
+                return "size", rows, name if rows == 0 else None
+            # Devices the registry may still hold are live data, never evicted
+            macs = [row[0] for row in cursor.execute(
+                'SELECT mac FROM devices WHERE timestamp < ? ORDER BY timestamp LIMIT ?',
+                (now - utils.REGISTRY_TTL, device_chunk)
+            ).fetchall()]
+            if macs:
+                return "size", _delete_devices(cursor, macs), None
+            logging.warning(
+                f"Database is {live / 1024 / 1024:.1f} MB, over RETENTION_MAX_DB_MB={limit}, "
+                f"but only today's sightings and devices seen within REGISTRY_TTL are left; "
+                f"not deleting live data"
+            )
+    return None
+
+def _vacuum_step(cursor, pages):
+    """Return up to 'pages' free pages to the filesystem. Returns the number freed."""
+    if cursor.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        return 0
+    free = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+    if not free:
+        return 0
+    # execute() steps the pragma once, freeing a single page; executescript()
+    # runs it to completion (after committing the open batch)
+    cursor.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    freed = free - cursor.execute('PRAGMA freelist_count').fetchone()[0]
+    VACUUMED.inc(freed)
+    return freed
+
+def _resolve(loop, future, set_outcome, value):
+    def resolve():
+        if not future.done():
+            set_outcome(value)
+    try:
+        loop.call_soon_threadsafe(resolve)
+    except RuntimeError:
+        # The event loop is gone (shutdown)
+        pass
+
+def _run_step(cursor, loop, future, func, args):
+    try:
+        result = func(cursor, *args)
+    except Exception as e:
+        logging.error(f"Retention step {func.__name__} failed: {e}")
+        _resolve(loop, future, future.set_exception, e)
+    else:
+        _resolve(loop, future, future.set_result, result)
+
+class Retention:
+    """
+    Drives retention passes from the event loop. 'sighting_log' forgets the
+    partitions that were dropped.
+    """
+
+    def __init__(self, sighting_log=None):
+        self.sighting_log = sighting_log
+        self.deleted = 0
+        self.vacuumed = 0
+        self.last_pass = None
+        self._task = None
+
+    async def _step(self, func, *args):
+        # Wait for a quiet writer, then run one step as its own transaction
+        writer = get_writer()
+        while writer.pending() > utils.RETENTION_IDLE_BACKLOG:
+            await asyncio.sleep(1)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        writer.call(_run_step, loop, future, func, args)
+        writer.commit()
+        result = await future
+        await asyncio.sleep(utils.RETENTION_STEP_PAUSE)
+        return result
+
+    async def run_pass(self):
+        """Delete what the policies ask for, then shrink the file. Returns rows deleted."""
+        started = time.monotonic()
+        now = time.time()
+        deleted = 0
+        while True:
+            result = await self._step(_retention_step, now)
+            if result is None:
+                break
+            _, rows, dropped = result
+            deleted += rows
+            if dropped is not None and self.sighting_log is not None:
+                self.sighting_log.forget_partition(dropped)
+        vacuumed = 0
+        while True:
+            freed = await self._step(_vacuum_step, utils.VACUUM_STEP_PAGES)
+            if not freed:
+                break
+            vacuumed += freed
+        self.deleted += deleted
+        self.vacuumed += vacuumed
+        self.last_pass = time.time()
+        if deleted or vacuumed:
+            logging.info(f"Retention: deleted {deleted} rows, freed {vacuumed} pages "
+                         f"in {time.monotonic() - started:.1f} s")
+        return deleted
+
+    async def run(self):
+        # Let the scanner settle before the first pass
+        await asyncio.sleep(min(utils.RETENTION_INTERVAL, 60))
+        while True:
+            try:
+                await self.run_pass()
+            except Exception as e:
+                logging.error(f"Retention pass failed: {e}")
+            await asyncio.sleep(utils.RETENTION_INTERVAL)
+
+    def start(self):
+        """Start the background passes; None if another pipeline already did."""
+        if self._task is not None and not self._task.done():
+            return None
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+def get_retention(sighting_log=None):
+    global _retention
+    if _retention is None:
+        _retention = Retention(sighting_log)
+    return _retention
+
+# --- Command line ---
+
+def _status():
+    connection = open_connection()
+    cursor = connection.cursor()
+    live, free = database_size(cursor)
+    mode = {0: "none", 1: "full", 2: "incremental"}.get(cursor.execute('PRAGMA auto_vacuum').fetchone()[0])
+    partitions = list_partitions(cursor)
+    print(f"Database:        {utils.DB_PATH} ({os.path.getsize(utils.DB_PATH) // 1024} kB on disk)")
+    print(f"Live data:       {live // 1024} kB, free pages {free // 1024} kB, auto_vacuum {mode}")
+    print(f"Partitions:      {len(partitions)}" + (f" ({partitions[0]} .. {partitions[-1]})" if partitions else ""))
+    print(f"Policy:          sightings {utils.RETENTION_SIGHTINGS_DAYS} d, aggregates "
+          f"{utils.RETENTION_AGGREGATE_DAYS} d, GATT {utils.RETENTION_GATT_DAYS} d, devices "
+          f"{utils.RETENTION_DEVICES_DAYS} d, max size {utils.RETENTION_MAX_DB_MB} MB")
+    connection.close()
+
+def _vacuum():
+    connection = open_connection()
+    connection.isolation_level = None
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+    connection.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the retention policies to the database.")
+    parser.add_argument("command", choices=["status", "run", "vacuum"])
+    parser.add_argument("--db", help=f"Database file (default: {utils.DB_PATH}).")
+    args = parser.parse_args(argv)
+    if args.db:
+        utils.DB_PATH = args.db
+    if not os.path.exists(utils.DB_PATH):
+        parser.exit(1, f"{utils.DB_PATH}: no such database\n")
+
+    started = time.perf_counter()
+    if args.command == "status":
+        _status()
+        return
+    if args.command == "vacuum":
+        before = os.path.getsize(utils.DB_PATH)
+        _vacuum()
+        print(f"Vacuumed {before // 1024} kB -> {os.path.getsize(utils.DB_PATH) // 1024} kB "
+              f"in {time.perf_counter() - started:.1f} s")
+        return
+    # Steps go straight through: there is no scanner to make room for
+    utils.RETENTION_STEP_PAUSE = 0
+    initialize_database()
+    retention = Retention()
+    try:
+        deleted = asyncio.run(retention.run_pass())
+    finally:
+        close_database()
+    print(f"Deleted {deleted} rows, freed {retention.vacuumed} pages in {time.perf_counter() - started:.1f} s")
+
+if __name__ == "__main__":
+    main()
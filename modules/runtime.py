@@ -0,0 +1,303 @@
+# modules/runtime.py
+
+"""
+Runtime state of one scan/connect pipeline. It replaces the mutable
+globals that used to live in utils (use_gps, max_connect, scan_mode,
+scanning_started, ...).
+
+- Settings are an immutable namedtuple. update() swaps in a new one with a
+  single assignment, so any thread or task reading state.settings gets a
+  consistent snapshot without a lock.
+- Each RuntimeState has its own device registry and sighting log, so
+  several pipelines can run in one process. They share the process-wide
+  DB writer, GPS track and console.
+- Connect backoff per MAC is not in the database. It goes to an
+  append-only journal (StateJournal) and is replayed at start-up, so a
+  restart does not hammer devices that just failed.
+- The identity resolver (logical devices behind rotating MACs) is
+  per-pipeline like the registry.
+- New devices are published to a process-wide DeviceEvents buffer that
+  the HTTP API streams to clients (GET /api/events).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque, namedtuple
+
+from . import utils
+from .device_registry import DeviceRegistry, get_registry
+from .sightings import SightingLog, get_sighting_log
+from .gps_track import get_gps_track
+from .identity import IdentityResolver, get_identities
+
+Settings = namedtuple("Settings", "use_gps max_connect scan_mode")
+
+_runtime = None
+_instances = []
+_device_events = None
+
+class StateJournal:
+    """
+    Append-only JSON-lines file of state changes:
+
+        {"k": "backoff", "mac": "AA:..", "n": 3, "until": 1714550000.0}
+        {"k": "clear", "mac": "AA:.."}
+
+    Replaying it in order yields the current state. Appends are buffered
+    and written by flush(). Once the file holds far more lines than live
+    entries, compact() rewrites it: a temporary file renamed over the
+    journal, never a rewrite in place.
+    """
+
+    def __init__(self, path, compact_after=None):
+        self.path = path
+        self.compact_after = compact_after or utils.STATE_JOURNAL_COMPACT
+        self.lines = 0
+        self._pending = []
+
+    def load(self):
+        """Replay the journal: {mac: (failures, until)} of the backoff table."""
+        backoff = {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    self.lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn last line after a crash
+                        continue
+                    if entry.get("k") == "backoff":
+                        backoff[entry["mac"]] = (entry["n"], entry["until"])
+                    elif entry.get("k") == "clear":
+                        backoff.pop(entry["mac"], None)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"Cannot read state journal {self.path}: {e}")
+        return backoff
+
+    def append(self, entry):
+        self._pending.append(json.dumps(entry, separators=(",", ":")))
+
+    def flush(self):
+        if not self._pending:
+            return
+        lines, self._pending = self._pending, []
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            self.lines += len(lines)
+        except OSError as e:
+            logging.error(f"Cannot write state journal {self.path}: {e}")
+
+    def needs_compaction(self, live):
+        return self.lines > max(self.compact_after, 4 * live)
+
+    def compact(self, entries):
+        """Replace the journal with 'entries' (the live state)."""
+        self._pending = []
+        temporary = f"{self.path}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+            self.lines = len(entries)
+        except OSError as e:
+            logging.error(f"Cannot compact state journal {self.path}: {e}")
+
+class DeviceEvents:
+    """
+    The last API_EVENT_BUFFER new-device events, numbered from 1. Events
+    are published on the event loop (the ingest path), so readers need no
+    lock: a waiting reader holds the current asyncio.Event, which is set
+    and replaced on every publish.
+    """
+
+    def __init__(self, size=None):
+        self.sequence = 0
+        self._events = deque(maxlen=size or utils.API_EVENT_BUFFER)
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.sequence += 1
+        event["seq"] = self.sequence
+        self._events.append(event)
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def since(self, sequence):
+        """Buffered events numbered above 'sequence', oldest first."""
+        if sequence >= self.sequence:
+            return []
+        return [event for event in self._events if event["seq"] > sequence]
+
+    async def wait(self, sequence, timeout):
+        """Wait up to 'timeout' seconds for an event numbered above 'sequence'."""
+        if self.sequence > sequence:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+def get_device_events():
+    global _device_events
+    if _device_events is None:
+        _device_events = DeviceEvents()
+    return _device_events
+
+class RuntimeState:
+    """
+    One pipeline: settings, registry, sighting log and the journaled
+    connect backoff. 'registry'/'sighting_log'/'identities' default to new
+    instances; the process' default state (get_runtime()) uses the shared
+    ones.
+    """
+
+    def __init__(self, name="default", journal_path=None, registry=None, sighting_log=None,
+                 identities=None, **settings):
+        self.name = name
+        self._settings = Settings(
+            use_gps=utils.USE_GPS, max_connect=utils.MAX_CONNECT, scan_mode=utils.SCAN_MODE
+        )._replace(**settings)
+        if registry is None:
+            registry = DeviceRegistry()
+            registry.warm_load()
+        self.registry = registry
+        self.sightings = sighting_log if sighting_log is not None else SightingLog()
+        if identities is None:
+            identities = IdentityResolver()
+            identities.warm_load()
+        self.identities = identities
+        self.gps_track = get_gps_track()
+        self.events = get_device_events()
+        self.scheduler = None
+        # Adapter -> ScanStats, set when scanning starts
+        self.scan_stats = {}
+        self.started_at = None
+
+        self.journal = StateJournal(journal_path) if journal_path else None
+        # MAC -> (consecutive failures, epoch seconds of the next allowed attempt)
+        self.backoff = self.journal.load() if self.journal else {}
+        self._apply_settings()
+        _instances.append(self)
+
+    @property
+    def settings(self):
+        return self._settings
+
+    def update(self, **changes):
+        """Replace some settings; readers see either the old or the new tuple."""
+        self._settings = self._settings._replace(**changes)
+        self._apply_settings()
+
+    def _apply_settings(self):
+        # Sightings are located from the GPS track only when GPS is in use
+        self.sightings.gps_track = self.gps_track if self._settings.use_gps else None
+
+    def current_fix(self, timestamp):
+        """(latitude, longitude) for the devices table at 'timestamp', or None."""
+        if not self._settings.use_gps:
+            return None
+        return self.gps_track.fix_at(timestamp)
+
+    def record_backoff(self, mac, failures, until):
+        self.backoff[mac] = (failures, until)
+        if self.journal is not None:
+            self.journal.append({"k": "backoff", "mac": mac, "n": failures, "until": round(until, 1)})
+
+    def clear_backoff(self, mac):
+        if self.backoff.pop(mac, None) is not None and self.journal is not None:
+            self.journal.append({"k": "clear", "mac": mac})
+
+    def record_capture(self, mac, timestamp):
+        """A GATT table of 'mac' was stored: its logical device counts as interrogated."""
+        self.identities.mark_interrogated(mac, timestamp)
+
+    def device_added(self, mac, record, adapter, logical_device, new_identity):
+        """
+        'mac' was heard for the first time: publish it for the HTTP API.
+        'new_identity' is False for a rotated MAC of a known logical device.
+        """
+        self.events.publish({
+            "mac": mac,
+            "name": record.name,
+            "adapter": adapter,
+            "rssi": record.rssi,
+            "timestamp": record.last_seen,
+            "logical_id": logical_device.id,
+            "new_identity": new_identity,
+            "pipeline": self.name,
+        })
+
+    def _prune_backoff(self):
+        stale = time.time() - utils.CONNECT_BACKOFF_MAX
+        for mac in [mac for mac, (_, until) in self.backoff.items() if until < stale]:
+            del self.backoff[mac]
+
+    def flush(self):
+        """Write back the registry, identities, sightings and journal."""
+        self.registry.flush()
+        self.identities.flush()
+        self.sightings.flush()
+        if self.journal is None:
+            return
+        self.journal.flush()
+        self._prune_backoff()
+        if self.journal.needs_compaction(len(self.backoff)):
+            self.journal.compact([
+                {"k": "backoff", "mac": mac, "n": failures, "until": round(until, 1)}
+                for mac, (failures, until) in self.backoff.items()
+            ])
+
+    def snapshot(self):
+        """Plain dict of the current state, safe to serialise from any thread."""
+        snapshot = {
+            "name": self.name,
+            "settings": self._settings._asdict(),
+            "scanning_since": self.started_at,
+            "devices_in_memory": len(self.registry),
+            "observations": self.registry.observations,
+            "logical_devices": len(self.identities),
+            "sightings_buffered": len(self.sightings),
+            "backoff": len(self.backoff),
+        }
+        scheduler = self.scheduler
+        if scheduler is not None:
+            snapshot.update({
+                "connect_queue": scheduler.queue_depth(),
+                "connects": scheduler.attempts,
+                "connect_successes": scheduler.successes,
+                "connect_failures": scheduler.failures,
+            })
+        return snapshot
+
+    def close(self):
+        self.flush()
+        if self in _instances:
+            _instances.remove(self)
+
+def get_runtime():
+    """The process' default pipeline (shared registry and sighting log)."""
+    global _runtime
+    if _runtime is None:
+        _runtime = RuntimeState(
+            "default", journal_path=utils.STATE_JOURNAL,
+            registry=get_registry(), sighting_log=get_sighting_log(),
+            identities=get_identities()
+        )
+    return _runtime
+
+def instances():
+    return list(_instances)
+
+def scanning():
+    """True once any pipeline in the process has started scanning."""
+    return any(state.started_at is not None for state in _instances)
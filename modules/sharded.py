@@ -0,0 +1,532 @@
+# modules/sharded.py
+
+"""
+Multi-process pipeline (scan mode "sharded"), to use every core of a Pi:
+
+- one scanner process per scan adapter. It runs the streaming scan,
+  cleans up names (the MAC regex included) and sends the adverts to the
+  main process in batches every SHARD_BATCH_INTERVAL seconds;
+- the main process is the persistence process: registry, sightings, GPS,
+  the SQLite writer, capture files, console and HTTP server;
+- connector processes, each with its own ConnectionScheduler. A device
+  always goes to the same connector (MAC modulo the number of
+  connectors), so the 'queued/connecting/interrogated/backing off'
+  checks need no coordination. Captured GATT tables and backoff changes
+  are sent back to the main process, which writes the database and the
+  state journal, and which drops offers for devices interrogated or
+  backing off before they are put on a connector's queue.
+
+Processes talk over multiprocessing queues (pipes plus a feeder thread,
+so put() never blocks an event loop). Children are started with "spawn":
+the main process already runs threads (DB writer, console, logging), and
+forking those is unsafe.
+
+Connect metrics (pible_connects_total, GATT reads, ...) are counted in the
+connector processes and are not part of the main process' /metrics.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import namedtuple
+from termcolor import colored
+from bleak.exc import BleakError
+
+from . import utils
+from . import metrics
+from .database import get_writer, use_writer, load_interrogated_devices
+from .device_registry import mac_to_int, load_stored
+from .identity import address_type
+from .runtime import Settings
+from .utils import display_name
+
+# Advert as sent by a scanner process; registry.observe() reads the
+# advertisement fields by attribute
+Advert = namedtuple(
+    "Advert", "timestamp mac name rssi manufacturer_data service_uuids service_data tx_power address_type"
+)
+
+# What the connector needs of a BLEDevice
+_Device = namedtuple("_Device", "address name")
+
+def shard_of(mac, shards):
+    """Connector index of 'mac'. Stable across processes, unlike hash()."""
+    return mac_to_int(mac) % shards
+
+def shard_adapters(adapters, shards):
+    """
+    [(adapters, workers)] per connector. With fewer connectors than
+    adapters each gets a slice of them; with more, connectors share an
+    adapter and split its max_connect between them.
+    """
+    if shards <= len(adapters):
+        return [(adapters[i::shards], None) for i in range(shards)]
+    layout = []
+    for i in range(shards):
+        adapter = adapters[i % len(adapters)]
+        sharing = len(range(i % len(adapters), shards, len(adapters)))
+        layout.append(([adapter], sharing))
+    return layout
+
+# --- Child processes ---
+
+def _init_child(setup):
+    """Common start-up of a child: settings, logging, signals, BLE backend."""
+    for name, value in setup["utils"].items():
+        setattr(utils, name, value)
+    # The dashboard belongs to the main process; children print errors only
+    if utils.CONSOLE_MODE == "dashboard":
+        utils.CONSOLE_MODE = "summary"
+    # Ctrl+C reaches the whole process group: let the main process decide
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if setup["log_file"]:
+        from .console import setup_logging
+        setup_logging(setup["log_file"])
+    if setup["simulation"] is not None:
+        from . import simulator
+        simulator.install(simulator.SimulatedWorld(setup["simulation"]))
+
+def _close_child(outbox):
+    from .console import close_console, stop_logging
+    close_console()
+    stop_logging()
+    # Wait until the feeder thread has written everything to the pipe
+    outbox.close()
+    outbox.join_thread()
+
+def _stop_on_sigterm(stop):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+
+def scanner_process(adapter, outbox, stop, setup):
+    _init_child(setup)
+    try:
+        asyncio.run(_scan_adapter(adapter, outbox, stop))
+    finally:
+        _close_child(outbox)
+
+async def _scan_adapter(adapter, outbox, stop):
+    from .ble_backend import get_scanner_class
+    from .console import get_console
+
+    batch = []
+    dropped = 0
+
+    def on_advert(device, advertisement_data):
+        batch.append((
+            time.time(), device.address, display_name(advertisement_data.local_name or device.name),
+            advertisement_data.rssi if advertisement_data.rssi is not None else -100,
+            advertisement_data.manufacturer_data, advertisement_data.service_uuids,
+            advertisement_data.service_data, advertisement_data.tx_power, address_type(device),
+        ))
+
+    _stop_on_sigterm(stop)
+    scanner = get_scanner_class()(detection_callback=on_advert, adapter=adapter)
+    console = get_console()
+    while True:
+        if stop.is_set():
+            return
+        console.line(f"{colored('[INFO]', 'blue')} Streaming scan on {adapter}...")
+        logging.info(f"Starting streaming scan on {adapter} (process {multiprocessing.current_process().pid})...")
+        try:
+            await scanner.start()
+            break
+        except BleakError as e:
+            logging.error(f"Failed to scan on adapter {adapter}: {e}")
+            console.line(f"{colored('[ERROR]', 'red')} Failed to scan on {adapter}. Is the adapter powered on?")
+            await asyncio.sleep(3)
+    outbox.put(("scanning", adapter, True))
+    try:
+        while not stop.is_set():
+            await asyncio.sleep(utils.SHARD_BATCH_INTERVAL)
+            if not batch:
+                continue
+            adverts = batch[:]
+            del batch[:]
+            try:
+                outbox.put_nowait(("adverts", adapter, adverts, dropped))
+                dropped = 0
+            except queue.Full:
+                # The main process is behind; don't let the backlog grow
+                dropped += len(adverts)
+    finally:
+        try:
+            await scanner.stop()
+        except BleakError as e:
+            logging.error(f"Failed to stop scanner on {adapter}: {e}")
+        outbox.put(("scanning", adapter, False))
+
+class _ShardState:
+    """
+    Stand-in for RuntimeState inside a connector: the backoff table it
+    starts from, with changes sent to the main process' journal. Logical
+    device identities live in the main process, which filters the offers.
+    """
+
+    identities = None
+
+    def __init__(self, name, settings, backoff, outbox):
+        self.name = name
+        self.settings = settings
+        self.backoff = backoff
+        self._outbox = outbox
+
+    def record_backoff(self, mac, failures, until):
+        self._outbox.put(("backoff", mac, failures, until))
+
+    def clear_backoff(self, mac):
+        self._outbox.put(("clear", mac))
+
+    def record_capture(self, mac, timestamp):
+        self._outbox.put(("captured", mac, timestamp))
+
+class _ForwardingWriter:
+    """
+    Database writer of a connector process: statements go to the main
+    process' writer instead of opening a second write connection.
+    """
+
+    statistics = None
+
+    def __init__(self, outbox):
+        self._outbox = outbox
+
+    def submit(self, sql, params=()):
+        self._outbox.put(("db", "exec", sql, params))
+
+    def submit_many(self, sql, rows):
+        self._outbox.put(("db", "many", sql, rows))
+
+    def call(self, func, *args, **kwargs):
+        # 'func' must be a module-level function so it pickles by name
+        self._outbox.put(("db", "call", func, (args, kwargs)))
+
+    def commit(self):
+        pass
+
+    def flush(self, timeout=None):
+        return True
+
+    def stop(self, timeout=None):
+        pass
+
+    def pending(self):
+        return 0
+
+def connector_process(index, adapters, workers, max_connect, backoff, jobs, outbox, stop, setup):
+    _init_child(setup)
+    use_writer(_ForwardingWriter(outbox))
+    try:
+        asyncio.run(_connect_shard(index, adapters, workers, max_connect, backoff, jobs, outbox, stop))
+    finally:
+        _close_child(outbox)
+
+async def _connect_shard(index, adapters, workers, max_connect, backoff, jobs, outbox, stop):
+    from .connection_scheduler import ConnectionScheduler
+
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    settings = Settings(use_gps=False, max_connect=max_connect, scan_mode="sharded")
+    state = _ShardState(f"shard{index}", settings, backoff, outbox)
+    scheduler = ConnectionScheduler(adapters, workers=workers, state=state)
+    scheduler.load_interrogated()
+    scheduler.start()
+
+    def handle(message):
+        if message is None:
+            stopped.set()
+            return
+        for mac, name, rssi, is_new in message:
+            scheduler.offer(_Device(mac, name), rssi, is_new)
+
+    def receive():
+        while True:
+            message = jobs.get()
+            loop.call_soon_threadsafe(handle, message)
+            if message is None:
+                return
+
+    threading.Thread(target=receive, name="connector-jobs", daemon=True).start()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    try:
+        while not stopped.is_set() and not stop.is_set():
+            try:
+                await asyncio.wait_for(stopped.wait(), 5)
+            except asyncio.TimeoutError:
+                pass
+            scheduler.prune()
+            outbox.put((
+                "connects", index, scheduler.take_stats(),
+                (scheduler.attempts, scheduler.successes, scheduler.failures),
+            ))
+    finally:
+        scheduler.stop()
+
+# --- Main (persistence) process ---
+
+class ShardedPipeline:
+    """
+    Starts and feeds the scanner and connector processes. Takes the place
+    of the ConnectionScheduler in bluetooth_scanner: offer() routes devices
+    to their connector, take_stats() merges the connectors' reports.
+    """
+
+    def __init__(self, adapters, connect_adapters, state, scan_stats):
+        self.adapters = list(adapters)
+        self.connect_adapters = list(connect_adapters)
+        self.state = state
+        self.scan_stats = scan_stats
+        self.shards = max(utils.SHARD_CONNECTORS or len(self.connect_adapters), 1)
+        self._context = multiprocessing.get_context("spawn")
+        self._inbox = self._context.Queue(maxsize=utils.SHARD_QUEUE_SIZE)
+        self._stop = self._context.Event()
+        self._jobs = []
+        self._processes = []
+        self._offers = [[] for _ in range(self.shards)]
+        # Connector index -> (take_stats() result, (attempts, successes, failures))
+        self._reports = {}
+        self._receiver = None
+        # MAC -> epoch of its last captured GATT table, to filter offers
+        self._interrogated = {}
+        self.last_stats = (0, 0.0, 0.0, {})
+
+        self.attempts = 0
+        self.successes = 0
+        self.failures = 0
+
+    def _setup(self):
+        from . import simulator
+        from .console import log_file
+        world = simulator.installed_world()
+        if world is not None and not isinstance(world, simulator.SimulatedWorld):
+            raise ValueError("sharded mode can't replay recordings: use scan mode 'stream'")
+        return {
+            "utils": {name: getattr(utils, name) for name in dir(utils) if name.isupper()},
+            "log_file": log_file(),
+            "simulation": world.config if world is not None else None,
+        }
+
+    def start(self):
+        setup = self._setup()
+        self._interrogated.update(load_interrogated_devices(int(time.time()) - utils.REINTERROGATE_TTL))
+        backoff = [{} for _ in range(self.shards)]
+        for mac, entry in self.state.backoff.items():
+            backoff[shard_of(mac, self.shards)][mac] = entry
+        max_connect = self.state.settings.max_connect
+        for index, (adapters, sharing) in enumerate(shard_adapters(self.connect_adapters, self.shards)):
+            workers = max(max_connect // sharing, 1) if sharing else max_connect * len(adapters)
+            jobs = self._context.Queue()
+            self._jobs.append(jobs)
+            self._spawn(f"pible-connect-{index}", connector_process,
+                        index, adapters, workers, max_connect, backoff[index], jobs, self._inbox, self._stop, setup)
+        for adapter in self.adapters:
+            self._spawn(f"pible-scan-{adapter}", scanner_process, adapter, self._inbox, self._stop, setup)
+        metrics.track_queue("shard_inbox", self._inbox.qsize)
+        logging.info(f"Sharded pipeline: {len(self.adapters)} scanner and {self.shards} connector processes")
+
+    def _spawn(self, name, target, *args):
+        process = self._context.Process(target=target, name=name, args=args, daemon=True)
+        process.start()
+        self._processes.append(process)
+
+    async def run(self):
+        """Apply the children's messages until cancelled, then shut them down."""
+        loop = asyncio.get_running_loop()
+        self._receiver = threading.Thread(target=self._receive, args=(loop,), name="shard-inbox", daemon=True)
+        self._receiver.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self._shutdown(loop)
+
+    def _receive(self, loop):
+        """
+        Hand inbox messages to the loop in batches. The next batch is only
+        read once the loop has applied the previous one, so a busy loop
+        leaves the backlog in the bounded inbox, where scanners see it.
+        """
+        applied = threading.Event()
+        while True:
+            messages = [self._inbox.get()]
+            while messages[-1] is not None and len(messages) < 256:
+                try:
+                    messages.append(self._inbox.get_nowait())
+                except queue.Empty:
+                    break
+            # Devices known to the database but not in memory are not new; looked
+            # up here, off the event loop
+            stored = self._load_missing(messages)
+            if messages[-1] is None:
+                loop.call_soon_threadsafe(self._handle_all, messages[:-1], None, stored)
+                return
+            applied.clear()
+            loop.call_soon_threadsafe(self._handle_all, messages, applied, stored)
+            applied.wait()
+
+    def _load_missing(self, messages):
+        macs = {advert[1] for message in messages if message is not None and message[0] == "adverts"
+                for advert in message[2]}
+        missing = self.state.registry.missing(macs)
+        return load_stored(missing) if missing else ()
+
+    def _handle_all(self, messages, applied, stored):
+        try:
+            self.state.registry.add_stored(stored)
+            for message in messages:
+                self._handle(message)
+        finally:
+            if applied is not None:
+                applied.set()
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == "adverts":
+            self._persist(message[1], message[2], message[3])
+        elif kind == "db":
+            writer = get_writer()
+            if message[1] == "exec":
+                writer.submit(message[2], message[3])
+            elif message[1] == "many":
+                writer.submit_many(message[2], message[3])
+            else:
+                args, kwargs = message[3]
+                writer.call(message[2], *args, **kwargs)
+        elif kind == "backoff":
+            self.state.record_backoff(message[1], message[2], message[3])
+        elif kind == "clear":
+            self.state.clear_backoff(message[1])
+        elif kind == "captured":
+            self._interrogated[message[1]] = message[2]
+            self.state.record_capture(message[1], message[2])
+        elif kind == "connects":
+            self._reports[message[1]] = (message[2], message[3])
+            self.attempts, self.successes, self.failures = (
+                sum(totals[i] for _, totals in self._reports.values()) for i in range(3)
+            )
+        elif kind == "scanning":
+            stats = self.scan_stats.get(message[1])
+            if stats is not None:
+                if message[2]:
+                    stats.scan_started()
+                else:
+                    stats.scan_stopped()
+
+    def _persist(self, adapter, adverts, dropped):
+        """One scanner batch: registry, sightings, capture, console, offers."""
+        from .bluetooth_scanner import log_sighting
+        from .capture import get_capture
+        from .console import get_console
+
+        stats = self.scan_stats[adapter]
+        stats.adverts += len(adverts)
+        metrics.ADVERTS.labels(adapter).inc(len(adverts))
+        if dropped:
+            stats.dropped += dropped
+            metrics.ADVERTS_DROPPED.labels(adapter).inc(dropped)
+        metrics.PERSIST_BATCH.observe(len(adverts))
+
+        # Fields by name from here on: the tuple grows with the advert format
+        adverts = [Advert._make(advert) for advert in adverts]
+        capture = get_capture()
+        if capture is not None:
+            for advert in adverts:
+                capture.append(advert.timestamp, adapter, advert.mac, advert.rssi,
+                               None if advert.name == "Unknown" else advert.name,
+                               advert.manufacturer_data, advert.service_uuids, advert.service_data,
+                               advert.tx_power)
+
+        # Strongest RSSI of each MAC in the batch
+        merged = {}
+        for advert in adverts:
+            previous = merged.get(advert.mac)
+            if previous is None or advert.rssi >= previous.rssi:
+                merged[advert.mac] = advert
+
+        timestamp = int(time.time())
+        gps_data = self.state.current_fix(timestamp)
+        registry = self.state.registry
+        sighting_log = self.state.sightings
+        console = get_console()
+        identities = self.state.identities
+        offers = self._offers
+        for mac, advert in merged.items():
+            record, is_new = registry.observe(mac, advert.name, advert.rssi, timestamp, adapter, gps_data, advert)
+            logical_device, new_identity = identities.observe(mac, advert.rssi, timestamp, advert, advert.address_type)
+            log_sighting(sighting_log, record, timestamp, advert.rssi, adapter)
+            console.seen(mac, advert.name, adapter, advert.rssi, record.count, timestamp, is_new)
+            if is_new:
+                self.state.device_added(mac, record, adapter, logical_device, new_identity)
+            # Most adverts are of devices already interrogated or backing off: don't ship those
+            if self._wanted(mac, timestamp):
+                offers[shard_of(mac, self.shards)].append((mac, advert.name, advert.rssi, is_new and new_identity))
+
+        for index, batch in enumerate(offers):
+            if batch:
+                self._jobs[index].put(batch)
+                offers[index] = []
+
+    async def _shutdown(self, loop):
+        self._stop.set()
+        for jobs in self._jobs:
+            jobs.put(None)
+        deadline = time.monotonic() + 10
+        for process in self._processes:
+            # Joined in a thread: the loop keeps applying what the children send meanwhile
+            await loop.run_in_executor(None, process.join, max(deadline - time.monotonic(), 0.1))
+        self.stop()
+        self._inbox.put(None)
+        await loop.run_in_executor(None, self._receiver.join, 5)
+        # Messages scheduled by the receiver before it stopped
+        await asyncio.sleep(0)
+        # Offers nobody will read any more must not hold up interpreter exit
+        for jobs in self._jobs:
+            jobs.cancel_join_thread()
+            jobs.close()
+
+    def stop(self):
+        """Kill children that did not exit on their own."""
+        for process in self._processes:
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop, terminating it")
+                process.terminate()
+
+    def queue_depth(self):
+        return sum(report[0][0] for report in self._reports.values())
+
+    def prune(self):
+        cutoff = time.time() - utils.REINTERROGATE_TTL
+        for mac in [mac for mac, t in self._interrogated.items() if t < cutoff]:
+            del self._interrogated[mac]
+
+    def _wanted(self, mac, now):
+        """The connectors' interrogated/backoff checks, done here to keep those offers off the queues."""
+        done = self._interrogated.get(mac)
+        if done is not None and now - done < utils.REINTERROGATE_TTL:
+            return False
+        if self.state.identities.interrogated(mac, utils.REINTERROGATE_TTL):
+            return False
+        backoff = self.state.backoff.get(mac)
+        return backoff is None or now >= backoff[1]
+
+    def take_stats(self):
+        """Same shape as ConnectionScheduler.take_stats(), from the last report of each connector."""
+        queue_depth = rate = successes = 0
+        # Adapter -> [connects/sec, successes/sec]; connectors may share an adapter
+        adapters = {}
+        for (depth, connects, success_rate, per_adapter), _ in self._reports.values():
+            queue_depth += depth
+            rate += connects
+            successes += connects * success_rate
+            for adapter, (adapter_rate, adapter_success) in per_adapter.items():
+                totals = adapters.setdefault(adapter, [0.0, 0.0])
+                totals[0] += adapter_rate
+                totals[1] += adapter_rate * adapter_success
+        per_adapter = {
+            adapter: (connects, successful / connects if connects else 0.0)
+            for adapter, (connects, successful) in adapters.items()
+        }
+        self.last_stats = (queue_depth, rate, successes / rate if rate else 0.0, per_adapter)
+        return self.last_stats
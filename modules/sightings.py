@@ -0,0 +1,265 @@
+# modules/sightings.py
+
+import calendar
+import time
+import sqlite3
+import logging
+import threading
+
+from . import utils
+from .database import get_writer, commit_pending, load_adapter_ids
+
+# Side of a heat_cells grid cell in 1e-7 degrees (0.001 degrees, ~111 m of latitude)
+HEAT_CELL = 10_000
+
+_sighting_log = None
+# Adapter name -> adapters.id, shared by every SightingLog of the process:
+# two pipelines meeting new adapters must not hand out the same id
+_adapter_ids = None
+_adapter_lock = threading.Lock()
+
+def partition_name(timestamp):
+    """Day partition (UTC) holding sightings made at 'timestamp'."""
+    return time.strftime("sightings_%Y%m%d", time.gmtime(timestamp))
+
+def scale_coordinate(value):
+    """Degrees -> integer 1e-7 degrees (about 1 cm), None stays None."""
+    if value is None:
+        return None
+    return int(round(float(value) * 10_000_000))
+
+def partition_day_start(name):
+    """Epoch seconds of 00:00 UTC of the day partition 'name'."""
+    return calendar.timegm(time.strptime(name[len("sightings_"):], "%Y%m%d"))
+
+def cell_sql(column):
+    """SQL for floor(column / HEAT_CELL) (SQLite's '/' truncates towards zero)."""
+    return (f"(CASE WHEN {column} >= 0 THEN {column} / {HEAT_CELL} "
+            f"ELSE -((-{column} + {HEAT_CELL - 1}) / {HEAT_CELL}) END)")
+
+def create_geo_index(cursor, name):
+    """
+    R-tree over a partition's fixes: (lat, lon, seconds into the day) boxes
+    of zero size keyed by the sighting rowid, so radius/box/time-window
+    queries never scan the partition. Falls back to a (lat, lon) B-tree
+    index when SQLite is built without the rtree module.
+    """
+    try:
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {name}_geo USING rtree_i32('
+            f'id, min_lat, max_lat, min_lon, max_lon, min_t, max_t)'
+        )
+    except sqlite3.OperationalError as e:
+        logging.warning(f"R-tree unavailable ({e}), indexing {name} by (lat, lon)")
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_latlon ON {name} (lat, lon)')
+
+def index_locations(cursor, name, start, end):
+    """
+    Add the fixes of sightings with rowid in (start, end] to the partition's
+    R-tree and to the hourly heat_cells grid.
+    """
+    if has_geo_index(cursor, name):
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO {name}_geo
+            SELECT rowid, lat, lat, lon, lon, ts - ?, ts - ?
+            FROM {name} WHERE rowid > ? AND rowid <= ? AND lat IS NOT NULL
+        ''', (partition_day_start(name), partition_day_start(name), start, end))
+    cursor.execute(f'''
+        INSERT INTO heat_cells (cy, cx, hour, count)
+        SELECT {cell_sql('lat')}, {cell_sql('lon')}, ts / 3600 * 3600, COUNT(*)
+        FROM {name} WHERE rowid > ? AND rowid <= ? AND lat IS NOT NULL
+        GROUP BY 1, 2, 3
+        ON CONFLICT(cy, cx, hour) DO UPDATE SET count = count + excluded.count
+    ''', (start, end))
+
+def has_geo_index(cursor, name):
+    return cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (f"{name}_geo",)
+    ).fetchone() is not None
+
+def _create_partition(cursor, name):
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {name} (
+            mac_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            rssi INTEGER,
+            lat INTEGER,
+            lon INTEGER,
+            adapter_id INTEGER
+        )
+    ''')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_mac ON {name} (mac_id)')
+    create_geo_index(cursor, name)
+
+def list_partitions(cursor):
+    cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND name GLOB 'sightings_[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]' ORDER BY name"
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+def _rollup(cursor, chunk):
+    """
+    Fold new sightings into device_locations (strongest-RSSI fix per
+    device) and hourly_counts, and index their fixes (R-tree and
+    heat_cells). Processes at most 'chunk' rows per partition so the writer
+    thread is never held for long.
+    """
+    for name in list_partitions(cursor):
+        row = cursor.execute('SELECT last_rowid FROM rollup_state WHERE partition = ?', (name,)).fetchone()
+        start = row[0] if row else 0
+        end = cursor.execute(f'SELECT MAX(rowid) FROM {name}').fetchone()[0] or 0
+        if end <= start:
+            continue
+        end = min(end, start + chunk)
+
+        cursor.execute(f'''
+            INSERT INTO hourly_counts (mac_id, hour, count)
+            SELECT mac_id, ts / 3600 * 3600, COUNT(*)
+            FROM {name} WHERE rowid > ? AND rowid <= ?
+            GROUP BY mac_id, ts / 3600
+            ON CONFLICT(mac_id, hour) DO UPDATE SET count = count + excluded.count
+        ''', (start, end))
+        # Bare columns next to MAX() come from the row holding the maximum
+        cursor.execute(f'''
+            INSERT INTO device_locations (mac_id, rssi, lat, lon, ts)
+            SELECT mac_id, MAX(rssi), lat, lon, ts
+            FROM {name} WHERE rowid > ? AND rowid <= ? AND lat IS NOT NULL
+            GROUP BY mac_id
+            ON CONFLICT(mac_id) DO UPDATE SET
+                rssi = excluded.rssi, lat = excluded.lat, lon = excluded.lon, ts = excluded.ts
+            WHERE excluded.rssi > device_locations.rssi
+        ''', (start, end))
+        index_locations(cursor, name, start, end)
+        cursor.execute('''
+            INSERT INTO rollup_state (partition, last_rowid) VALUES (?, ?)
+            ON CONFLICT(partition) DO UPDATE SET last_rowid = excluded.last_rowid
+        ''', (name, end))
+
+def _drop_partition(cursor, name, archive_path=None):
+    if archive_path:
+        # ATTACH/DETACH are not allowed inside a transaction
+        cursor.connection.commit()
+        cursor.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+        try:
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS archive.{name} AS SELECT * FROM main.{name} WHERE 0')
+            cursor.execute(f'INSERT INTO archive.{name} SELECT * FROM main.{name}')
+            cursor.connection.commit()
+        finally:
+            cursor.execute('DETACH DATABASE archive')
+    cursor.execute(f'DROP TABLE IF EXISTS {name}_geo')
+    cursor.execute(f'DROP TABLE IF EXISTS {name}')
+    cursor.execute('DELETE FROM rollup_state WHERE partition = ?', (name,))
+    logging.info(f"Dropped sightings partition {name}" + (f" (archived to {archive_path})" if archive_path else ""))
+
+def _drop_partitions_before(cursor, cutoff, archive_path=None):
+    oldest_kept = partition_name(cutoff)
+    for name in list_partitions(cursor):
+        if name < oldest_kept:
+            _drop_partition(cursor, name, archive_path)
+
+def _new_adapter_id(adapter):
+    """Id of 'adapter', assigned under the lock on first use and queued for the adapters table."""
+    with _adapter_lock:
+        adapter_id = _adapter_ids.get(adapter)
+        if adapter_id is None:
+            adapter_id = max(_adapter_ids.values(), default=0) + 1
+            _adapter_ids[adapter] = adapter_id
+            get_writer().submit('INSERT OR IGNORE INTO adapters (id, name) VALUES (?, ?)', (adapter_id, adapter))
+        return adapter_id
+
+class SightingLog:
+    """
+    Append-only per-sighting log: (mac_id, ts, rssi, lat, lon, adapter_id)
+    rows are buffered in memory and written in bulk into one table per day.
+    """
+
+    def __init__(self, gps_track=None):
+        global _adapter_ids
+        # When set, rows without coordinates are located from this track at flush time
+        self.gps_track = gps_track
+        self._buffer = []
+        self._partitions = set()
+        with _adapter_lock:
+            if _adapter_ids is None:
+                _adapter_ids = load_adapter_ids()
+        self._last_rollup = time.monotonic()
+
+    def adapter_id(self, adapter):
+        return _adapter_ids.get(adapter) or _new_adapter_id(adapter)
+
+    def append(self, mac_id, timestamp, rssi, lat, lon, adapter):
+        """
+        lat/lon are already scaled with scale_coordinate(). Pass None to
+        have them interpolated from the GPS track at flush time.
+        """
+        if rssi is not None:
+            rssi = max(-128, min(127, rssi))
+        self._buffer.append((mac_id, timestamp, rssi, lat, lon, self.adapter_id(adapter)))
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def flush(self):
+        """Queue buffered rows, one executemany per day partition."""
+        if not self._buffer:
+            return 0
+        rows, self._buffer = self._buffer, []
+        if self.gps_track is not None:
+            rows = self._locate(rows)
+        # Grouped by UTC day number; the name is formatted once per day
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row[1] // 86400, []).append(row)
+
+        writer = get_writer()
+        for day, partition_rows in by_day.items():
+            name = partition_name(day * 86400)
+            if name not in self._partitions:
+                writer.call(_create_partition, name)
+                self._partitions.add(name)
+            writer.submit_many(
+                f'INSERT INTO {name} (mac_id, ts, rssi, lat, lon, adapter_id) VALUES (?, ?, ?, ?, ?, ?)',
+                partition_rows
+            )
+        commit_pending()
+        return len(rows)
+
+    def _locate(self, rows):
+        track = self.gps_track
+        fixes = track.snapshot()
+        if not fixes:
+            return rows
+        located = []
+        for row in rows:
+            if row[3] is None:
+                fix = track.fix_at(row[1], fixes)
+                if fix is not None:
+                    row = (row[0], row[1], row[2], scale_coordinate(fix[0]), scale_coordinate(fix[1]), row[5])
+            located.append(row)
+        return located
+
+    def rollup_due(self):
+        return time.monotonic() - self._last_rollup >= utils.SIGHTINGS_ROLLUP_INTERVAL
+
+    def rollup(self):
+        """Queue an incremental rollup on the writer thread."""
+        self._last_rollup = time.monotonic()
+        get_writer().call(_rollup, utils.SIGHTINGS_ROLLUP_CHUNK)
+        commit_pending()
+
+    def forget_partition(self, name):
+        """'name' was dropped elsewhere (retention); recreate it if written again."""
+        self._partitions.discard(name)
+
+    def drop_partitions_before(self, cutoff, archive_path=None):
+        """Drop (optionally archive to another SQLite file) days older than 'cutoff'."""
+        self._partitions = {name for name in self._partitions if name >= partition_name(cutoff)}
+        get_writer().call(_drop_partitions_before, cutoff, archive_path)
+        commit_pending()
+
+def get_sighting_log():
+    global _sighting_log
+    if _sighting_log is None:
+        _sighting_log = SightingLog()
+    return _sighting_log
@@ -0,0 +1,449 @@
+# modules/simulator.py
+
+import asyncio
+import json
+import logging
+import random
+import time
+
+from bleak import BleakError
+from bleak.backends.device import BLEDevice
+from bleak.backends.scanner import AdvertisementData
+
+from .ble_backend import set_backend, get_scanner_class
+
+# Seconds between two advert batches emitted by a simulated scanner
+TICK = 0.05
+
+_world = None
+
+class SimulationConfig:
+    """Knobs of the synthetic radio environment."""
+
+    def __init__(self, devices=500, churn_per_minute=30, random_mac_fraction=0.3,
+                 mac_rotation=900, advert_interval=1.0, models=20,
+                 services=4, characteristics=6, connect_latency=1.0,
+                 connect_failure_rate=0.2, read_latency=0.05, seed=None):
+        self.devices = devices
+        # Devices leaving (and as many arriving) per minute
+        self.churn_per_minute = churn_per_minute
+        # Share of devices using a random private address, rotated every
+        # 'mac_rotation' seconds
+        self.random_mac_fraction = random_mac_fraction
+        self.mac_rotation = mac_rotation
+        # Average seconds between two adverts of one device
+        self.advert_interval = advert_interval
+        # Devices of the same model share one GATT layout
+        self.models = models
+        self.services = services
+        self.characteristics = characteristics
+        self.connect_latency = connect_latency
+        self.connect_failure_rate = connect_failure_rate
+        self.read_latency = read_latency
+        self.seed = seed
+
+class _SimDevice:
+    __slots__ = ("address", "address_type", "name", "model", "rssi", "manufacturer_data", "service_uuids", "rotates_at")
+
+class _SimService:
+    def __init__(self, handle, uuid, characteristics):
+        self.handle = handle
+        self.uuid = uuid
+        self.description = "Simulated service"
+        self.characteristics = characteristics
+
+class _SimCharacteristic:
+    def __init__(self, handle, uuid, properties):
+        self.handle = handle
+        self.uuid = uuid
+        self.description = "Simulated characteristic"
+        self.properties = properties
+
+def _uuid16(value):
+    return f"0000{value & 0xFFFF:04x}-0000-1000-8000-00805f9b34fb"
+
+class _Metrics:
+    """Counters shared by the synthetic and replay worlds."""
+
+    def __init__(self):
+        self.adverts = 0
+        self.connects = 0
+        self.connect_failures = 0
+        self.captures = 0
+        # MAC -> monotonic time of its first advert
+        self.first_heard = {}
+        # Seconds from first advert to a completed GATT capture, per device
+        self.latencies = []
+
+    def heard(self, address):
+        self.adverts += 1
+        if address not in self.first_heard:
+            self.first_heard[address] = time.monotonic()
+
+    def captured(self, address):
+        self.captures += 1
+        first = self.first_heard.get(address)
+        if first is not None:
+            self.latencies.append(time.monotonic() - first)
+
+class SimulatedWorld(_Metrics):
+    """
+    Population of synthetic devices. Scanners sample adverts from it and
+    clients connect to its devices; churn and MAC rotation are applied
+    lazily as simulated time passes.
+    """
+
+    def __init__(self, config=None):
+        super().__init__()
+        self.config = config or SimulationConfig()
+        self._random = random.Random(self.config.seed)
+        self._devices = [self._new_device() for _ in range(self.config.devices)]
+        self._by_address = {device.address: device for device in self._devices}
+        self._layouts = {}
+        self._last_advance = time.monotonic()
+        self._churn_credit = 0.0
+
+    def _random_address(self, private):
+        raw = self._random.getrandbits(48)
+        if private:
+            # Resolvable private address: top two bits 01
+            raw = (raw & 0x3FFFFFFFFFFF) | 0x400000000000
+        else:
+            raw &= 0x3FFFFFFFFFFF
+        text = f"{raw:012X}"
+        return ":".join(text[i:i + 2] for i in range(0, 12, 2))
+
+    def _new_device(self):
+        config = self.config
+        device = _SimDevice()
+        private = self._random.random() < config.random_mac_fraction
+        device.address = self._random_address(private)
+        device.address_type = "random" if private else "public"
+        device.model = self._random.randrange(max(config.models, 1))
+        device.name = f"SIM-{device.model:03d}" if self._random.random() < 0.5 else None
+        device.rssi = self._random.randint(-95, -40)
+        device.manufacturer_data = {0x0059 + device.model: bytes([device.model, self._random.getrandbits(8)])}
+        device.service_uuids = [_uuid16(0x1800 + device.model % 16)]
+        device.rotates_at = (
+            time.monotonic() + self._random.uniform(0, config.mac_rotation)
+            if private and config.mac_rotation else None
+        )
+        return device
+
+    def _advance(self):
+        now = time.monotonic()
+        elapsed = now - self._last_advance
+        if elapsed <= 0:
+            return
+        self._last_advance = now
+
+        self._churn_credit += self.config.churn_per_minute * elapsed / 60
+        while self._churn_credit >= 1 and self._devices:
+            self._churn_credit -= 1
+            index = self._random.randrange(len(self._devices))
+            del self._by_address[self._devices[index].address]
+            self._devices[index] = self._new_device()
+            self._by_address[self._devices[index].address] = self._devices[index]
+
+        for device in self._devices:
+            if device.rotates_at is not None and device.rotates_at <= now:
+                del self._by_address[device.address]
+                device.address = self._random_address(True)
+                device.rotates_at = now + self.config.mac_rotation
+                self._by_address[device.address] = device
+
+    def sampler(self):
+        """Per-scanner advert source: take(dt) -> [(BLEDevice, AdvertisementData)]."""
+        world = self
+        credit = [0.0]
+
+        def take(dt):
+            world._advance()
+            if not world._devices:
+                return []
+            credit[0] += len(world._devices) * dt / max(world.config.advert_interval, 1e-3)
+            count = int(credit[0])
+            credit[0] -= count
+            adverts = []
+            for _ in range(count):
+                device = world._devices[world._random.randrange(len(world._devices))]
+                world.heard(device.address)
+                adverts.append((
+                    # Details shaped like BlueZ's, for identity.address_type()
+                    BLEDevice(device.address, device.name, {"props": {"AddressType": device.address_type}}),
+                    AdvertisementData(
+                        device.name, device.manufacturer_data, {}, device.service_uuids,
+                        None, device.rssi + world._random.randint(-6, 6), ()
+                    ),
+                ))
+            return adverts
+
+        return take
+
+    def layout(self, address):
+        """GATT services of the device at 'address' (shared per model)."""
+        device = self._by_address.get(address)
+        model = device.model if device is not None else 0
+        services = self._layouts.get(model)
+        if services is None:
+            services = []
+            handle = 1
+            for s in range(self.config.services):
+                service_handle = handle
+                handle += 1
+                characteristics = []
+                for c in range(self.config.characteristics):
+                    properties = ["read"] if (s + c + model) % 3 else ["read", "notify"]
+                    characteristics.append(_SimCharacteristic(handle + 1, _uuid16(0x2A00 + s * 16 + c), properties))
+                    handle += 2
+                services.append(_SimService(service_handle, _uuid16(0x1800 + s), characteristics))
+            self._layouts[model] = services
+        return services
+
+    def value(self, address, characteristic):
+        return f"{address}/{characteristic.handle}".encode()
+
+class ReplayWorld(_Metrics):
+    """
+    Replays adverts recorded with record_adverts() (JSON lines). 'speed'
+    compresses time: 10 replays a ten-minute capture in one minute.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False, config=None):
+        super().__init__()
+        self.config = config or SimulationConfig()
+        self.speed = speed
+        self.loop = loop
+        self._random = random.Random(self.config.seed)
+        self._fallback = SimulatedWorld(self.config)
+        self._events = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    self._events.append(json.loads(line))
+        self._events.sort(key=lambda event: event["t"])
+        if self._events:
+            start = self._events[0]["t"]
+            for event in self._events:
+                event["t"] -= start
+        logging.info(f"Replay: loaded {len(self._events)} adverts from {path}")
+
+    def sampler(self):
+        world = self
+        state = {"position": 0, "clock": 0.0, "offset": 0.0}
+
+        def take(dt):
+            events = world._events
+            state["clock"] += dt * world.speed
+            adverts = []
+            while True:
+                if state["position"] >= len(events):
+                    if not world.loop or not events:
+                        return adverts
+                    state["position"] = 0
+                    state["offset"] += events[-1]["t"] + 1
+                event = events[state["position"]]
+                if event["t"] + state["offset"] > state["clock"]:
+                    return adverts
+                state["position"] += 1
+                world.heard(event["address"])
+                adverts.append((
+                    BLEDevice(event["address"], event.get("name"), None),
+                    AdvertisementData(
+                        event.get("name"),
+                        {int(k): bytes.fromhex(v) for k, v in event.get("manufacturer_data", {}).items()},
+                        {k: bytes.fromhex(v) for k, v in event.get("service_data", {}).items()},
+                        event.get("service_uuids", []),
+                        event.get("tx_power"),
+                        event.get("rssi", -100),
+                        (),
+                    ),
+                ))
+
+        return take
+
+    def layout(self, address):
+        return self._fallback.layout(address)
+
+    def value(self, address, characteristic):
+        return self._fallback.value(address, characteristic)
+
+class CaptureReplayWorld(ReplayWorld):
+    """
+    Replays binary capture files (modules/capture.py) straight from their
+    memory mapping; records are decoded only as the replay clock reaches them.
+    """
+
+    def __init__(self, paths, speed=1.0, loop=False, config=None):
+        _Metrics.__init__(self)
+        self.config = config or SimulationConfig()
+        self.speed = speed
+        self.loop = loop
+        self._random = random.Random(self.config.seed)
+        self._fallback = SimulatedWorld(self.config)
+        self.paths = [paths] if isinstance(paths, str) else list(paths)
+
+    def sampler(self):
+        from .capture import iter_captures
+        world = self
+        state = {
+            "records": iter_captures(self.paths), "next": None, "start": None,
+            "clock": 0.0, "offset": 0.0, "last": 0.0,
+        }
+
+        def take(dt):
+            state["clock"] += dt * world.speed
+            adverts = []
+            while True:
+                advert = state["next"]
+                if advert is None:
+                    advert = next(state["records"], None)
+                    if advert is None:
+                        if not world.loop or state["start"] is None:
+                            return adverts
+                        state["records"] = iter_captures(world.paths)
+                        state["offset"] += state["last"] + 1
+                        continue
+                    if state["start"] is None:
+                        state["start"] = advert.timestamp
+                    state["next"] = advert
+                relative = advert.timestamp - state["start"]
+                if relative + state["offset"] > state["clock"]:
+                    return adverts
+                state["next"] = None
+                state["last"] = relative
+                world.heard(advert.mac)
+                adverts.append((
+                    BLEDevice(advert.mac, advert.local_name, None),
+                    AdvertisementData(
+                        advert.local_name, advert.manufacturer_data, advert.service_data,
+                        advert.service_uuids, advert.tx_power, advert.rssi, ()
+                    ),
+                ))
+
+        return take
+
+class SimulatedScanner:
+    """Drop-in for BleakScanner backed by the installed world."""
+
+    def __init__(self, detection_callback=None, adapter=None, **kwargs):
+        self._callback = detection_callback
+        self._adapter = adapter
+        self._take = _world.sampler()
+        self._task = None
+
+    async def start(self):
+        async def run():
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(TICK)
+                now = time.monotonic()
+                for device, advertisement_data in self._take(now - last):
+                    self._callback(device, advertisement_data)
+                last = now
+
+        self._task = asyncio.create_task(run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @classmethod
+    async def discover(cls, timeout=5.0, return_adv=False, **kwargs):
+        # Like BleakScanner.discover: a new scanner from kwargs (adapter=...)
+        scanner = cls(**kwargs)
+        seen = {}
+        deadline = time.monotonic() + timeout
+        last = time.monotonic()
+        while time.monotonic() < deadline:
+            await asyncio.sleep(TICK)
+            now = time.monotonic()
+            for device, advertisement_data in scanner._take(now - last):
+                seen[device.address] = (device, advertisement_data)
+            last = now
+        if return_adv:
+            return seen
+        return [device for device, _ in seen.values()]
+
+class SimulatedClient:
+    """Drop-in for BleakClient with configurable latency and failures."""
+
+    def __init__(self, address, adapter=None, timeout=10.0, **kwargs):
+        self.address = address
+        self.adapter = adapter
+        self.timeout = timeout
+        self.is_connected = False
+        self.services = []
+
+    async def __aenter__(self):
+        config = _world.config
+        _world.connects += 1
+        latency = _world._random.uniform(0.5, 1.5) * config.connect_latency
+        if latency > self.timeout:
+            await asyncio.sleep(self.timeout)
+            _world.connect_failures += 1
+            raise BleakError(f"Simulated connection to {self.address} timed out")
+        await asyncio.sleep(latency)
+        if _world._random.random() < config.connect_failure_rate:
+            _world.connect_failures += 1
+            raise BleakError(f"Simulated connection to {self.address} failed")
+        self.is_connected = True
+        self.services = _world.layout(self.address)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.is_connected and exc_type is None:
+            _world.captured(self.address)
+        self.is_connected = False
+
+    async def read_gatt_char(self, characteristic):
+        await asyncio.sleep(_world._random.uniform(0.5, 1.5) * _world.config.read_latency)
+        return _world.value(self.address, characteristic)
+
+def install(world):
+    """Route bluetooth_scanner/device_connector through 'world'."""
+    global _world
+    _world = world
+    set_backend(SimulatedScanner, SimulatedClient)
+    return world
+
+def installed_world():
+    """The world set by install(), or None when bleak is in use."""
+    return _world
+
+def uninstall():
+    global _world
+    _world = None
+    set_backend()
+
+async def record_adverts(path, adapter, duration):
+    """
+    Capture real adverts from 'adapter' for 'duration' seconds into 'path'
+    (JSON lines) for later use with ReplayWorld. Returns the advert count.
+    """
+    started = time.monotonic()
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        def on_advert(device, advertisement_data):
+            nonlocal count
+            count += 1
+            f.write(json.dumps({
+                "t": round(time.monotonic() - started, 3),
+                "address": device.address,
+                "name": advertisement_data.local_name or device.name,
+                "rssi": advertisement_data.rssi,
+                "manufacturer_data": {str(k): v.hex() for k, v in advertisement_data.manufacturer_data.items()},
+                "service_data": {k: v.hex() for k, v in advertisement_data.service_data.items()},
+                "service_uuids": list(advertisement_data.service_uuids),
+                "tx_power": advertisement_data.tx_power,
+            }) + "\n")
+
+        scanner = get_scanner_class()(detection_callback=on_advert, adapter=adapter)
+        await scanner.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            await scanner.stop()
+    return count
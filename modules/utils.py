@@ -1,46 +1,136 @@
 # modules/utils.py
 
 import re
-import time
-import pickle
-import os
+from functools import lru_cache
 
-gps_status = "offline"
-latest_gps_coords = {"latitude": None, "longitude": None}
-last_gps_update_time = None  # Time of last GPS update
+GPS_DATA_TIMEOUT = 300          # Max seconds between a sighting and the fix used for it
 
-scanning_started = False
-device_being_processed = False
+# GPS sources (modules/gps_server.py) and fix buffer (modules/gps_track.py)
+GPS_SOURCE = "http"             # "http" (POST /gps), "gpsd" or "nmea"
+GPS_HTTP_HOST = "0.0.0.0"
+GPS_HTTP_PORT = 5000
+GPSD_HOST = "127.0.0.1"
+GPSD_PORT = 2947
+GPS_SERIAL_DEVICE = "/dev/ttyACM0"
+GPS_SERIAL_BAUD = 9600
+GPS_BUFFER_SIZE = 600           # Fixes kept for interpolation
+GPS_INTERPOLATE_MAX_GAP = 60    # Interpolate only between fixes at most this far apart
+GPS_WAIT_FOR_FIX = True         # Hold the first scan until a fix arrives
 
-GPS_DATA_TIMEOUT = 300
+DETECTION_COUNT_INTERVAL = 1800  # Seconds between detection_count increments
 
-device_last_count_update = {}
+# Defaults of the runtime settings (modules/runtime.py); main.py overrides them per run
+USE_GPS = False
+MAX_CONNECT = 5          # Simultaneous connections per connect adapter
+SCAN_MODE = "cycle"      # "cycle": discover + connect + sleep, "stream": continuous scanning,
+                         # "sharded": scanner/connector processes (modules/sharded.py)
+STATE_JOURNAL = "pible_state.journal"  # Append-only journal of runtime state (None: don't persist)
+STATE_JOURNAL_COMPACT = 10000          # Compact the journal once it has this many lines
+SCAN_DURATION = 3.0      # Seconds per discover() call in cycle mode
+SCAN_INTERVAL = 3.0      # Seconds between two scan cycles
+ADVERT_QUEUE_SIZE = 10000  # Adverts buffered between the scanner callback and persistence
 
-connect_mode = True  # We can just set this to True by default if you like
-gps_data_received = False
-use_gps = False
+# Sharded scan mode (modules/sharded.py)
+SHARD_CONNECTORS = None      # Connector processes; None: one per connect adapter
+SHARD_BATCH_INTERVAL = 0.1   # Seconds a scanner process collects adverts before sending them
+SHARD_QUEUE_SIZE = 1000      # Messages waiting for the main process before scanners drop batches
 
-max_connect = 5  # Default concurrency limit
+# Connection scheduler
+REINTERROGATE_TTL = 24 * 3600  # Don't reconnect to a device whose GATT table is younger than this
+CONNECT_BACKOFF_BASE = 10      # Seconds before the first retry after a failed connect
+CONNECT_BACKOFF_MAX = 1800     # Upper bound on the retry delay
+CONNECT_QUEUE_MAX_AGE = 30     # Drop queued connects older than this (device probably gone)
+
+# GATT interrogation
+GATT_CONNECT_TIMEOUT = 10      # Seconds allowed for connect + service discovery
+GATT_DEVICE_TIMEOUT = 20       # Total seconds per device, connect included
+GATT_READ_TIMEOUT = 3          # Seconds per characteristic read
+GATT_READ_CONCURRENCY = 4      # Reads in flight per connection
+CONNECT_COOLDOWN_MIN = 0.5     # First pause on an adapter after a failed connect
+CONNECT_COOLDOWN_MAX = 5       # Longest pause after repeated failures
+
+# Console output (modules/console.py)
+CONSOLE_MODE = "verbose"       # "verbose": per-device lines, "summary": statistics only, "dashboard": live table
+DASHBOARD_REFRESH = 1.0        # Seconds between dashboard redraws
+DASHBOARD_ROWS = 20            # Most recently heard devices shown in the dashboard
+DASHBOARD_EVENTS = 8           # Recent connect/error messages shown under the table
+CONSOLE_QUEUE_SIZE = 10000     # Lines waiting for the console writer thread before dropping
+
+# Metrics (modules/metrics.py)
+METRICS_HTTP = True            # Serve GET /metrics on GPS_HTTP_HOST:GPS_HTTP_PORT even without the GPS server
+METRICS_DUMP_PATH = None       # Also write all metrics as JSON to this file
+METRICS_DUMP_INTERVAL = 60     # Seconds between JSON dumps
+METRICS_LAG_INTERVAL = 0.5     # Period of the event-loop lag probe
+
+# Query API (modules/api.py), served on the same port as /gps and /metrics
+API_LIST_TTL = 1.0             # Seconds a sorted device list is reused between requests
+API_DETAIL_TTL = 30            # Seconds a device's stored row and GATT table are cached
+API_DETAIL_CACHE = 1000        # Devices kept in the detail cache
+API_PAGE_SIZE = 50             # Default page size of GET /api/devices
+API_PAGE_MAX = 500             # Largest page a client may ask for
+API_EVENT_BUFFER = 1000        # New-device events kept for GET /api/events
+API_EVENT_HEARTBEAT = 15       # Seconds between SSE keep-alive comments
+API_MAX_STREAMS = 16           # Concurrent GET /api/events streams
+
+# Database settings
+DB_PATH = "bluetooth_devices.db"
+DB_JOURNAL_MODE = "WAL"
+DB_SYNCHRONOUS = "NORMAL"     # OFF / NORMAL / FULL
+DB_CACHE_SIZE = -8000         # Negative value = size in KiB
+DB_COMMIT_INTERVAL = 1.0      # Max seconds a write transaction stays open
+DB_MAX_BATCH = 5000           # Max statements per transaction
+
+# In-memory device registry
+REGISTRY_MAX_DEVICES = 50000   # LRU bound on records kept in memory
+REGISTRY_TTL = 6 * 3600        # Drop records not seen for this many seconds
+REGISTRY_FLUSH_INTERVAL = 10   # Seconds between write-behind flushes
+
+# Identity resolution for rotating random addresses (modules/identity.py)
+IDENTITY_MAX_GAP = 30          # Max seconds between the old MAC's last advert and the new MAC's first
+IDENTITY_RSSI_DELTA = 12       # Max RSSI difference (dB) across a rotation
+IDENTITY_SPLIT_GRACE = 10      # Old MAC heard this long after a rotation = two devices, split
+IDENTITY_CANDIDATES = 8        # Logical devices kept per fingerprint
+
+# Sightings history
+SIGHTING_INTERVAL = 1              # Min seconds between logged sightings of one device
+SIGHTINGS_ROLLUP_INTERVAL = 60     # Seconds between background rollups
+SIGHTINGS_ROLLUP_CHUNK = 50000     # Max sightings folded per partition per rollup
+
+# Retention (modules/retention.py); None disables a policy
+RETENTION_SIGHTINGS_DAYS = 90      # Drop sightings day partitions older than this
+RETENTION_AGGREGATE_DAYS = 730     # Drop hourly_counts/heat_cells hours older than this
+RETENTION_GATT_DAYS = 180          # Drop GATT values of devices not seen for this long
+RETENTION_DEVICES_DAYS = None      # Drop devices not seen for this long
+RETENTION_MAX_DB_MB = None         # Evict oldest data while the live data is larger
+RETENTION_INTERVAL = 3600          # Seconds between retention passes
+RETENTION_DELETE_CHUNK = 5000      # Max rows deleted per transaction
+RETENTION_IDLE_BACKLOG = 50        # Wait while the writer has more statements queued
+RETENTION_STEP_PAUSE = 0.2         # Seconds between two retention steps
+VACUUM_STEP_PAGES = 256            # Pages returned to the filesystem per step
+
+# Log file (modules/console.py)
+LOG_MAX_BYTES = 10 * 1024 * 1024   # Rotate app.log at this size; 0 never rotates
+LOG_BACKUPS = 5                    # Rotated logs kept (app.log.1.gz ...)
+LOG_COMPRESS = True                # gzip rotated logs
+
+# Exports (modules/export.py)
+EXPORT_CHUNK_ROWS = 10000              # Rows fetched and written per chunk
+EXPORT_STATE = "pible_export.json"     # Watermarks of incremental exports
+
+# Raw advert capture (modules/capture.py)
+CAPTURE_DIR = None                     # Directory for capture files; None disables capture
+CAPTURE_ROTATE_BYTES = 64 * 1024 * 1024  # Start a new file after this many bytes
+CAPTURE_INDEX_EVERY = 1024             # Records between two index entries
+
+_MAC_PATTERN = re.compile(r'([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})')
 
 def is_mac_address(name):
-    mac_pattern = r'([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})'
-    return re.fullmatch(mac_pattern, name) is not None
-
-def is_gps_data_fresh():
-    if not use_gps:
-        return False
-    if last_gps_update_time is None:
-        return False
-    return (time.time() - last_gps_update_time) <= GPS_DATA_TIMEOUT
-
-def load_device_last_count_update():
-    if os.path.exists("device_last_count_update.pkl"):
-        with open("device_last_count_update.pkl", "rb") as f:
-            return pickle.load(f)
-    return {}
-
-def save_device_last_count_update():
-    with open("device_last_count_update.pkl", "wb") as f:
-        pickle.dump(device_last_count_update, f)
-
-device_last_count_update = load_device_last_count_update()
+    return _MAC_PATTERN.fullmatch(name) is not None
+
+@lru_cache(maxsize=4096)
+def display_name(name):
+    """
+    Name stored for an advertised name: "Unknown" for none or for a MAC
+    address posing as a name. Cached, since devices repeat their names.
+    """
+    return name if name and not is_mac_address(name) else "Unknown"
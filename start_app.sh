@@ -1,9 +1,14 @@
 #!/bin/bash
 
-# Завершение всех процессов, использующих порт 5000
-sudo fuser -k 5000/tcp
+# Интерактивный запуск. Для работы без терминала (systemd) см. pible.service:
+#   python3 main.py --daemon --config /etc/pible.conf
+# Аргументы передаются в main.py, например: ./start_app.sh --adapters all --max-connect 4
 
-sudo systemctl restart bluetooth
+# Перезапуск bluetoothd только по запросу: ./start_app.sh --restart-bluetooth ...
+if [ "$1" = "--restart-bluetooth" ]; then
+    shift
+    sudo systemctl restart bluetooth
+fi
 
 # Активация виртуального окружения
 # source venv/bin/activate
@@ -11,4 +16,4 @@ sudo systemctl restart bluetooth
 hciconfig
 
 # Запуск Python-скрипта
-sudo venv/bin/python3 main.py
\ No newline at end of file
+sudo venv/bin/python3 main.py "$@"